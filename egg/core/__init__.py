@@ -3,10 +3,18 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from .trainers import Trainer
+from .trainers import Trainer, MetricsAccumulator
 from .callbacks import Callback, ConsoleLogger, TensorboardLogger, TemperatureUpdater, CheckpointSaver
 from .util import init, get_opts, build_optimizer, dump_sender_receiver, move_to, get_summary_writer, close
+from .util import Dump, dump_interactions, iter_dump
 from .early_stopping import EarlyStopperAccuracy
+from .length_cost import LengthCostScheduler, PowerLengthCost, StepLengthCost
+from .horizon import AdaptiveMaxLen
+from .prefetch import PrefetchLoader
+from .compile import compile_game
+from .interventions import intervene, perturb_messages
+from .run_store import RunStore, RunStoreWriter
+from .output_heads import OUTPUT_HEADS, DenseHead, AdaptiveSoftmaxHead, SampledSoftmaxHead, build_output_head
 from .gs_wrappers import (GumbelSoftmaxWrapper,
                           SymbolGameGS, RelaxedEmbedding,
                           RnnSenderGS, RnnReceiverGS,
@@ -22,11 +30,27 @@ from .rnn import RnnEncoder
 
 __all__ = [
     'Trainer',
+    'MetricsAccumulator',
     'get_opts',
     'init',
     'build_optimizer',
     'Callback',
     'EarlyStopperAccuracy',
+    'LengthCostScheduler',
+    'PowerLengthCost',
+    'StepLengthCost',
+    'AdaptiveMaxLen',
+    'PrefetchLoader',
+    'compile_game',
+    'intervene',
+    'perturb_messages',
+    'RunStore',
+    'RunStoreWriter',
+    'OUTPUT_HEADS',
+    'DenseHead',
+    'AdaptiveSoftmaxHead',
+    'SampledSoftmaxHead',
+    'build_output_head',
     'ConsoleLogger',
     'TensorboardLogger',
     'TemperatureUpdater',
@@ -45,6 +69,9 @@ __all__ = [
     'RnnReceiverGS',
     'SenderReceiverRnnGS',
     'dump_sender_receiver',
+    'Dump',
+    'dump_interactions',
+    'iter_dump',
     'move_to',
     'get_summary_writer',
     'close',
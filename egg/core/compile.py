@@ -0,0 +1,162 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+import torch.nn as nn
+
+COMPILE_MODES = ['none', 'agents', 'game']
+
+
+def _graph_breaks():
+    try:
+        from torch._dynamo.utils import counters
+    except ImportError:
+        return None
+    return dict(counters['graph_break'])
+
+
+def _compile_errors():
+    """
+    The exceptions raised by torch.compile when it cannot compile a module, as opposed to the errors of the module.
+    """
+    try:
+        from torch._dynamo import exc
+    except ImportError:
+        return ()
+    return tuple(getattr(exc, name) for name in ['BackendCompilerFailed', 'Unsupported', 'InternalTorchDynamoError']
+                 if hasattr(exc, name))
+
+
+class _CompiledForward:
+    """
+    Replaces the forward of a module by its torch.compile-d version. If a call of the module fails to compile before
+    any of its graphs has run (at the first call, or at a recompilation for a new `training` flag, unrolling
+    horizon...), the compilation error is reported and the module runs eagerly from then on. Any other error is
+    raised, as is a compilation error met once a graph of the call has run: that graph may have applied some of the
+    Python side effects of the forward (baseline updates, the unrolling horizon...), and running the call again
+    eagerly would apply them twice. The runs of the graphs are tracked by wrapping the functions returned by the
+    backend. The graph breaks met during the first call are reported.
+
+    >>> def failing_backend(graph, example_inputs):
+    ...     raise RuntimeError('no backend')
+    >>> linear = nn.Linear(2, 1)
+    >>> forward = _CompiledForward('linear', linear.forward, backend=failing_backend)
+    >>> forward(torch.ones(1, 2)).shape, forward.failed  # doctest: +ELLIPSIS
+    # compile: linear could not be compiled, falling back to eager mode (BackendCompilerFailed: ...)
+    (torch.Size([1, 1]), True)
+    >>> def second_compilation_fails(graph, example_inputs, compilations=[]):
+    ...     compilations.append(graph)
+    ...     if len(compilations) > 1:
+    ...         raise RuntimeError('no backend')
+    ...     return graph.forward
+    >>> forward = _CompiledForward('linear', linear.forward, backend=second_compilation_fails, dynamic=False)
+    >>> forward(torch.ones(1, 2)).shape
+    # compile: linear compiled with 0 graph break(s)
+    torch.Size([1, 1])
+    >>> forward(torch.ones(3, 2)).shape, forward.failed  # doctest: +ELLIPSIS
+    # compile: linear could not be compiled, falling back to eager mode (BackendCompilerFailed: ...)
+    (torch.Size([3, 1]), True)
+    >>> def failing_forward(x):
+    ...     raise ValueError('not a compilation error')
+    >>> forward = _CompiledForward('failing', failing_forward, backend='eager')
+    >>> forward(torch.ones(1))
+    Traceback (most recent call last):
+    ...
+    ValueError: not a compilation error
+    >>> forward.failed
+    False
+    """
+    def __init__(self, name, eager_forward, backend='inductor', **compile_kwargs):
+        self.name = name
+        self.eager_forward = eager_forward
+        if isinstance(backend, str):
+            from torch._dynamo import lookup_backend
+            backend = lookup_backend(backend)
+        self.backend = backend
+        self.compiled_forward = torch.compile(eager_forward, backend=self._tracking_backend, **compile_kwargs)
+        self.failed = False
+        self.first_call = True
+        self.graph_ran = False
+        self.compile_errors = _compile_errors()
+
+    def _tracking_backend(self, graph, example_inputs, **kwargs):
+        compiled_graph = self.backend(graph, example_inputs, **kwargs)
+
+        def run(*args):
+            self.graph_ran = True
+            return compiled_graph(*args)
+        # the calling convention of the compiled graph (a single list of inputs) is kept
+        run._boxed_call = getattr(compiled_graph, '_boxed_call', False)
+        return run
+
+    def __call__(self, *args, **kwargs):
+        if self.failed:
+            return self.eager_forward(*args, **kwargs)
+
+        breaks_before = _graph_breaks() if self.first_call else None
+        self.graph_ran = False
+        try:
+            output = self.compiled_forward(*args, **kwargs)
+        except self.compile_errors as e:
+            if self.graph_ran:
+                raise
+            self.failed = True
+            print(f"# compile: {self.name} could not be compiled, falling back to eager mode "
+                  f"({type(e).__name__}: {str(e).splitlines()[0] if str(e) else ''})")
+            return self.eager_forward(*args, **kwargs)
+
+        if self.first_call:
+            self.first_call = False
+            self._report(breaks_before)
+        return output
+
+    def _report(self, breaks_before):
+        breaks_after = _graph_breaks()
+        if breaks_before is None or breaks_after is None:
+            return
+        new_breaks = {reason: count - breaks_before.get(reason, 0) for reason, count in breaks_after.items()
+                      if count > breaks_before.get(reason, 0)}
+        print(f"# compile: {self.name} compiled with {sum(new_breaks.values())} graph break(s)")
+        for reason, count in new_breaks.items():
+            print(f"#   {count}x {reason.splitlines()[0]}")
+
+
+def compile_game(game: nn.Module, mode: str = 'game', **compile_kwargs) -> nn.Module:
+    """
+    Compiles a game with torch.compile, in place: the module hierarchy, and hence the state dicts and the checkpoints,
+    are unchanged. The Python-level unrolling loops of the agents are traced step by step, and a new graph is compiled
+    for each value of the attributes they branch on (`training`, the unrolling horizon, ...). Data-dependent control
+    flow, such as the early exit of Sender or the length buckets of Receiver, causes graph breaks: they are reported
+    at the first call. A module whose call cannot be compiled before any of its graphs has run falls back to eager
+    mode.
+
+    :param game: the game to be compiled
+    :param mode: 'none' (the game is returned as is), 'agents' (the forward of `game.sender` and `game.receiver` are
+        compiled, the game logic stays eager) or 'game' (the forward of the whole game is compiled)
+    :param compile_kwargs: passed to torch.compile (e.g. backend, dynamic). As the backend is wrapped, `mode` and
+        `options` reach it as keyword arguments, which only custom backends accept
+
+    >>> game = compile_game(nn.Linear(2, 1), mode='none')
+    >>> isinstance(game.forward, _CompiledForward)
+    False
+    """
+    if mode not in COMPILE_MODES:
+        raise ValueError(f"Unknown compile mode: {mode}")
+    if mode == 'none':
+        return game
+    if not hasattr(torch, 'compile'):
+        print(f"# compile: torch.compile requires PyTorch 2.0, torch {torch.__version__} runs the game eagerly")
+        return game
+
+    if mode == 'game':
+        targets = [('game', game)]
+    else:
+        targets = [(name, getattr(game, name)) for name in ['sender', 'receiver'] if hasattr(game, name)]
+
+    for name, module in targets:
+        if not isinstance(module.forward, _CompiledForward):
+            module.forward = _CompiledForward(name, module.forward, **compile_kwargs)
+
+    return game
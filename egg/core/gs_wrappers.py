@@ -85,7 +85,7 @@ class SymbolGameGS(nn.Module):
         loss, rest_info = self.loss(sender_input, message, receiver_input, receiver_output, labels)
         for k, v in rest_info.items():
             if hasattr(v, 'mean'):
-                rest_info[k] = v.mean().item()
+                rest_info[k] = v.mean().detach()
 
         return loss.mean(), rest_info
 
@@ -204,7 +204,7 @@ class RnnSenderGS(nn.Module):
             else:
                 h_t = self.cell(e_t, prev_hidden)
 
-            step_logits = F.log_softmax(self.hidden_to_output(h_t), dim=1)
+            step_logits = F.log_softmax(self.hidden_to_output(h_t).float(), dim=1)
             distr = RelaxedOneHotCategorical(logits=step_logits, temperature=self.temperature)
 
             if self.training:
@@ -0,0 +1,83 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+
+class AdaptiveMaxLen:
+    """
+    Training-time controller of the unrolling horizon of Sender, i.e. the number of symbols it generates before the
+    messages are cut by an EOS symbol. It keeps a decayed histogram of the message lengths (including EOS) seen during
+    training and, every `interval` batches, sets the horizon to a high quantile of it plus a safety margin. When more
+    than `1 - quantile` of the messages were truncated by the current horizon, the horizon grows back by `margin`
+    instead. The horizon never exceeds `max_len`.
+
+    The histogram stays on the device of the lengths: the host only reads it when the horizon is updated.
+
+    >>> controller = AdaptiveMaxLen(max_len=30, quantile=0.9, margin=2, interval=1)
+    >>> controller.horizon
+    30
+    >>> controller.update(torch.tensor([3, 4, 4, 5]))
+    >>> controller.horizon
+    7
+    >>> controller.update(torch.tensor([8, 8, 8, 2]))  # 8 = 7 symbols + the EOS padded by Sender: truncated
+    >>> controller.horizon
+    9
+    """
+    def __init__(self, max_len: int, quantile: float = 0.99, margin: int = 2, decay: float = 0.99,
+                 interval: int = 10) -> None:
+        """
+        :param max_len: the maximal number of symbols generated by Sender (the initial horizon)
+        :param quantile: the quantile of the lengths that must fit in the horizon
+        :param margin: the number of positions added to the quantile, and the growth step after a truncation
+        :param decay: the decay of the length histogram at each batch
+        :param interval: the number of batches between two updates of the horizon
+        """
+        assert 0. < quantile <= 1., 'The quantile must be in (0, 1]'
+        self.max_len = max_len
+        self.quantile = quantile
+        self.margin = margin
+        self.decay = decay
+        self.interval = interval
+
+        self.horizon = max_len
+        self.counts = None
+        self.n_truncated = None
+        self.n_seen = None
+        self.n_batches = 0
+
+    def update(self, message_lengths: torch.Tensor) -> None:
+        """
+        :param message_lengths: the lengths (including EOS) of the messages of a training batch
+        """
+        counts = torch.bincount(message_lengths, minlength=self.max_len + 2).float()
+        truncated = (message_lengths > self.horizon).sum() if self.horizon < self.max_len else 0
+
+        if self.counts is None:
+            self.counts = counts
+            self.n_truncated = torch.zeros((), device=counts.device)
+            self.n_seen = 0
+        else:
+            self.counts = self.counts * self.decay + counts
+        self.n_truncated = self.n_truncated + truncated
+        self.n_seen += message_lengths.size(0)
+
+        self.n_batches += 1
+        if self.n_batches % self.interval == 0:
+            self._update_horizon()
+
+    def _update_horizon(self) -> None:
+        cdf = self.counts.cumsum(0) / self.counts.sum()
+        # a message of length L needs L symbols from Sender, its EOS included
+        length_quantile, n_truncated = torch.stack([(cdf < self.quantile).sum().float(), self.n_truncated]).tolist()
+
+        if n_truncated > (1. - self.quantile) * self.n_seen:
+            horizon = self.horizon + self.margin
+        else:
+            horizon = int(length_quantile) + self.margin
+        self.horizon = max(1, min(self.max_len, horizon))
+
+        self.n_truncated = torch.zeros_like(self.n_truncated)
+        self.n_seen = 0
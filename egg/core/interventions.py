@@ -0,0 +1,193 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+from typing import Optional
+
+import torch
+
+from .util import find_lengths, move_to
+from .reinforce_wrappers import RnnReceiverImpatient, _receive
+
+INTERVENTIONS = ['substitute', 'delete', 'swap', 'truncate']
+# interventions whose result does not depend on a random draw: a single variant is computed
+DETERMINISTIC_INTERVENTIONS = ['delete', 'truncate']
+
+
+def perturb_messages(messages: torch.Tensor, intervention: str, n_samples: int = 1, vocab_size: Optional[int] = None,
+                     generator: Optional[torch.Generator] = None) -> torch.Tensor:
+    """
+    Applies an intervention at every position of every message, all at once. For a message m and a position p:
+    - substitute: m[p] is replaced by a symbol drawn uniformly in [1, vocab_size) (as in dump_test_position)
+    - delete: m[p] is removed, the following symbols are shifted to the left and the message is padded with eos
+    - swap: m[p] is exchanged with the symbol at a position drawn uniformly before the eos of m
+    - truncate: m is cut at p, i.e. m[p] and the following symbols are replaced by eos
+    The random interventions are drawn `n_samples` times, the deterministic ones once.
+
+    :param messages: the [N, T] messages, padded with eos (0)
+    :returns the [N, T, V, T] perturbed messages, with V = n_samples, or 1 for delete and truncate
+
+    >>> messages = torch.tensor([[3, 1, 2, 0]])
+    >>> perturb_messages(messages, 'truncate')[0, :, 0]
+    tensor([[0, 0, 0, 0],
+            [3, 0, 0, 0],
+            [3, 1, 0, 0],
+            [3, 1, 2, 0]])
+    >>> perturb_messages(messages, 'delete')[0, :, 0]
+    tensor([[1, 2, 0, 0],
+            [3, 2, 0, 0],
+            [3, 1, 0, 0],
+            [3, 1, 2, 0]])
+    >>> substituted = perturb_messages(messages, 'substitute', n_samples=5, vocab_size=4)
+    >>> substituted.size(), bool(((substituted != messages).sum(dim=3) <= 1).all())
+    (torch.Size([1, 4, 5, 4]), True)
+    >>> swapped = perturb_messages(messages, 'swap', n_samples=5)
+    >>> bool((swapped[0, :3].sort(dim=2).values == messages.sort(dim=1).values).all())
+    True
+    """
+    if intervention not in INTERVENTIONS:
+        raise ValueError(f"Unknown intervention: {intervention}")
+
+    n_messages, width = messages.size()
+    n_variants = 1 if intervention in DETERMINISTIC_INTERVENTIONS else n_samples
+    device = messages.device
+
+    # [N, p, v, q]: the symbol at position q of the v-th variant of the message perturbed at position p
+    base = messages[:, None, None, :].expand(n_messages, width, n_variants, width)
+    positions = torch.arange(width, device=device)
+    p, q = positions[:, None, None], positions[None, None, :]
+
+    if intervention == 'truncate':
+        return base.masked_fill(q >= p, 0)
+
+    if intervention == 'delete':
+        shifted = torch.cat([messages[:, 1:], torch.zeros_like(messages[:, :1])], dim=1)
+        return torch.where(q >= p, shifted[:, None, None, :], base)
+
+    if intervention == 'substitute':
+        if vocab_size is None:
+            raise ValueError("The substitute intervention needs the vocabulary size")
+        symbols = torch.randint(1, vocab_size, (n_messages, width, n_variants), device=device, generator=generator)
+        return torch.where(q == p, symbols.unsqueeze(3), base)
+
+    # swap with a position before eos, if any
+    n_symbols = (find_lengths(messages) - 1).clamp(min=1)
+    partners = torch.rand(n_messages, width, n_variants, device=device, generator=generator)
+    partners = (partners * n_symbols[:, None, None]).long().clamp(max=width - 1)
+
+    symbols_at_p = messages.gather(1, positions.expand(n_messages, -1))[:, :, None, None]
+    symbols_at_partner = messages.gather(1, partners.view(n_messages, -1)).view(n_messages, width, n_variants, 1)
+    swapped = torch.where(q == p, symbols_at_partner, base)
+    return torch.where(q == partners.unsqueeze(3), symbols_at_p, swapped)
+
+
+def _cut_at_eos(messages):
+    # the symbols after eos are not read by Receiver
+    after_eos = torch.arange(messages.size(1), device=messages.device) >= find_lengths(messages).unsqueeze(1)
+    return messages.masked_fill(after_eos, 0)
+
+
+def _read_receiver(receiver, messages, receiver_input, impatient, n_buckets):
+    lengths = find_lengths(messages)
+    # the prediction of an Impatient Listener is read at eos; RnnReceiverImpatient only computes it there
+    positions = (lengths - 1).unsqueeze(1) if impatient and isinstance(receiver, RnnReceiverImpatient) else None
+    output = _receive(receiver, messages, receiver_input, lengths, n_buckets, per_position=impatient,
+                      positions=positions)[0]
+
+    if impatient and positions is None:
+        positions = (lengths - 1).unsqueeze(1)
+        if hasattr(output, 'materialize'):
+            output = output.with_hidden(output.hidden.gather(1, positions.unsqueeze(2).expand(
+                -1, -1, output.hidden.size(2))))
+        else:
+            output = output[torch.arange(output.size(0), device=output.device).unsqueeze(1), positions]
+    if hasattr(output, 'materialize'):
+        output = output.materialize()
+    if impatient:
+        output = output.squeeze(1)
+
+    return output.argmax(dim=-1)
+
+
+def intervene(game: torch.nn.Module, sender_input: torch.Tensor, intervention: str = 'substitute',
+              n_samples: int = 1, vocab_size: Optional[int] = None, impatient: bool = False,
+              receiver_input: Optional[torch.Tensor] = None, chunk_size: int = 65536, n_buckets: int = 8,
+              device: Optional[torch.device] = None, generator: Optional[torch.Generator] = None):
+    """
+    Counterfactual message interventions: the messages of Sender are computed once and perturbed at every position
+    by perturb_messages, by chunks of (at most) `chunk_size` perturbed messages. Receiver only reads the messages up
+    to their eos, so a perturbed message that is unchanged up to its eos (e.g. a symbol substituted after eos) gets
+    the prediction of the unperturbed message without being fed to Receiver. The other ones are fed in a single
+    call per chunk, in `n_buckets` length buckets (see _receive). This replaces max_len calls of dump_test_position,
+    each of them running both agents on all the inputs.
+
+    The Receiver prediction is the argmax of its output over the last dimension, read at the eos of the perturbed
+    message for an Impatient Listener (`impatient=True`). For inputs with several attributes, there is one
+    prediction per attribute.
+
+    :param game: a Reinforce game, whose agents return (output, log-prob, entropy)
+    :param sender_input: the N inputs of Sender
+    :param intervention: one of INTERVENTIONS, see perturb_messages
+    :param n_samples: the number K of random draws of the intervention at each position
+    :returns the [N, T] messages of Sender, and the [N, T, K] (or [N, T, K, n_attributes]) predictions of Receiver
+        for the message perturbed at each position
+
+    >>> from .reinforce_wrappers import RnnSenderReinforce
+    >>> class Game(torch.nn.Module):
+    ...     def __init__(self):
+    ...         super().__init__()
+    ...         self.sender = RnnSenderReinforce(torch.nn.Linear(6, 8), vocab_size=5, embed_dim=4, hidden_size=8,
+    ...                                          max_len=4, force_eos=True)
+    ...         self.receiver = RnnReceiverImpatient(None, vocab_size=5, embed_dim=4, hidden_size=8, max_len=4,
+    ...                                              n_features=6)
+    >>> game = Game()
+    >>> messages, predictions = intervene(game, torch.eye(6), 'truncate', n_samples=3, impatient=True, chunk_size=7)
+    >>> messages.size(), predictions.size()
+    (torch.Size([6, 4]), torch.Size([6, 4, 3]))
+    >>> output = game.receiver(messages)[0]
+    >>> unperturbed = output[torch.arange(6), find_lengths(messages) - 1].argmax(dim=1)
+    >>> torch.equal(predictions[:, -1, 0], unperturbed)  # with force_eos, the last symbol is always eos
+    True
+    """
+    train_state = game.training
+    game.eval()
+
+    device = device if device is not None else sender_input.device
+    sender_input = move_to(sender_input, device)
+    receiver_input = move_to(receiver_input, device)
+
+    with torch.no_grad():
+        messages = game.sender(sender_input)
+        if isinstance(messages, tuple):
+            messages = messages[0]
+        n_messages, width = messages.size()
+        n_variants = 1 if intervention in DETERMINISTIC_INTERVENTIONS else n_samples
+
+        unperturbed = _read_receiver(game.receiver, messages, receiver_input, impatient, n_buckets)
+        read = _cut_at_eos(messages)
+
+        # perturbing chunks of messages bounds the memory used by the [n, T, V, T] perturbed messages
+        rows_per_chunk = max(1, chunk_size // (width * n_variants))
+        predictions = []
+        for start in range(0, n_messages, rows_per_chunk):
+            rows = torch.arange(start, min(start + rows_per_chunk, n_messages), device=device)
+            perturbed = perturb_messages(messages[rows], intervention, n_samples, vocab_size, generator)
+            perturbed = perturbed.reshape(-1, width)
+            rows = rows.repeat_interleave(width * n_variants)
+
+            chunk_predictions = unperturbed[rows]
+            changed = (_cut_at_eos(perturbed) != read[rows]).any(dim=1).nonzero().squeeze(1)
+            if changed.numel() > 0:
+                changed_input = receiver_input[rows[changed]] if receiver_input is not None else None
+                chunk_predictions[changed] = _read_receiver(game.receiver, perturbed[changed], changed_input,
+                                                            impatient, n_buckets)
+
+            predictions.append(chunk_predictions.view(-1, width, n_variants, *chunk_predictions.size()[1:]))
+
+        predictions = torch.cat(predictions)
+        if n_variants < n_samples:
+            predictions = predictions.expand(-1, -1, n_samples, *predictions.size()[3:])
+
+    game.train(mode=train_state)
+    return messages, predictions
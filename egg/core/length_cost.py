@@ -0,0 +1,61 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+
+class LengthCostScheduler:
+    """
+    A base class for the regularization scheduling of the length cost (Lazy Speaker). A scheduler is called once per
+    batch with the batch accuracy (a 0-dim tensor, averaged on device) and the current length cost, and returns the
+    new length cost. It only applies tensor operations, so that no host-device synchronisation is needed.
+    """
+    def __call__(self, accuracy: torch.Tensor, length_cost) -> torch.Tensor:
+        raise NotImplementedError()
+
+
+class PowerLengthCost(LengthCostScheduler):
+    """
+    length_cost = accuracy ** exponent / scale: the cost stays negligible until the game is almost solved.
+    The default values are the ones used for n_features=100.
+
+    >>> PowerLengthCost()(torch.tensor(1.), 0.)
+    tensor(0.2000)
+    >>> PowerLengthCost()(torch.tensor(0.5), 0.) < 1e-10
+    tensor(True)
+    """
+    def __init__(self, exponent: float = 45, scale: float = 5.) -> None:
+        self.exponent = exponent
+        self.scale = scale
+
+    def __call__(self, accuracy, length_cost):
+        return accuracy ** self.exponent / self.scale
+
+
+class StepLengthCost(LengthCostScheduler):
+    """
+    Incremental schedule: the length cost grows by `step` at each batch where the accuracy is above `upper` and is
+    reset to zero when the accuracy falls between `lower` and `upper`.
+
+    >>> scheduler = StepLengthCost()
+    >>> cost = scheduler(torch.tensor(1.), 0.)
+    >>> cost = scheduler(torch.tensor(1.), cost)
+    >>> cost
+    tensor(0.0200)
+    >>> scheduler(torch.tensor(0.95), cost)
+    tensor(0.)
+    >>> scheduler(torch.tensor(0.5), cost)
+    tensor(0.0200)
+    """
+    def __init__(self, step: float = 0.01, lower: float = 0.9, upper: float = 0.99) -> None:
+        self.step = step
+        self.lower = lower
+        self.upper = upper
+
+    def __call__(self, accuracy, length_cost):
+        length_cost = torch.as_tensor(length_cost, dtype=accuracy.dtype, device=accuracy.device)
+        length_cost = torch.where((accuracy > self.lower) & (accuracy < self.upper),
+                                  torch.zeros_like(length_cost), length_cost)
+        return torch.where(accuracy > self.upper, length_cost + self.step, length_cost)
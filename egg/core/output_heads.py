@@ -0,0 +1,337 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.distributions import Categorical
+from torch.utils.checkpoint import checkpoint
+
+OUTPUT_HEADS = ['dense', 'adaptive', 'sampled']
+
+
+def _impatient_log_prob_entropy(log_probs, sample, with_log_prob):
+    """
+    Computes the entropy of the categorical distributions given by `log_probs` along the last dimension and,
+    if `with_log_prob` is set, the log-probability of a symbol that is either sampled (`sample=True`) or the argmax.
+    Otherwise, zero log-probabilities are returned.
+    """
+    # as in Categorical.entropy, guards against 0 * -inf
+    entropy = -(log_probs.exp() * log_probs.clamp(min=torch.finfo(log_probs.dtype).min)).sum(dim=-1)
+
+    if not with_log_prob:
+        return torch.zeros_like(entropy), entropy
+
+    if sample:
+        symbols = Categorical(logits=log_probs).sample()
+    else:
+        symbols = log_probs.argmax(dim=-1)
+    log_prob = log_probs.gather(-1, symbols.unsqueeze(-1)).squeeze(-1)
+
+    return log_prob, entropy
+
+
+def frequency_cutoffs(probs, masses=(0.8, 0.95)):
+    """
+    Splits the inputs, ranked by decreasing frequency, into the clusters of an adaptive softmax: the k-th cutoff is
+    the number of most frequent inputs that cover `masses[k]` of the probability mass of `probs`. Empty clusters are
+    dropped.
+
+    >>> probs = 1 / np.arange(1, 101)
+    >>> frequency_cutoffs(probs / probs.sum())
+    [36, 78]
+    >>> frequency_cutoffs(np.ones(10) / 10, masses=(0.5, 0.55, 1.))
+    [5, 6]
+    """
+    cumulated = np.cumsum(np.sort(np.asarray(probs, dtype=np.float64))[::-1])
+    cumulated /= cumulated[-1]
+
+    cutoffs = []
+    for mass in masses:
+        cutoff = int(np.searchsorted(cumulated, mass - 1e-9)) + 1
+        if cutoff < len(cumulated) and (not cutoffs or cutoff > cutoffs[-1]):
+            cutoffs.append(cutoff)
+    return cutoffs
+
+
+class OutputHead(nn.Module):
+    """
+    Output layer of an Impatient Listener, mapping hidden states to distributions over the `n_features` inputs.
+    `log_probs` always returns the exact, full log-probabilities (evaluation, dumps); the per-position reductions
+    used in training, `log_prob_entropy` and `cross_entropy_accuracy`, can be approximated by the subclasses. They
+    take [N, H] hidden states and return [N] tensors.
+    """
+    # dense heads can be applied to the [B, T, H] hidden states at once, the others go through ImpatientLogits
+    dense = False
+
+    def log_probs(self, hidden):
+        raise NotImplementedError
+
+    def log_prob_entropy(self, hidden, sample, with_log_prob):
+        return _impatient_log_prob_entropy(self.log_probs(hidden), sample, with_log_prob)
+
+    def cross_entropy_accuracy(self, hidden, target):
+        log_probs = self.log_probs(hidden)
+        cross_entropy = -log_probs.gather(1, target.unsqueeze(1)).squeeze(1)
+        accuracy = (log_probs.argmax(dim=1) == target).float()
+        return cross_entropy, accuracy
+
+
+class DenseHead(nn.Linear, OutputHead):
+    """
+    The Linear layer followed by a softmax over all the inputs: the parameters are named as those of nn.Linear.
+
+    >>> head = DenseHead(4, 6)
+    >>> hidden = torch.randn(5, 4)
+    >>> torch.allclose(head.log_probs(hidden), F.log_softmax(head(hidden), dim=-1))
+    True
+    """
+    dense = True
+
+    @property
+    def n_features(self):
+        return self.out_features
+
+    def log_probs(self, hidden):
+        # [..., H] -> [..., n_features]
+        return F.log_softmax(self(hidden).float(), dim=-1)
+
+
+class SampledSoftmaxHead(DenseHead):
+    """
+    A DenseHead trained with a sampled softmax: in training mode, the cross-entropy of each row is computed over
+    its target and `n_samples` negatives drawn from `probs` (shared by the rows of a chunk), with the logits corrected
+    by the log expected counts of the candidates (Jean et al., 2015). Negatives equal to the target are masked. The
+    entropy is the self-normalised importance sampling estimate computed over the same negatives, unless the
+    log-probability of a sampled symbol is needed. The accuracy is exact (argmax over all the inputs, without
+    gradient). In evaluation mode, the head is a DenseHead, with which it shares its parameters and state dict.
+
+    >>> probs = np.array([0.5, 0.2, 0.2, 0.1])
+    >>> head = SampledSoftmaxHead(3, probs, n_samples=2)
+    >>> hidden, target = torch.randn(5, 3), torch.tensor([0, 1, 2, 3, 0])
+    >>> loss, acc = head.cross_entropy_accuracy(hidden, target)
+    >>> loss.size(), bool((loss >= 0).all())
+    (torch.Size([5]), True)
+    >>> torch.equal(acc, (head.log_probs(hidden).argmax(dim=1) == target).float())
+    True
+    >>> _ = head.eval()
+    >>> loss, _ = head.cross_entropy_accuracy(hidden, target)
+    >>> torch.allclose(loss, F.cross_entropy(head(hidden), target, reduction='none'))
+    True
+    """
+    dense = False
+
+    def __init__(self, hidden_size, probs, n_samples=1024):
+        super(SampledSoftmaxHead, self).__init__(hidden_size, len(probs))
+        self.n_samples = n_samples
+        proposal = torch.as_tensor(np.asarray(probs, dtype=np.float32))
+        self.register_buffer('proposal', proposal / proposal.sum(), persistent=False)
+        # log of the expected number of occurrences of each input among the negatives
+        self.register_buffer('log_expected_count', torch.log(self.proposal * n_samples), persistent=False)
+
+    def _sample_logits(self, hidden):
+        negatives = torch.multinomial(self.proposal, self.n_samples, replacement=True)
+        logits = F.linear(hidden, self.weight[negatives], self.bias[negatives]).float()
+        return negatives, logits - self.log_expected_count[negatives]
+
+    def log_prob_entropy(self, hidden, sample, with_log_prob):
+        if not self.training or with_log_prob:
+            return super(SampledSoftmaxHead, self).log_prob_entropy(hidden, sample, with_log_prob)
+
+        negatives, logits = self._sample_logits(hidden)
+        # importance weights of the negatives, and log-partition estimated from them
+        weights = F.softmax(logits, dim=1)
+        log_partition = torch.logsumexp(logits, dim=1, keepdim=True)
+        log_probs = logits + self.log_expected_count[negatives] - log_partition
+        entropy = -(weights * log_probs).sum(dim=1)
+        return torch.zeros_like(entropy), entropy
+
+    def cross_entropy_accuracy(self, hidden, target):
+        if not self.training:
+            return super(SampledSoftmaxHead, self).cross_entropy_accuracy(hidden, target)
+
+        negatives, logits = self._sample_logits(hidden)
+        logits = logits.masked_fill(negatives.unsqueeze(0) == target.unsqueeze(1), float('-inf'))
+        target_logits = (hidden * self.weight[target]).sum(dim=1) + self.bias[target]
+        target_logits = target_logits.float() - self.log_expected_count[target]
+
+        logits = torch.cat([target_logits.unsqueeze(1), logits], dim=1)
+        cross_entropy = torch.logsumexp(logits, dim=1) - target_logits
+
+        with torch.no_grad():
+            accuracy = (self(hidden).argmax(dim=1) == target).float()
+        return cross_entropy, accuracy
+
+
+class AdaptiveSoftmaxHead(OutputHead):
+    """
+    Adaptive softmax (Grave et al., 2017) over the inputs ranked by decreasing `probs`: the most frequent inputs and
+    one token per cluster of less frequent inputs are scored by the head, and the clusters by lower-dimensional
+    projections (divided by `div_value` from a cluster to the next one). The clusters are given by `cutoffs` which,
+    by default, are derived from `probs` by frequency_cutoffs. The log-probabilities and the accuracy are exact.
+
+    >>> probs = 1 / np.arange(1, 21)
+    >>> head = AdaptiveSoftmaxHead(16, probs / probs.sum())
+    >>> head.adaptive.cutoffs
+    [10, 17, 20]
+    >>> hidden, target = torch.randn(5, 16), torch.tensor([0, 3, 9, 17, 19])
+    >>> log_probs = head.log_probs(hidden)
+    >>> log_probs.size(), torch.allclose(log_probs.exp().sum(dim=1), torch.ones(5))
+    (torch.Size([5, 20]), True)
+    >>> loss, acc = head.cross_entropy_accuracy(hidden, target)
+    >>> torch.allclose(loss, F.nll_loss(log_probs, target, reduction='none'))
+    True
+    >>> _, entropy = head.log_prob_entropy(hidden, sample=False, with_log_prob=False)
+    >>> torch.allclose(entropy, -(log_probs.exp() * log_probs).sum(dim=1))
+    True
+    >>> torch.equal(acc, (log_probs.argmax(dim=1) == target).float())
+    True
+    """
+    def __init__(self, hidden_size, probs, cutoffs=None, div_value=4.):
+        super(AdaptiveSoftmaxHead, self).__init__()
+        probs = np.asarray(probs, dtype=np.float64)
+        self.n_features = len(probs)
+        if cutoffs is None:
+            cutoffs = frequency_cutoffs(probs)
+
+        # rank of each input by decreasing frequency
+        order = np.argsort(-probs, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.register_buffer('rank', torch.from_numpy(rank), persistent=False)
+
+        self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(hidden_size, self.n_features, list(cutoffs),
+                                                      div_value=div_value)
+
+    def log_probs(self, hidden):
+        # [..., H] -> [..., n_features], columns by input id
+        rows = hidden.reshape(-1, hidden.size(-1))
+        log_probs = self.adaptive.log_prob(rows).float().index_select(1, self.rank)
+        return log_probs.view(*hidden.size()[:-1], self.n_features)
+
+    def log_prob_entropy(self, hidden, sample, with_log_prob):
+        if with_log_prob:
+            return super(AdaptiveSoftmaxHead, self).log_prob_entropy(hidden, sample, with_log_prob)
+
+        # H = H(head) + sum_c P(c) H(cluster c), without assembling the full distribution
+        head_log_probs = F.log_softmax(self.adaptive.head(hidden).float(), dim=1)
+        _, entropy = _impatient_log_prob_entropy(head_log_probs, False, False)
+        for i, tail in enumerate(self.adaptive.tail):
+            _, tail_entropy = _impatient_log_prob_entropy(F.log_softmax(tail(hidden).float(), dim=1), False, False)
+            entropy = entropy + head_log_probs[:, self.adaptive.shortlist_size + i].exp() * tail_entropy
+        return torch.zeros_like(entropy), entropy
+
+    def cross_entropy_accuracy(self, hidden, target):
+        rank = self.rank[target]
+        cross_entropy = -self.adaptive(hidden, rank).output.float()
+        with torch.no_grad():
+            accuracy = (self.adaptive.predict(hidden) == rank).float()
+        return cross_entropy, accuracy
+
+
+def build_output_head(head, hidden_size, n_features, probs=None, n_samples=1024, masses=(0.8, 0.95)):
+    """
+    Builds the output head named `head` (one of OUTPUT_HEADS). The adaptive and sampled heads need the input
+    distribution `probs`, as passed to the training loader. For 'dense', None is returned: Receiver then builds its
+    default DenseHead itself, and its initialisation is unchanged. The adaptive head falls back to the dense one when
+    the inputs are too few to be split into clusters.
+
+    >>> build_output_head('adaptive', 8, 2, probs=np.array([2 / 3, 1 / 3])) is None
+    True
+    >>> build_output_head('adaptive', 8, 100, probs=np.ones(100) / 100).adaptive.cutoffs
+    [80, 95, 100]
+    """
+    if head not in OUTPUT_HEADS:
+        raise ValueError(f"Unknown output head: {head}")
+    if head == 'dense':
+        return None
+
+    if probs is None or len(probs) != n_features:
+        raise ValueError(f"The {head} output head needs the probabilities of the {n_features} inputs")
+    if head == 'adaptive':
+        cutoffs = frequency_cutoffs(probs, masses)
+        if not cutoffs:
+            return None
+        return AdaptiveSoftmaxHead(hidden_size, probs, cutoffs=cutoffs)
+    return SampledSoftmaxHead(hidden_size, probs, n_samples=n_samples)
+
+
+class ImpatientLogits:
+    """
+    Stands for the [B, T, n_features] log-probabilities of an Impatient Listener without materialising them: it keeps
+    the [B, T, H] hidden states and the OutputHead mapping them to log-probabilities. Only per-position reductions are
+    computed (entropy, cross-entropy, accuracy), with the head's own (possibly approximate) methods. With
+    `chunk_size` > 0, they are applied by chunks of `chunk_size` (message, position) pairs, and each chunk is
+    checkpointed: its log-probabilities are recomputed in the backward pass instead of being stored. The memory used
+    by the output layer is hence O(chunk_size * n_features).
+
+    >>> hidden = torch.randn(2, 3, 4)
+    >>> head = DenseHead(4, 5)
+    >>> chunked = ImpatientLogits(hidden, head, chunk_size=4)
+    >>> chunked.size()
+    torch.Size([2, 3, 5])
+    >>> loss, acc = chunked.cross_entropy_accuracy(torch.tensor([1, 4]))
+    >>> full = head.log_probs(hidden)
+    >>> torch.allclose(loss, -full[:, :, [1, 4]].diagonal(dim1=0, dim2=2).t())
+    True
+    >>> torch.equal(acc, (full.argmax(dim=2) == torch.tensor([[1], [4]])).float())
+    True
+    >>> torch.equal(chunked.predictions(), full.argmax(dim=2))
+    True
+    """
+    def __init__(self, hidden, head, chunk_size=0):
+        self.hidden = hidden
+        self.head = head
+        self.chunk_size = chunk_size
+
+    def size(self, dim=None):
+        size = torch.Size((self.hidden.size(0), self.hidden.size(1), self.head.n_features))
+        return size if dim is None else size[dim]
+
+    def with_hidden(self, hidden):
+        return ImpatientLogits(hidden, self.head, self.chunk_size)
+
+    def materialize(self):
+        return self.head.log_probs(self.hidden)
+
+    def log_prob_entropy(self, sample, with_log_prob):
+        """
+        Chunked _impatient_log_prob_entropy: returns the [B, T] log-probabilities of the sampled (or argmax) symbols
+        and entropies.
+        """
+        return self._reduce(lambda hidden: self.head.log_prob_entropy(hidden, sample, with_log_prob))
+
+    def cross_entropy_accuracy(self, target):
+        """
+        :param target: the [B] ids of the inputs
+        :returns the [B, T] cross-entropies of the predictions at every position, and their [B, T] accuracies
+        """
+        target = target.unsqueeze(1).expand(-1, self.hidden.size(1))
+        return self._reduce(self.head.cross_entropy_accuracy, target)
+
+    def predictions(self):
+        """
+        :returns the [B, T] argmax of the log-probabilities at every position
+        """
+        return self._reduce(lambda hidden: (self.head.log_probs(hidden).argmax(dim=1),))[0]
+
+    def _reduce(self, reduce, *per_position):
+        batch_size, n_positions = self.hidden.size(0), self.hidden.size(1)
+        rows = [self.hidden.reshape(batch_size * n_positions, -1)] + \
+               [x.reshape(batch_size * n_positions) for x in per_position]
+
+        if self.chunk_size <= 0:
+            outputs = [reduce(*rows)]
+        else:
+            outputs = []
+            for start in range(0, rows[0].size(0), self.chunk_size):
+                chunk = [x[start:start + self.chunk_size] for x in rows]
+                if torch.is_grad_enabled():
+                    outputs.append(checkpoint(reduce, *chunk, use_reentrant=False))
+                else:
+                    outputs.append(reduce(*chunk))
+
+        return tuple(torch.cat(parts).view(batch_size, n_positions) for parts in zip(*outputs))
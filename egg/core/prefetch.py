@@ -0,0 +1,118 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import queue
+import threading
+from typing import Any, Iterable, Optional
+
+import torch
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, exception: BaseException) -> None:
+        self.exception = exception
+
+
+def _pin_and_move(x: Any, device: Optional[torch.device], pin_memory: bool) -> Any:
+    """
+    Same as util.move_to, but pins the CPU tensors first so that the host-to-device copy can be asynchronous.
+    """
+    if torch.is_tensor(x):
+        if pin_memory and x.device.type == 'cpu':
+            x = x.pin_memory()
+        return x if device is None else x.to(device, non_blocking=pin_memory)
+    if isinstance(x, list) or isinstance(x, tuple):
+        return [_pin_and_move(i, device, pin_memory) for i in x]
+    if isinstance(x, dict):
+        return {k: _pin_and_move(v, device, pin_memory) for k, v in x.items()}
+    return x
+
+
+class _PrefetchIterator:
+    def __init__(self, iterator, n_batches, device, pin_memory):
+        self.iterator = iterator
+        self.device = device
+        self.pin_memory = pin_memory
+
+        self.queue = queue.Queue(maxsize=n_batches)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _produce(self):
+        try:
+            for batch in self.iterator:
+                if self.stop.is_set():
+                    return
+                self._put(_pin_and_move(batch, self.device, self.pin_memory))
+            self._put(_END)
+        except Exception as e:
+            self._put(_Failure(e))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.queue.get()
+        if item is _END:
+            self.stop.set()
+            raise StopIteration()
+        if isinstance(item, _Failure):
+            self.stop.set()
+            raise item.exception
+        return item
+
+    def close(self):
+        self.stop.set()
+
+    def __del__(self):
+        self.close()
+
+
+class PrefetchLoader:
+    """
+    Wraps a loader so that its next `n_batches` batches are generated on a background thread while the current one
+    is being used. The batches are handed over already moved to `device` (with pinned memory when it is a CUDA
+    device, so that the copy overlaps with the computation).
+
+    The wrapped loader's iterator is created in the calling thread and consumed sequentially, hence the batches and
+    their order are the same as without prefetching for a given seed.
+
+    >>> loader = PrefetchLoader([(torch.ones(2), i) for i in range(5)], n_batches=2)
+    >>> [y for _, y in loader]
+    [0, 1, 2, 3, 4]
+    >>> [y for _, y in loader]
+    [0, 1, 2, 3, 4]
+    """
+    def __init__(self, loader: Iterable, n_batches: int, device: Optional[torch.device] = None,
+                 pin_memory: Optional[bool] = None) -> None:
+        """
+        :param loader: the loader to be wrapped (any iterable of batches)
+        :param n_batches: the number of batches generated ahead
+        :param device: device the batches are moved to (default: None, batches are not moved)
+        :param pin_memory: whether CPU tensors are pinned before being moved (default: True iff device is CUDA)
+        """
+        assert n_batches > 0, 'At least one batch has to be prefetched'
+        self.loader = loader
+        self.n_batches = n_batches
+        self.device = torch.device(device) if device is not None else None
+        if pin_memory is None:
+            pin_memory = self.device is not None and self.device.type == 'cuda'
+        self.pin_memory = pin_memory
+
+    def __iter__(self):
+        # any seed drawn by the wrapped loader comes from the global RNGs of the calling thread
+        iterator = iter(self.loader)
+        return _PrefetchIterator(iterator, self.n_batches, self.device, self.pin_memory)
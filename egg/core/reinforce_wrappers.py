@@ -14,7 +14,9 @@ import numpy as np
 
 from .transformer import TransformerEncoder, TransformerDecoder
 from .rnn import RnnEncoder, RnnEncoderImpatient
-from .util import find_lengths
+from .output_heads import DenseHead, AdaptiveSoftmaxHead, ImpatientLogits, _impatient_log_prob_entropy
+from .util import find_lengths, stratified_positions
+from .length_cost import PowerLengthCost, StepLengthCost
 
 
 class ReinforceWrapper(nn.Module):
@@ -118,19 +120,19 @@ class SymbolGameReinforce(nn.Module):
 
         if self.training:
             self.n_points += 1.0
-            self.mean_baseline += (loss.detach().mean().item() -
+            self.mean_baseline += (loss.detach().mean() -
                                    self.mean_baseline) / self.n_points
 
         full_loss = policy_loss + entropy_loss + loss.mean()
 
         for k, v in rest_info.items():
             if hasattr(v, 'mean'):
-                rest_info[k] = v.mean().item()
+                rest_info[k] = v.mean().detach()
 
         rest_info['baseline'] = self.mean_baseline
-        rest_info['loss'] = loss.mean().item()
-        rest_info['sender_entropy'] = sender_entropy.mean()
-        rest_info['receiver_entropy'] = receiver_entropy.mean()
+        rest_info['loss'] = loss.mean().detach()
+        rest_info['sender_entropy'] = sender_entropy.mean().detach()
+        rest_info['receiver_entropy'] = receiver_entropy.mean().detach()
 
         return full_loss, rest_info
 
@@ -152,8 +154,17 @@ class RnnSenderReinforce(nn.Module):
     1
     >>> message.size()  # batch size x max_len
     torch.Size([16, 10])
+    >>> _ = agent.eval()
+    >>> message, _, _ = agent(input)
+    >>> agent.early_exit = True  # the unrolling stops once every message has ended, with the same lengths
+    >>> early_message, _, _ = agent(input)
+    >>> early_message.size()
+    torch.Size([16, 10])
+    >>> torch.equal(find_lengths(early_message), find_lengths(message))
+    True
     """
-    def __init__(self, agent, vocab_size, embed_dim, hidden_size, max_len, num_layers=1, cell='rnn', force_eos=True):
+    def __init__(self, agent, vocab_size, embed_dim, hidden_size, max_len, num_layers=1, cell='rnn', force_eos=True,
+                 early_exit=False):
         """
         :param agent: the agent to be wrapped
         :param vocab_size: the communication vocabulary size
@@ -163,11 +174,16 @@ class RnnSenderReinforce(nn.Module):
         :param cell: type of the cell used (rnn, gru, lstm)
         :param force_eos: if set to True, each message is extended by an EOS symbol. To ensure that no message goes
         beyond `max_len`, Sender only generates `max_len - 1` symbols from an RNN cell and appends EOS.
+        :param early_exit: if set to True, the unrolling stops as soon as every message of the batch contains EOS; the
+        remaining positions are filled with EOS, with zero log-prob and entropy. The output shapes are unchanged.
         """
         super(RnnSenderReinforce, self).__init__()
         self.agent = agent
 
         self.force_eos = force_eos
+        self.early_exit = early_exit
+        # training-time unrolling horizon, set by the game from an AdaptiveMaxLen controller (None: max_len)
+        self.horizon = None
 
         self.max_len = max_len
         if force_eos:
@@ -203,15 +219,25 @@ class RnnSenderReinforce(nn.Module):
 
         prev_c = [torch.zeros_like(prev_hidden[0]) for _ in range(self.num_layers)]  # only used for LSTM
 
-        input = torch.stack([self.sos_embedding] * x.size(0))
+        input = self.sos_embedding.expand(x.size(0), -1)
 
-        sequence = []
-        logits = []
-        entropy = []
+        max_len = self.max_len
+        if self.training and self.horizon is not None:
+            max_len = min(self.horizon, self.max_len)
 
-        for step in range(self.max_len):
+        # the outputs are written in place; the positions that are not generated (early exit, horizon, force_eos)
+        # keep the EOS symbol with zero log-prob and entropy
+        width = self.max_len + 1 if self.force_eos else self.max_len
+        sequence = torch.zeros((x.size(0), width), dtype=torch.long, device=input.device)
+        logits = input.new_zeros((x.size(0), width))
+        entropy = input.new_zeros((x.size(0), width))
+
+        eosed = torch.zeros(x.size(0), dtype=torch.bool, device=input.device)
+        is_lstm = isinstance(self.cells[0], nn.LSTMCell)
+
+        for step in range(max_len):
             for i, layer in enumerate(self.cells):
-                if isinstance(layer, nn.LSTMCell):
+                if is_lstm:
                     h_t, c_t = layer(input, (prev_hidden[i], prev_c[i]))
                     prev_c[i] = c_t
                 else:
@@ -219,38 +245,54 @@ class RnnSenderReinforce(nn.Module):
                 prev_hidden[i] = h_t
                 input = h_t
 
-
-            step_logits = F.log_softmax(self.hidden_to_output(h_t), dim=1)
+            step_logits = F.log_softmax(self.hidden_to_output(h_t).float(), dim=1)
             # ATTENTION ENLEVER LAJOUT
             #if step==0:
             #    step_logits = F.log_softmax(self.hidden_to_output(h_t), dim=1)-1000*torch.cat((torch.zeros((h_t.size(0),1)),torch.ones((h_t.size(0),int(self.vocab_size/2))),torch.zeros((h_t.size(0),int(self.vocab_size/2)))),dim=1).to("cuda")
             #else:
             #    step_logits = F.log_softmax(self.hidden_to_output(h_t), dim=1)-1000*torch.cat((torch.zeros((h_t.size(0),1)),torch.zeros((h_t.size(0),int(self.vocab_size/2))),torch.ones((h_t.size(0),int(self.vocab_size/2)))),dim=1).to("cuda")
-            distr = Categorical(logits=step_logits)
-            entropy.append(distr.entropy())
-
-            if self.training:
-                x = distr.sample()
-            else:
-                x = step_logits.argmax(dim=1)
+            x, step_log_prob, step_entropy = _sample_symbols(step_logits, self.training)
 
-            logits.append(distr.log_prob(x))
+            sequence[:, step] = x
+            logits[:, step] = step_log_prob
+            entropy[:, step] = step_entropy
 
             input = self.embedding(x)
-            sequence.append(x)
 
-        sequence = torch.stack(sequence).permute(1, 0)
-        logits = torch.stack(logits).permute(1, 0)
-        entropy = torch.stack(entropy).permute(1, 0)
+            if self.early_exit:
+                eosed = eosed | (x == 0)
+                if eosed.all():
+                    break
 
-        if self.force_eos:
-            zeros = torch.zeros((sequence.size(0), 1)).to(sequence.device)
+        return sequence, logits, entropy
 
-            sequence = torch.cat([sequence, zeros.long()], dim=1)
-            logits = torch.cat([logits, zeros], dim=1)
-            entropy = torch.cat([entropy, zeros], dim=1)
 
-        return sequence, logits, entropy
+def _sample_symbols(log_probs, sample):
+    """
+    Draws a symbol from each row of the normalised `log_probs` (the argmax if `sample` is False) and returns it with
+    its log-probability and the entropy of the row, as Categorical(logits=log_probs) would, without building the
+    distribution. The same random numbers are consumed, so that the samples are the same for a given seed.
+
+    >>> log_probs = F.log_softmax(torch.randn(64, 5), dim=1)
+    >>> _ = torch.manual_seed(0)
+    >>> symbols, log_prob, entropy = _sample_symbols(log_probs, sample=True)
+    >>> _ = torch.manual_seed(0)
+    >>> distr = Categorical(logits=log_probs)
+    >>> torch.equal(symbols, distr.sample())
+    True
+    >>> torch.allclose(log_prob, distr.log_prob(symbols)) and torch.allclose(entropy, distr.entropy())
+    True
+    """
+    probs = log_probs.exp()
+    entropy = -(log_probs.clamp(min=torch.finfo(log_probs.dtype).min) * probs).sum(dim=1)
+
+    if sample:
+        symbols = torch.multinomial(probs, 1, True).squeeze(1)
+    else:
+        symbols = log_probs.argmax(dim=1)
+    log_prob = log_probs.gather(1, symbols.unsqueeze(1)).squeeze(1)
+
+    return symbols, log_prob, entropy
 
 
 class RnnReceiverReinforce(nn.Module):
@@ -287,7 +329,7 @@ class RnnReceiverCompositionality(nn.Module):
 
     def forward(self, message, input=None, lengths=None):
         encoded = self.encoder(message)
-        logits = F.log_softmax(self.hidden_to_output(encoded).reshape(encoded.size(0),self.n_attributes,self.n_values), dim=2)
+        logits = F.log_softmax(self.hidden_to_output(encoded).reshape(encoded.size(0),self.n_attributes,self.n_values).float(), dim=2)
         #entropy=-torch.exp(logits)*logits
         entropy=[]
         slogits= []
@@ -349,40 +391,66 @@ class RnnReceiverImpatient(nn.Module):
     The wrapper logic feeds the message into the cell and calls the wrapped agent.
     The wrapped agent has to returns the intermediate hidden states for every position.
     All the hidden states are mapped to a categorical distribution with a single
-    Linear layer (hidden_to_ouput) followed by a softmax.
+    Linear layer (hidden_to_ouput) followed by a softmax, applied to all the positions at once.
     Thess categorical probabilities (step_logits) will then be used to compute the Impatient loss function.
+
+    The Impatient loss is differentiable, hence the per-position predictions are not sampled by default and the
+    returned log-probabilities are zeros. With `sample=True`, a symbol is sampled at each position during training
+    (argmax at evaluation time) and its log-probability is returned.
+
+    With `chunk_size` > 0, the [B, T, n_features] log-probabilities are not materialised: the output is an
+    ImpatientLogits, evaluated by chunks of `chunk_size` (message, position) pairs, which loss_impatient consumes
+    directly. The output layer is a DenseHead by default; another OutputHead (e.g. an AdaptiveSoftmaxHead or a
+    SampledSoftmaxHead) can be passed as `output_head`, in which case the output is always an ImpatientLogits, so
+    that the head computes the loss and the entropy its own way.
+
+    If the [B, K] reading `positions` are given, the output layer is only applied at these positions: the outputs
+    are [B, K] (resp. [B, K, n_features]) instead of [B, T] (resp. [B, T, n_features]).
+
+    >>> receiver = RnnReceiverImpatient(None, vocab_size=5, embed_dim=4, hidden_size=8, max_len=6, n_features=3)
+    >>> message = torch.tensor([[1, 2, 0, 0, 0, 0], [3, 4, 1, 2, 0, 0]])
+    >>> output, log_prob, entropy = receiver(message)
+    >>> output.size(), log_prob.size(), entropy.size()  # one prediction per position of the messages
+    (torch.Size([2, 6, 3]), torch.Size([2, 6]), torch.Size([2, 6]))
+    >>> (log_prob == 0).all().item()
+    True
+    >>> receiver.chunk_size = 5
+    >>> chunked, _, chunked_entropy = receiver(message)
+    >>> chunked.size(), torch.allclose(chunked.materialize(), output), torch.allclose(chunked_entropy, entropy)
+    (torch.Size([2, 6, 3]), True, True)
+    >>> probs = np.array([0.6, 0.3, 0.1])
+    >>> receiver = RnnReceiverImpatient(None, vocab_size=5, embed_dim=4, hidden_size=8, max_len=6, n_features=3,
+    ...                                 output_head=AdaptiveSoftmaxHead(8, probs, cutoffs=[1]))
+    >>> output = receiver(message)[0]
+    >>> output.size(), torch.allclose(output.materialize().exp().sum(dim=2), torch.ones(2, 6))
+    (torch.Size([2, 6, 3]), True)
+    >>> at_positions = receiver(message, positions=torch.tensor([[0, 2], [3, 5]]))[0]
+    >>> torch.allclose(at_positions.materialize(), output.materialize()[[[0], [1]], [[0, 2], [3, 5]]])
+    True
     """
 
-    def __init__(self, agent, vocab_size, embed_dim, hidden_size,max_len,n_features, cell='rnn', num_layers=1):
+    def __init__(self, agent, vocab_size, embed_dim, hidden_size,max_len,n_features, cell='rnn', num_layers=1,
+                 sample=False, chunk_size=0, output_head=None):
         super(RnnReceiverImpatient, self).__init__()
 
         self.max_len = max_len
-        self.hidden_to_output = nn.Linear(hidden_size, n_features)
+        self.sample = sample
+        self.chunk_size = chunk_size
+        self.hidden_to_output = output_head if output_head is not None else DenseHead(hidden_size, n_features)
         self.encoder = RnnEncoderImpatient(vocab_size, embed_dim, hidden_size, cell, num_layers)
 
-    def forward(self, message, input=None, lengths=None):
-        encoded = self.encoder(message)
-
-        sequence = []
-        logits = []
-        entropy = []
-
-        for step in range(encoded.size(0)):
-            h_t=encoded[step,:,:]
-            step_logits = F.log_softmax(self.hidden_to_output(h_t), dim=1)
-            distr = Categorical(logits=step_logits)
-            entropy.append(distr.entropy())
-
-            if self.training:
-                x = distr.sample() # Sampling useless ?
-            else:
-                x = step_logits.argmax(dim=1)
-            logits.append(distr.log_prob(x))
-            sequence.append(step_logits)
+    def forward(self, message, input=None, lengths=None, positions=None):
+        # [T, B, H] -> [B, T, H]
+        encoded = self.encoder(message).transpose(0, 1)
+        if positions is not None:
+            encoded = encoded.gather(1, positions.unsqueeze(2).expand(-1, -1, encoded.size(2)))
 
-        sequence = torch.stack(sequence).permute(1, 0, 2)
-        logits = torch.stack(logits).permute(1, 0)
-        entropy = torch.stack(entropy).permute(1, 0)
+        if self.chunk_size > 0 or not self.hidden_to_output.dense:
+            sequence = ImpatientLogits(encoded, self.hidden_to_output, self.chunk_size)
+            logits, entropy = sequence.log_prob_entropy(self.sample and self.training, self.sample)
+        else:
+            sequence = self.hidden_to_output.log_probs(encoded)
+            logits, entropy = _impatient_log_prob_entropy(sequence, self.sample and self.training, self.sample)
 
         return sequence, logits, entropy
 
@@ -392,56 +460,33 @@ class RnnReceiverImpatientCompositionality(nn.Module):
     RnnReceiverImpatientCompositionality is an adaptation of RnnReceiverImpatientCompositionality
     for inputs with several attributes (compositionality experiments).
     Each attribute is treated independently.
+    As for RnnReceiverImpatient, all positions and attributes go through the output layer at once.
     """
 
-    def __init__(self, agent, vocab_size, embed_dim, hidden_size,max_len,n_attributes, n_values, cell='rnn', num_layers=1):
+    def __init__(self, agent, vocab_size, embed_dim, hidden_size,max_len,n_attributes, n_values, cell='rnn', num_layers=1,
+                 sample=False):
         super(RnnReceiverImpatientCompositionality, self).__init__()
 
         self.max_len = max_len
         self.n_attributes=n_attributes
         self.n_values=n_values
+        self.sample = sample
         self.hidden_to_output = nn.Linear(hidden_size, n_attributes*n_values)
         self.encoder = RnnEncoderImpatient(vocab_size, embed_dim, hidden_size, cell, num_layers)
 
     def forward(self, message, input=None, lengths=None):
 
-        encoded = self.encoder(message)
-
-        sequence = []
-        slogits = []
-        entropy = []
-
-        for step in range(encoded.size(0)):
-
-            h_t=encoded[step,:,:]
-            step_logits = F.log_softmax(self.hidden_to_output(h_t).reshape(h_t.size(0),self.n_attributes,self.n_values), dim=2)
-            distr = Categorical(logits=step_logits)
-
-            sequence.append(step_logits)
+        encoded = self.encoder(message).transpose(0, 1)
 
-            entropy_step=[]
-            slogits_step=[]
-
-            for i in range(step_logits.size(1)):
-              distr = Categorical(logits=step_logits[:,i,:])
-              entropy_step.append(distr.entropy())
-              x = distr.sample()
-              slogits_step.append(distr.log_prob(x))
-
-            entropy_step = torch.stack(entropy_step).permute(1, 0)
-            slogits_step = torch.stack(slogits_step).permute(1, 0)
-
-            entropy.append(entropy_step)
-            slogits.append(slogits_step)
-
-        sequence = torch.stack(sequence).permute(1,0,2,3)
-        entropy = torch.stack(entropy).permute(1,0,2)
-        slogits= torch.stack(slogits).permute(1,0,2)
-        #logits = torch.stack(logits).permute(1, 0)
-        #entropy = torch.stack(entropy).permute(1, 0)
+        # [B, T, H] -> [B, T, n_attributes, n_values]
+        sequence = self.hidden_to_output(encoded).reshape(encoded.size(0), encoded.size(1), self.n_attributes,
+                                                          self.n_values)
+        sequence = F.log_softmax(sequence.float(), dim=3)
+        slogits, entropy = _impatient_log_prob_entropy(sequence, self.sample and self.training, self.sample)
 
         return sequence, slogits, entropy
 
+
 #class RnnReceiverImpatient2(nn.Module):
 
 #    """
@@ -531,6 +576,104 @@ class RnnReceiverImpatientCompositionality(nn.Module):
 
 
 
+def _effective_entropy_log_prob(entropy_s, log_prob_s, message_lengths):
+    """
+    Averages the entropy and sums the log-prob of the Sender's outputs up to and including the eos symbol, with a
+    single masked reduction over the positions.
+
+    >>> entropy, log_prob = torch.ones(2, 4), -torch.ones(2, 4)
+    >>> _effective_entropy_log_prob(entropy, log_prob, torch.tensor([1, 3]))
+    (tensor([1., 1.]), tensor([-1., -3.]))
+    """
+    positions = torch.arange(entropy_s.size(1), device=message_lengths.device)
+    not_eosed = (positions.unsqueeze(0) < message_lengths.unsqueeze(1)).to(entropy_s.dtype)
+
+    effective_entropy_s = (entropy_s * not_eosed).sum(1) / message_lengths.float()
+    effective_log_prob_s = (log_prob_s * not_eosed).sum(1)
+    return effective_entropy_s, effective_log_prob_s
+
+
+def _eos_accuracy(crible_acc, message_lengths):
+    """
+    Mean accuracy of the Impatient Listener at the eos position of each message.
+
+    >>> _eos_accuracy(torch.tensor([[0., 1., 0.], [0., 0., 0.]]), torch.tensor([2, 3]))
+    tensor(0.5000)
+    """
+    return crible_acc.gather(1, (message_lengths - 1).unsqueeze(1)).mean()
+
+
+def _receive(receiver, message, receiver_input, message_lengths, n_buckets=1, per_position=False, positions=None):
+    """
+    Feeds the messages to Receiver. With n_buckets > 1, the messages are sorted by length and split into n_buckets
+    groups of (almost) equal size. Each group is fed truncated to its longest message plus one padding position, and
+    the outputs are scattered back in the original order, so that the cost of Receiver follows the lengths of the
+    messages rather than their width. The lengths are read on the host once per call.
+
+    The per-position outputs of an Impatient Listener (per_position=True) are padded back to the width of the messages
+    by repeating their last position: it is past the eos of all the messages of the group, so the padded positions
+    have the same values as without bucketing. If the [B, K] reading `positions` of an Impatient Listener are given,
+    they are passed to it, and its outputs are only computed at these positions.
+
+    >>> _ = torch.manual_seed(0)
+    >>> receiver = RnnReceiverImpatient(None, vocab_size=5, embed_dim=4, hidden_size=8, max_len=6, n_features=3)
+    >>> message = torch.tensor([[1, 2, 0, 0, 0, 0], [3, 4, 1, 2, 3, 0], [2, 0, 0, 0, 0, 0], [1, 1, 1, 1, 1, 1]])
+    >>> lengths = find_lengths(message)
+    >>> full = _receive(receiver, message, None, lengths)
+    >>> bucketed = _receive(receiver, message, None, lengths, n_buckets=3, per_position=True)
+    >>> [x.size() == y.size() and torch.allclose(x, y, atol=1e-6) for x, y in zip(full, bucketed)]
+    [True, True, True]
+    """
+    kwargs = {} if positions is None else {'positions': positions}
+    if n_buckets <= 1:
+        return receiver(message, receiver_input, message_lengths, **kwargs)
+
+    width = message.size(1)
+    sorted_lengths, order = message_lengths.sort()
+    groups = order.chunk(n_buckets)
+    group_ends = sorted_lengths.cpu().split([group.size(0) for group in groups])
+
+    outputs = []
+    for group, ends in zip(groups, group_ends):
+        group_width = min(int(ends[-1]) + 1, width)
+        group_input = receiver_input[group] if receiver_input is not None else None
+        if positions is not None:
+            kwargs = {'positions': positions[group]}
+        group_outputs = receiver(message[group, :group_width], group_input, message_lengths[group], **kwargs)
+
+        if per_position and positions is None:
+            group_outputs = [_repeat_last_position(x, width) for x in group_outputs]
+        outputs.append(group_outputs)
+
+    inverse = torch.empty_like(order)
+    inverse[order] = torch.arange(order.size(0), device=order.device)
+    return tuple(_concat_rows(parts, inverse) for parts in zip(*outputs))
+
+
+def _first_positions(receiver_output, n_positions):
+    """
+    The outputs of an Impatient Listener at its first `n_positions` reading positions.
+    """
+    if isinstance(receiver_output, ImpatientLogits):
+        return receiver_output.with_hidden(receiver_output.hidden[:, :n_positions])
+    return receiver_output[:, :n_positions]
+
+
+def _concat_rows(parts, inverse):
+    if isinstance(parts[0], ImpatientLogits):
+        return parts[0].with_hidden(_concat_rows([x.hidden for x in parts], inverse))
+    return torch.cat(parts).index_select(0, inverse)
+
+
+def _repeat_last_position(x, width):
+    if isinstance(x, ImpatientLogits):
+        return x.with_hidden(_repeat_last_position(x.hidden, width))
+    if x.size(1) == width:
+        return x
+    padding = x[:, -1:].expand(-1, width - x.size(1), *x.size()[2:])
+    return torch.cat([x, padding], dim=1)
+
+
 class SenderReceiverRnnReinforce(nn.Module):
     """
     Implements Sender/Receiver game with training done via Reinforce. Both agents are supposed to
@@ -565,7 +708,8 @@ class SenderReceiverRnnReinforce(nn.Module):
     5.0
     """
     def __init__(self, sender, receiver, loss, sender_entropy_coeff, receiver_entropy_coeff,
-                 length_cost=0.0,unigram_penalty=0.0,reg=False):
+                 length_cost=0.0,unigram_penalty=0.0,reg=False,
+                 length_cost_scheduler=None, max_len_controller=None, receiver_buckets=1):
         """
         :param sender: sender agent
         :param receiver: receiver agent
@@ -583,6 +727,11 @@ class SenderReceiverRnnReinforce(nn.Module):
         :param receiver_entropy_coeff: entropy regularization coeff for receiver
         :param length_cost: the penalty applied to Sender for each symbol produced
         :param reg: apply the regularization scheduling (Lazy Speaker)
+        :param length_cost_scheduler: the LengthCostScheduler used when reg is set (default: PowerLengthCost())
+        :param max_len_controller: an AdaptiveMaxLen controller updated with the message lengths during training,
+            which sets the unrolling horizon of Sender (default: None)
+        :param receiver_buckets: the number of length buckets the messages are split into before being fed to
+            Receiver, each one truncated to its longest message (default: 1, no bucketing)
         """
         super(SenderReceiverRnnReinforce, self).__init__()
         self.sender = sender
@@ -596,54 +745,35 @@ class SenderReceiverRnnReinforce(nn.Module):
         self.mean_baseline = defaultdict(float)
         self.n_points = defaultdict(float)
         self.reg=reg
+        if reg and length_cost_scheduler is None:
+            length_cost_scheduler = PowerLengthCost()
+        self.length_cost_scheduler = length_cost_scheduler if reg else None
+        self.max_len_controller = max_len_controller
+        self.receiver_buckets = receiver_buckets
 
     def forward(self, sender_input, labels, receiver_input=None):
         message, log_prob_s, entropy_s = self.sender(sender_input)
         message_lengths = find_lengths(message)
+        if self.max_len_controller is not None and self.training:
+            self.max_len_controller.update(message_lengths)
+            self.sender.horizon = self.max_len_controller.horizon
 
-        receiver_output, log_prob_r, entropy_r = self.receiver(message, receiver_input, message_lengths)
+        receiver_output, log_prob_r, entropy_r = _receive(self.receiver, message, receiver_input, message_lengths,
+                                                          self.receiver_buckets)
 
         loss, rest = self.loss(sender_input, message, receiver_input, receiver_output, labels)
 
-        # the entropy of the outputs of S before and including the eos symbol - as we don't care about what's after
-        effective_entropy_s = torch.zeros_like(entropy_r)
-
-        # the log prob of the choices made by S before and including the eos symbol - again, we don't
-        # care about the rest
-        effective_log_prob_s = torch.zeros_like(log_prob_r)
-
-        for i in range(message.size(1)):
-            not_eosed = (i < message_lengths).float()
-            effective_entropy_s += entropy_s[:, i] * not_eosed
-            effective_log_prob_s += log_prob_s[:, i] * not_eosed
-        effective_entropy_s = effective_entropy_s / message_lengths.float()
+        # the entropy and log prob of the outputs of S before and including the eos symbol - as we don't care about
+        # what's after
+        effective_entropy_s, effective_log_prob_s = _effective_entropy_log_prob(entropy_s, log_prob_s, message_lengths)
 
         weighted_entropy = effective_entropy_s.mean() * self.sender_entropy_coeff + \
                 entropy_r.mean() * self.receiver_entropy_coeff
 
         log_prob = effective_log_prob_s + log_prob_r
 
-        if self.reg:
-
-          sc=rest["acc"].sum()/rest["acc"].size(0)
-
-          # Pour n_features=100
-          self.length_cost= sc**(45) / 5
-
-          #self.length_cost= sc**(45) / 10
-          #if sc>0.99:
-              #self.length_cost=(sc-0.99)*100 +0.01
-          #else:
-              #self.length_cost=0.
-          #if sc>0.995:
-              #self.length_cost+=0.01
-              #if self.length_cost==0.3:
-            #      self.length_cost-=0.01
-              #print(self.length_cost)
-
-          #if sc<0.98:
-              #self.length_cost=0.
-
+        if self.length_cost_scheduler is not None:
+            self.length_cost = self.length_cost_scheduler(rest["acc"].float().mean(), self.length_cost)
 
         length_loss = message_lengths.float() * self.length_cost
 
@@ -660,18 +790,20 @@ class SenderReceiverRnnReinforce(nn.Module):
             self.update_baseline('length', length_loss)
 
         for k, v in rest.items():
-            rest[k] = v.mean().item() if hasattr(v, 'mean') else v
-        rest['loss'] = optimized_loss.detach().item()
-        rest['sender_entropy'] = entropy_s.mean().item()
-        rest['receiver_entropy'] = entropy_r.mean().item()
-        rest['original_loss'] = loss.mean().item()
-        rest['mean_length'] = message_lengths.float().mean().item()
+            rest[k] = v.mean().detach() if hasattr(v, 'mean') else v
+        rest['loss'] = optimized_loss.detach()
+        rest['sender_entropy'] = entropy_s.mean().detach()
+        rest['receiver_entropy'] = entropy_r.mean().detach()
+        rest['original_loss'] = loss.mean().detach()
+        rest['mean_length'] = message_lengths.float().mean()
+        if self.max_len_controller is not None:
+            rest['horizon'] = self.max_len_controller.horizon
 
         return optimized_loss, rest
 
     def update_baseline(self, name, value):
         self.n_points[name] += 1
-        self.mean_baseline[name] += (value.detach().mean().item() - self.mean_baseline[name]) / self.n_points[name]
+        self.mean_baseline[name] += (value.detach().float().mean() - self.mean_baseline[name]) / self.n_points[name]
 
 class SenderImpatientReceiverRnnReinforce(nn.Module):
     """
@@ -681,9 +813,32 @@ class SenderImpatientReceiverRnnReinforce(nn.Module):
     - tensor shapes are adapted for variance reduction.
 
     When reg is set to True, the regularization scheduling is applied (Lazy Speaker).
+
+    With impatient_positions = K > 0, the Impatient loss is estimated during training from K reading positions per
+    message (see stratified_positions): the output layer of Receiver and the loss are only computed at these
+    positions, and the loss is given the positions and the sizes of their strata as `positions` and
+    `position_counts` keyword arguments. The receiver log-probability and entropy are averaged over all the positions
+    of the messages, as without sampling: Receiver is also read at the first position past eos, which stands for all
+    the positions past eos. This assumes that Receiver has the same outputs at all of them, as RnnReceiverImpatient,
+    whose encoder returns zero hidden states past eos. Evaluation always reads all the positions.
+
+    >>> sender = RnnSenderReinforce(nn.Linear(3, 10), vocab_size=5, embed_dim=5, hidden_size=10, max_len=4)
+    >>> receiver = RnnReceiverImpatient(None, vocab_size=5, embed_dim=4, hidden_size=8, max_len=4, n_features=3)
+    >>> def loss(sender_input, message, _message_length, _receiver_input, receiver_output, _labels, **kwargs):
+    ...     return torch.zeros(message.size(0)), {}, torch.zeros(message.size())
+    >>> game = SenderImpatientReceiverRnnReinforce(sender, receiver, loss, sender_entropy_coeff=0.0,
+    ...                                            receiver_entropy_coeff=0.1)
+    >>> input = torch.randn(8, 3)
+    >>> _ = torch.manual_seed(0)
+    >>> full = game(input, labels=None)[1]['receiver_entropy']
+    >>> game.impatient_positions = 4  # at most one position per stratum: the estimate is exact
+    >>> _ = torch.manual_seed(0)
+    >>> torch.allclose(game(input, labels=None)[1]['receiver_entropy'], full)
+    True
     """
     def __init__(self, sender, receiver, loss, sender_entropy_coeff, receiver_entropy_coeff,
-                 length_cost=0.0,unigram_penalty=0.0,reg=False):
+                 length_cost=0.0,unigram_penalty=0.0,reg=False,
+                 length_cost_scheduler=None, max_len_controller=None, receiver_buckets=1, impatient_positions=0):
         """
         :param sender: sender agent
         :param receiver: receiver agent
@@ -701,6 +856,13 @@ class SenderImpatientReceiverRnnReinforce(nn.Module):
         :param receiver_entropy_coeff: entropy regularization coeff for receiver
         :param length_cost: the penalty applied to Sender for each symbol produced
         :param reg: apply the regularization scheduling (Lazy Speaker)
+        :param length_cost_scheduler: the LengthCostScheduler used when reg is set (default: PowerLengthCost())
+        :param max_len_controller: an AdaptiveMaxLen controller updated with the message lengths during training,
+            which sets the unrolling horizon of Sender (default: None)
+        :param receiver_buckets: the number of length buckets the messages are split into before being fed to
+            Receiver, each one truncated to its longest message (default: 1, no bucketing)
+        :param impatient_positions: if positive, the number of reading positions per message the Impatient loss is
+            estimated from during training (default: 0, all the positions)
         """
         super(SenderImpatientReceiverRnnReinforce, self).__init__()
         self.sender = sender
@@ -711,6 +873,12 @@ class SenderImpatientReceiverRnnReinforce(nn.Module):
         self.length_cost = length_cost
         self.unigram_penalty = unigram_penalty
         self.reg=reg
+        if reg and length_cost_scheduler is None:
+            length_cost_scheduler = PowerLengthCost()
+        self.length_cost_scheduler = length_cost_scheduler if reg else None
+        self.max_len_controller = max_len_controller
+        self.receiver_buckets = receiver_buckets
+        self.impatient_positions = impatient_positions
 
         self.mean_baseline = defaultdict(float)
         self.n_points = defaultdict(float)
@@ -718,59 +886,51 @@ class SenderImpatientReceiverRnnReinforce(nn.Module):
     def forward(self, sender_input, labels, receiver_input=None):
         message, log_prob_s, entropy_s = self.sender(sender_input)
         message_lengths = find_lengths(message)
+        if self.max_len_controller is not None and self.training:
+            self.max_len_controller.update(message_lengths)
+            self.sender.horizon = self.max_len_controller.horizon
+
+        positions = read_positions = None
+        if self.impatient_positions > 0 and self.training:
+            positions, position_counts = stratified_positions(message_lengths, self.impatient_positions)
+            # plus the first position past eos, which stands for all of them (the last position for full messages,
+            # with a zero weight)
+            width = message.size(1)
+            past_eos = message_lengths.clamp(max=width - 1).unsqueeze(1)
+            read_positions = torch.cat([positions, past_eos], dim=1)
 
         # If impatient 1
-        receiver_output, log_prob_r, entropy_r = self.receiver(message, receiver_input, message_lengths)
-
-        """ NOISE VERSION
-
-        # Randomly takes a position
-        rand_length=np.random.randint(0,message.size(1))
-
-        # Loss by output
-        loss, rest = self.loss(sender_input, message, receiver_input, receiver_output[:,rand_length,:], labels)
-
-        # the entropy of the outputs of S before and including the eos symbol - as we don't care about what's after
-        effective_entropy_s = torch.zeros_like(entropy_r[:,rand_length])
-
-        # the log prob of the choices made by S before and including the eos symbol - again, we don't
-        # care about the rest
-        effective_log_prob_s = torch.zeros_like(log_prob_r[:,rand_length])
-        """
+        receiver_output, log_prob_r, entropy_r = _receive(self.receiver, message, receiver_input, message_lengths,
+                                                          self.receiver_buckets, per_position=True,
+                                                          positions=read_positions)
 
         #Loss
-        loss, rest, crible_acc = self.loss(sender_input, message, message_lengths, receiver_input, receiver_output, labels)
-
-        # the entropy of the outputs of S before and including the eos symbol - as we don't care about what's after
-        effective_entropy_s = torch.zeros_like(entropy_r.mean(1))
-
-        # the log prob of the choices made by S before and including the eos symbol - again, we don't
-        # care about the rest
-        effective_log_prob_s = torch.zeros_like(log_prob_r.mean(1))
-
-        for i in range(message.size(1)):
-            not_eosed = (i < message_lengths).float()
-            effective_entropy_s += entropy_s[:, i] * not_eosed
-            effective_log_prob_s += log_prob_s[:, i] * not_eosed
-        effective_entropy_s = effective_entropy_s / message_lengths.float()
+        if positions is None:
+            loss, rest, crible_acc = self.loss(sender_input, message, message_lengths, receiver_input, receiver_output,
+                                               labels)
+            log_prob_r = log_prob_r.mean(1)
+        else:
+            loss, rest, crible_acc = self.loss(sender_input, message, message_lengths, receiver_input,
+                                               _first_positions(receiver_output, positions.size(1)), labels,
+                                               positions=positions, position_counts=position_counts)
+            # unbiased estimates of the averages over all the positions, as without sampling
+            position_weights = torch.cat([position_counts, (width - message_lengths).unsqueeze(1).float()], dim=1)
+            position_weights = position_weights / width
+            log_prob_r, entropy_r = (log_prob_r * position_weights).sum(1), (entropy_r * position_weights).sum(1)
+
+        # the entropy and log prob of the outputs of S before and including the eos symbol - as we don't care about
+        # what's after
+        effective_entropy_s, effective_log_prob_s = _effective_entropy_log_prob(entropy_s, log_prob_s, message_lengths)
 
         weighted_entropy = effective_entropy_s.mean() * self.sender_entropy_coeff + \
                 entropy_r.mean() * self.receiver_entropy_coeff
 
-        log_prob = effective_log_prob_s + log_prob_r.mean(1)
-
-        if self.reg:
-            sc=0.
-
-            for i in range(message_lengths.size(0)):
-              sc+=crible_acc[i,message_lengths[i]-1]
-            sc/=message_lengths.size(0)
-
-            # Regularization scheduling paper
-            #self.length_cost= sc**(45) / 10
+        log_prob = effective_log_prob_s + log_prob_r
 
-            # Pour n_features=100
-            self.length_cost= sc**(45) / 5
+        # the accuracy of the listener once it has read the whole message
+        eos_acc = _eos_accuracy(crible_acc, message_lengths).detach()
+        if self.length_cost_scheduler is not None:
+            self.length_cost = self.length_cost_scheduler(eos_acc, self.length_cost)
 
         length_loss = message_lengths.float() * self.length_cost
 
@@ -787,26 +947,49 @@ class SenderImpatientReceiverRnnReinforce(nn.Module):
             self.update_baseline('length', length_loss)
 
         for k, v in rest.items():
-            rest[k] = v.mean().item() if hasattr(v, 'mean') else v
-        rest['loss'] = optimized_loss.detach().item()
-        rest['sender_entropy'] = entropy_s.mean().item()
-        rest['receiver_entropy'] = entropy_r.mean().item()
-        rest['original_loss'] = loss.mean().item()
-        rest['mean_length'] = message_lengths.float().mean().item()
+            rest[k] = v.mean().detach() if hasattr(v, 'mean') else v
+        rest['loss'] = optimized_loss.detach()
+        rest['sender_entropy'] = entropy_s.mean().detach()
+        rest['receiver_entropy'] = entropy_r.mean().detach()
+        rest['original_loss'] = loss.mean().detach()
+        rest['eos_acc'] = eos_acc
+        rest['mean_length'] = message_lengths.float().mean()
+        if self.max_len_controller is not None:
+            rest['horizon'] = self.max_len_controller.horizon
 
         return optimized_loss, rest
 
     def update_baseline(self, name, value):
         self.n_points[name] += 1
-        self.mean_baseline[name] += (value.detach().mean().item() - self.mean_baseline[name]) / self.n_points[name]
+        self.mean_baseline[name] += (value.detach().float().mean() - self.mean_baseline[name]) / self.n_points[name]
 
 class CompositionalitySenderReceiverRnnReinforce(nn.Module):
 
     """
-    Adaptation of SenderReceiverRnnReinforce to inputs with several attributes.
+    Adaptation of SenderReceiverRnnReinforce to inputs with several attributes. Receiver reads the whole message, so
+    the length cost scheduler (Lazy Speaker) is fed the batch accuracy.
+
+    >>> sender = RnnSenderReinforce(nn.Linear(6, 10), vocab_size=5, embed_dim=5, hidden_size=10, max_len=4)
+    >>> receiver = RnnReceiverCompositionality(None, vocab_size=5, embed_dim=5, hidden_size=8, max_len=4,
+    ...                                        n_attributes=2, n_values=3)
+    >>> def loss(sender_input, _message, _message_length, _receiver_input, receiver_output, _labels, n_attributes,
+    ...          n_values):
+    ...     sender_input = sender_input.reshape(sender_input.size(0), n_attributes, n_values)
+    ...     crible_acc = (receiver_output.argmax(dim=2) == sender_input.argmax(dim=2)).float().mean(1)
+    ...     return -receiver_output.sum(dim=(1, 2)), {'acc': crible_acc}, crible_acc
+    >>> scheduler = StepLengthCost(step=0.5, upper=-1.)
+    >>> game = CompositionalitySenderReceiverRnnReinforce(sender, receiver, loss, sender_entropy_coeff=0.0,
+    ...                                                   receiver_entropy_coeff=0.0, n_attributes=2, n_values=3,
+    ...                                                   reg=True, length_cost_scheduler=scheduler)
+    >>> optimized_loss, aux_info = game(torch.eye(3).repeat(4, 2), labels=None)
+    >>> float(game.length_cost)  # any accuracy is above `upper`: the length cost grows by `step`
+    0.5
+    >>> sorted(aux_info.keys())
+    ['acc', 'loss', 'mean_length', 'original_loss', 'receiver_entropy', 'sender_entropy']
     """
     def __init__(self, sender, receiver, loss, sender_entropy_coeff, receiver_entropy_coeff,n_attributes,n_values,
-                 length_cost=0.0,unigram_penalty=0.0,reg=False):
+                 length_cost=0.0,unigram_penalty=0.0,reg=False,
+                 length_cost_scheduler=None, max_len_controller=None, receiver_buckets=1):
         """
         :param sender: sender agent
         :param receiver: receiver agent
@@ -823,6 +1006,13 @@ class CompositionalitySenderReceiverRnnReinforce(nn.Module):
         :param sender_entropy_coeff: entropy regularization coeff for sender
         :param receiver_entropy_coeff: entropy regularization coeff for receiver
         :param length_cost: the penalty applied to Sender for each symbol produced
+        :param reg: apply the regularization scheduling (Lazy Speaker)
+        :param length_cost_scheduler: the LengthCostScheduler used when reg is set (default: None, the length cost
+            is fixed even when reg is set)
+        :param max_len_controller: an AdaptiveMaxLen controller updated with the message lengths during training,
+            which sets the unrolling horizon of Sender (default: None)
+        :param receiver_buckets: the number of length buckets the messages are split into before being fed to
+            Receiver, each one truncated to its longest message (default: 1, no bucketing)
         """
         super(CompositionalitySenderReceiverRnnReinforce, self).__init__()
         self.sender = sender
@@ -833,6 +1023,9 @@ class CompositionalitySenderReceiverRnnReinforce(nn.Module):
         self.length_cost = length_cost
         self.unigram_penalty = unigram_penalty
         self.reg=reg
+        self.length_cost_scheduler = length_cost_scheduler if reg else None
+        self.max_len_controller = max_len_controller
+        self.receiver_buckets = receiver_buckets
         self.n_attributes=n_attributes
         self.n_values=n_values
 
@@ -843,57 +1036,38 @@ class CompositionalitySenderReceiverRnnReinforce(nn.Module):
 
         message, log_prob_s, entropy_s = self.sender(sender_input)
         message_lengths = find_lengths(message)
+        if self.max_len_controller is not None and self.training:
+            self.max_len_controller.update(message_lengths)
+            self.sender.horizon = self.max_len_controller.horizon
 
         # Noisy channel
         noise_level=0.
-        noise_map=torch.from_numpy(1*(np.random.rand(message.size(0),message.size(1))<noise_level)).to("cuda")
-        noise=torch.from_numpy(np.random.randint(1,self.sender.vocab_size,size=(message.size(0),message.size(1)))).to("cuda") # random symbols
+        noise_map=torch.from_numpy(1*(np.random.rand(message.size(0),message.size(1))<noise_level)).to(message.device)
+        noise=torch.from_numpy(np.random.randint(1,self.sender.vocab_size,size=(message.size(0),message.size(1)))).to(message.device) # random symbols
 
         message_noise=message*(1-noise_map) + noise_map* noise
 
         # Receiver normal
-        receiver_output_all_att, log_prob_r_all_att, entropy_r_all_att = self.receiver(message_noise, receiver_input, message_lengths)
+        receiver_output_all_att, log_prob_r_all_att, entropy_r_all_att = _receive(
+            self.receiver, message_noise, receiver_input, message_lengths, self.receiver_buckets)
         #dim=[batch_size,n_att,n_val]
 
-        # reg
-        sc=0.
-
         loss, rest, crible_acc = self.loss(sender_input, message, message_lengths, receiver_input, receiver_output_all_att, labels,self.n_attributes,self.n_values)
 
-        #if self.reg:
-        #     for i in range(message_lengths.size(0)):
-        #      sc+=crible_acc[i,message_lengths[i]-1]
-
-
         log_prob_r=log_prob_r_all_att.mean(1)
         entropy_r=entropy_r_all_att.mean(1)
 
-        # the entropy of the outputs of S before and including the eos symbol - as we don't care about what's after
-        effective_entropy_s = torch.zeros_like(entropy_r)
-
-        # the log prob of the choices made by S before and including the eos symbol - again, we don't
-        # care about the rest
-        effective_log_prob_s = torch.zeros_like(log_prob_r)
-
-        for i in range(message.size(1)):
-            not_eosed = (i < message_lengths).float()
-            effective_entropy_s += entropy_s[:, i] * not_eosed
-            effective_log_prob_s += log_prob_s[:, i] * not_eosed
-        effective_entropy_s = effective_entropy_s / message_lengths.float()
+        # the entropy and log prob of the outputs of S before and including the eos symbol - as we don't care about
+        # what's after
+        effective_entropy_s, effective_log_prob_s = _effective_entropy_log_prob(entropy_s, log_prob_s, message_lengths)
 
         weighted_entropy = effective_entropy_s.mean() * self.sender_entropy_coeff + \
                 entropy_r.mean() * self.receiver_entropy_coeff
 
         log_prob = effective_log_prob_s + log_prob_r
 
-        #if self.reg:
-        #    sc/=message_lengths.size(0)
-
-        #    if sc>0.98:
-        #    	self.length_cost+=0.1
-        #    else:
-        #    	self.length_cost=0.
-            #self.length_cost= sc**(60) / 2
+        if self.length_cost_scheduler is not None:
+            self.length_cost = self.length_cost_scheduler(rest["acc"].float().mean(), self.length_cost)
 
         length_loss = message_lengths.float() * self.length_cost
 
@@ -910,18 +1084,20 @@ class CompositionalitySenderReceiverRnnReinforce(nn.Module):
             self.update_baseline('length', length_loss)
 
         for k, v in rest.items():
-            rest[k] = v.mean().item() if hasattr(v, 'mean') else v
-        rest['loss'] = optimized_loss.detach().item()
-        rest['sender_entropy'] = entropy_s.mean().item()
-        rest['receiver_entropy'] = entropy_r.mean().item()
-        rest['original_loss'] = loss.mean().item()
-        rest['mean_length'] = message_lengths.float().mean().item()
+            rest[k] = v.mean().detach() if hasattr(v, 'mean') else v
+        rest['loss'] = optimized_loss.detach()
+        rest['sender_entropy'] = entropy_s.mean().detach()
+        rest['receiver_entropy'] = entropy_r.mean().detach()
+        rest['original_loss'] = loss.mean().detach()
+        rest['mean_length'] = message_lengths.float().mean()
+        if self.max_len_controller is not None:
+            rest['horizon'] = self.max_len_controller.horizon
 
         return optimized_loss, rest
 
     def update_baseline(self, name, value):
         self.n_points[name] += 1
-        self.mean_baseline[name] += (value.detach().mean().item() - self.mean_baseline[name]) / self.n_points[name]
+        self.mean_baseline[name] += (value.detach().float().mean() - self.mean_baseline[name]) / self.n_points[name]
 
 class CompositionalitySenderImpatientReceiverRnnReinforce(nn.Module):
     """
@@ -957,7 +1133,8 @@ class CompositionalitySenderImpatientReceiverRnnReinforce(nn.Module):
     5.0
     """
     def __init__(self, sender, receiver, loss, sender_entropy_coeff, receiver_entropy_coeff,n_attributes,n_values,att_weights,
-                 length_cost=0.0,unigram_penalty=0.0,reg=False):
+                 length_cost=0.0,unigram_penalty=0.0,reg=False,
+                 length_cost_scheduler=None, max_len_controller=None, receiver_buckets=1):
         """
         :param sender: sender agent
         :param receiver: receiver agent
@@ -974,6 +1151,12 @@ class CompositionalitySenderImpatientReceiverRnnReinforce(nn.Module):
         :param sender_entropy_coeff: entropy regularization coeff for sender
         :param receiver_entropy_coeff: entropy regularization coeff for receiver
         :param length_cost: the penalty applied to Sender for each symbol produced
+        :param reg: apply the regularization scheduling (Lazy Speaker)
+        :param length_cost_scheduler: the LengthCostScheduler used when reg is set (default: StepLengthCost())
+        :param max_len_controller: an AdaptiveMaxLen controller updated with the message lengths during training,
+            which sets the unrolling horizon of Sender (default: None)
+        :param receiver_buckets: the number of length buckets the messages are split into before being fed to
+            Receiver, each one truncated to its longest message (default: 1, no bucketing)
         """
         super(CompositionalitySenderImpatientReceiverRnnReinforce, self).__init__()
         self.sender = sender
@@ -984,6 +1167,11 @@ class CompositionalitySenderImpatientReceiverRnnReinforce(nn.Module):
         self.length_cost = length_cost
         self.unigram_penalty = unigram_penalty
         self.reg=reg
+        if reg and length_cost_scheduler is None:
+            length_cost_scheduler = StepLengthCost()
+        self.length_cost_scheduler = length_cost_scheduler if reg else None
+        self.max_len_controller = max_len_controller
+        self.receiver_buckets = receiver_buckets
         self.n_attributes=n_attributes
         self.n_values=n_values
         self.att_weights=att_weights
@@ -996,12 +1184,13 @@ class CompositionalitySenderImpatientReceiverRnnReinforce(nn.Module):
         #print(sender_input[:,11:-1])
         message, log_prob_s, entropy_s = self.sender(torch.floor(sender_input))
         message_lengths = find_lengths(message)
+        if self.max_len_controller is not None and self.training:
+            self.max_len_controller.update(message_lengths)
+            self.sender.horizon = self.max_len_controller.horizon
 
         # If impatient 1
-        receiver_output_all_att, log_prob_r_all_att, entropy_r_all_att = self.receiver(message, receiver_input, message_lengths)
-
-        # reg
-        sc=0.
+        receiver_output_all_att, log_prob_r_all_att, entropy_r_all_att = _receive(
+            self.receiver, message, receiver_input, message_lengths, self.receiver_buckets, per_position=True)
 
         # Version de base
         #loss, rest, crible_acc = self.loss(sender_input, message, message_lengths, receiver_input, receiver_output_all_att, labels,self.n_attributes,self.n_values,self.att_weights)
@@ -1010,42 +1199,23 @@ class CompositionalitySenderImpatientReceiverRnnReinforce(nn.Module):
         loss, rest, crible_acc = self.loss(sender_input, message, message_lengths, receiver_input, receiver_output_all_att, labels,self.n_attributes,self.n_values,self.att_weights)
 
 
-        if self.reg:
-            for i in range(message_lengths.size(0)):
-              sc+=crible_acc[i,message_lengths[i]-1]
-
 
         log_prob_r=log_prob_r_all_att.mean(1).mean(1)
         entropy_r=entropy_r_all_att.mean(1).mean(1)
 
-        # the entropy of the outputs of S before and including the eos symbol - as we don't care about what's after
-        effective_entropy_s = torch.zeros_like(entropy_r)
-
-        # the log prob of the choices made by S before and including the eos symbol - again, we don't
-        # care about the rest
-        effective_log_prob_s = torch.zeros_like(log_prob_r)
-
-        for i in range(message.size(1)):
-            not_eosed = (i < message_lengths).float()
-            effective_entropy_s += entropy_s[:, i] * not_eosed
-            effective_log_prob_s += log_prob_s[:, i] * not_eosed
-        effective_entropy_s = effective_entropy_s / message_lengths.float()
+        # the entropy and log prob of the outputs of S before and including the eos symbol - as we don't care about
+        # what's after
+        effective_entropy_s, effective_log_prob_s = _effective_entropy_log_prob(entropy_s, log_prob_s, message_lengths)
 
         weighted_entropy = effective_entropy_s.mean() * self.sender_entropy_coeff + \
                 entropy_r.mean() * self.receiver_entropy_coeff
 
         log_prob = effective_log_prob_s + log_prob_r
 
-        if self.reg:
-            sc/=message_lengths.size(0)
-
-            if sc>0.9 and sc<0.99:
-                self.length_cost=0.
-            if sc>0.99:
-                self.length_cost+=0.01
-            #if sc<0.9:
-            #   self.length_cost=-0.1
-            #self.length_cost= sc**(60) / 2
+        # the accuracy of the listener once it has read the whole message
+        eos_acc = _eos_accuracy(crible_acc, message_lengths).detach()
+        if self.length_cost_scheduler is not None:
+            self.length_cost = self.length_cost_scheduler(eos_acc, self.length_cost)
 
         length_loss = message_lengths.float() * self.length_cost
 
@@ -1066,23 +1236,26 @@ class CompositionalitySenderImpatientReceiverRnnReinforce(nn.Module):
             self.update_baseline('length', length_loss)
 
         for k, v in rest.items():
-            rest[k] = v.mean().item() if hasattr(v, 'mean') else v
-        rest['loss'] = optimized_loss.detach().item()
-        rest['sender_entropy'] = entropy_s.mean().item()
-        rest['receiver_entropy'] = entropy_r.mean().item()
-        rest['original_loss'] = loss.mean().item()
-        rest['mean_length'] = message_lengths.float().mean().item()
+            rest[k] = v.mean().detach() if hasattr(v, 'mean') else v
+        rest['loss'] = optimized_loss.detach()
+        rest['sender_entropy'] = entropy_s.mean().detach()
+        rest['receiver_entropy'] = entropy_r.mean().detach()
+        rest['original_loss'] = loss.mean().detach()
+        rest['eos_acc'] = eos_acc
+        rest['mean_length'] = message_lengths.float().mean()
+        if self.max_len_controller is not None:
+            rest['horizon'] = self.max_len_controller.horizon
 
         return optimized_loss, rest
 
     def update_baseline(self, name, value):
         self.n_points[name] += 1
-        self.mean_baseline[name] += (value.detach().mean().item() - self.mean_baseline[name]) / self.n_points[name]
+        self.mean_baseline[name] += (value.detach().float().mean() - self.mean_baseline[name]) / self.n_points[name]
 
 
 class TransformerReceiverDeterministic(nn.Module):
     def __init__(self, agent, vocab_size, max_len, embed_dim, num_heads, hidden_size, num_layers, positional_emb=True,
-                causal=True):
+                causal=True, attention='torch', pooling='after_eos'):
         super(TransformerReceiverDeterministic, self).__init__()
         self.agent = agent
         self.encoder = TransformerEncoder(vocab_size=vocab_size,
@@ -1092,7 +1265,9 @@ class TransformerReceiverDeterministic(nn.Module):
                                           num_layers=num_layers,
                                           hidden_size=hidden_size,
                                           positional_embedding=positional_emb,
-                                          causal=causal)
+                                          causal=causal,
+                                          attention=attention,
+                                          pooling=pooling)
 
     def forward(self, message, input=None, lengths=None):
         if lengths is None:
@@ -1109,7 +1284,7 @@ class TransformerReceiverDeterministic(nn.Module):
 
 class TransformerSenderReinforce(nn.Module):
     def __init__(self, agent, vocab_size, embed_dim, max_len, num_layers, num_heads, hidden_size,
-                 generate_style='standard', causal=True, force_eos=True):
+                 generate_style='standard', causal=True, force_eos=True, incremental=True, attention='torch'):
         """
         :param agent: the agent to be wrapped, returns the "encoder" state vector, which is the unrolled into a message
         :param vocab_size: vocab size of the message
@@ -1125,6 +1300,10 @@ class TransformerSenderReinforce(nn.Module):
             'standard': [s1 s2 s3] -> embeddings [[e1] [e2] [e3]] -> (s4 = argmax(linear(e3)))
             'in-place': [s1 s2 s3] -> [s1 s2 s3 <need-symbol>] -> embeddings [[e1] [e2] [e3] [e4]] -> (s4 = argmax(linear(e4)))
         :param force_eos: <eos> added to the end of each sequence
+        :param incremental: when causal, generate the message incrementally, with the keys and values of the previous
+            symbols cached in every layer, instead of running the decoder over the whole prefix at each step
+        :param attention: the attention backend of the decoder, 'torch' (nn.MultiheadAttention) or 'sdpa'
+            (F.scaled_dot_product_attention)
         """
         super(TransformerSenderReinforce, self).__init__()
         self.agent = agent
@@ -1133,6 +1312,7 @@ class TransformerSenderReinforce(nn.Module):
         assert generate_style in ['standard', 'in-place']
         self.generate_style = generate_style
         self.causal = causal
+        self.incremental = incremental
 
         self.max_len = max_len
 
@@ -1141,7 +1321,7 @@ class TransformerSenderReinforce(nn.Module):
 
         self.transformer = TransformerDecoder(embed_dim=embed_dim,
                                               max_len=max_len, num_layers=num_layers,
-                                              num_heads=num_heads, hidden_size=hidden_size)
+                                              num_heads=num_heads, hidden_size=hidden_size, attention=attention)
 
         self.embedding_to_vocab = nn.Linear(embed_dim, vocab_size)
 
@@ -1163,15 +1343,16 @@ class TransformerSenderReinforce(nn.Module):
 
         special_symbol = self.special_symbol_embedding.expand(batch_size, -1).unsqueeze(1).to(device)
         input = special_symbol
+        incremental = self.causal and self.incremental
+        caches = self.transformer.init_caches()
 
         for step in range(self.max_len):
-            if self.causal:
-                attn_mask = torch.triu(torch.ones(step+1, step+1).byte(), diagonal=1).to(device)
-                attn_mask = attn_mask.float().masked_fill(attn_mask == 1, float('-inf'))
+            if incremental:
+                # only the last symbol is fed, the previous ones are cached
+                output = self.transformer.forward_incremental(input[:, -1:, :], encoder_state, caches)
             else:
-                attn_mask = None
-            output = self.transformer(embedded_input=input, encoder_out=encoder_state, attn_mask=attn_mask)
-            step_logits = F.log_softmax(self.embedding_to_vocab(output[:, -1, :]), dim=1)
+                output = self.transformer(embedded_input=input, encoder_out=encoder_state, is_causal=self.causal)
+            step_logits = F.log_softmax(self.embedding_to_vocab(output[:, -1, :]).float(), dim=1)
 
             distr = Categorical(logits=step_logits)
             entropy.append(distr.entropy())
@@ -1189,24 +1370,27 @@ class TransformerSenderReinforce(nn.Module):
 
     def generate_inplace(self, encoder_state):
         batch_size = encoder_state.size(0)
-        device = encoder_state.device
 
         sequence = []
         logits = []
         entropy = []
 
         special_symbol = self.special_symbol_embedding.expand(batch_size, -1).unsqueeze(1).to(encoder_state.device)
+        incremental = self.causal and self.incremental
+        caches = self.transformer.init_caches()
+
         output = []
         for step in range(self.max_len):
-            input = torch.cat(output + [special_symbol], dim=1)
-            if self.causal:
-                attn_mask = torch.triu(torch.ones(step+1, step+1).byte(), diagonal=1).to(device)
-                attn_mask = attn_mask.float().masked_fill(attn_mask == 1, float('-inf'))
+            if incremental:
+                # the symbol generated at the previous step replaces the special one, which moves to the next position;
+                # only the former is cached
+                input = torch.cat(output[-1:] + [special_symbol], dim=1)
+                embedded = self.transformer.forward_incremental(input, encoder_state, caches,
+                                                                n_committed=input.size(1) - 1)
             else:
-                attn_mask = None
-
-            embedded = self.transformer(embedded_input=input, encoder_out=encoder_state, attn_mask=attn_mask)
-            step_logits = F.log_softmax(self.embedding_to_vocab(embedded[:, -1, :]), dim=1)
+                input = torch.cat(output + [special_symbol], dim=1)
+                embedded = self.transformer(embedded_input=input, encoder_out=encoder_state, is_causal=self.causal)
+            step_logits = F.log_softmax(self.embedding_to_vocab(embedded[:, -1, :]).float(), dim=1)
 
             distr = Categorical(logits=step_logits)
             entropy.append(distr.entropy())
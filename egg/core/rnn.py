@@ -10,12 +10,64 @@ import torch.nn as nn
 from .util import find_lengths
 
 
+# Above this ratio between the mean message length and the message width, running the RNN over the padded messages
+# and masking the outputs is faster than packing them (measured with GRU and LSTM cells, batches of 32 to 2048
+# messages of width 30: packing only wins for messages much shorter than the width)
+MASKED_FILL_CROSSOVER = 0.35
+
+ENCODER_MODES = ['auto', 'packed', 'masked']
+
+
+class _ExecutionMode:
+    """
+    Chooses between packed and masked execution of an encoder. In 'auto' mode, the choice depends on the fill ratio of
+    the batches (mean length / width). It is measured at every call for lengths on the CPU, and only every `interval`
+    calls otherwise, as reading it is then a device-to-host synchronisation.
+    """
+    def __init__(self, mode: str, crossover: float = MASKED_FILL_CROSSOVER, interval: int = 100) -> None:
+        if mode not in ENCODER_MODES:
+            raise ValueError(f"Unknown encoder mode: {mode}")
+        self.mode = mode
+        self.crossover = crossover
+        self.interval = interval
+        self.fill = None
+        self.n_calls = 0
+
+    def __call__(self, lengths: torch.Tensor, width: int) -> str:
+        if self.mode != 'auto':
+            return self.mode
+
+        if self.fill is None or lengths.device.type == 'cpu' or self.n_calls % self.interval == 0:
+            self.fill = lengths.float().mean().item() / width
+        self.n_calls += 1
+
+        return 'masked' if self.fill >= self.crossover else 'packed'
+
+
+def _run_masked(cell: nn.RNNBase, emb: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+    """
+    Runs the cell over the padded embedded messages [B, T, E] and zeroes the outputs past <eos>, as padding does.
+    Since the cell is left-to-right, the outputs up to <eos> are the same as with packed sequences.
+    """
+    seq_hidden, _ = cell(emb)
+    not_eosed = torch.arange(emb.size(1), device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+    return seq_hidden * not_eosed.unsqueeze(2).to(seq_hidden.dtype)
+
+
 class RnnEncoder(nn.Module):
     """Feeds a sequence into an RNN (vanilla RNN, GRU, LSTM) cell and returns a vector representation
     of it, which is found as the last hidden state of the last RNN layer. Assumes that the eos token has the id equal to 0.
+
+    >>> encoder = RnnEncoder(vocab_size=5, embed_dim=4, n_hidden=3, cell='lstm', mode='packed')
+    >>> message = torch.tensor([[1, 2, 0, 0], [3, 4, 1, 0], [2, 0, 0, 0]])
+    >>> packed = encoder(message)
+    >>> encoder.execution.mode = 'masked'
+    >>> torch.allclose(packed, encoder(message), atol=1e-6)
+    True
     """
 
-    def __init__(self, vocab_size: int, embed_dim: int, n_hidden: int, cell: str = 'rnn', num_layers: int = 1) -> None:
+    def __init__(self, vocab_size: int, embed_dim: int, n_hidden: int, cell: str = 'rnn', num_layers: int = 1,
+                 mode: str = 'auto') -> None:
         """
         Arguments:
             vocab_size {int} -- The size of the input vocabulary (including eos)
@@ -25,8 +77,12 @@ class RnnEncoder(nn.Module):
         Keyword Arguments:
             cell {str} -- Type of the cell ('rnn', 'gru', or 'lstm') (default: {'rnn'})
             num_layers {int} -- Number of the stacked RNN layers (default: {1})
+            mode {str} -- 'packed' (pack_padded_sequence), 'masked' (the padded messages are fed and the output at
+                <eos> is gathered, no host synchronisation) or 'auto' (chosen from the fill ratio of the batches)
+                (default: {'auto'})
         """
         super(RnnEncoder, self).__init__()
+        self.execution = _ExecutionMode(mode)
 
         cell = cell.lower()
         cell_types = {'rnn': nn.RNN, 'gru': nn.GRU, 'lstm': nn.LSTM}
@@ -53,6 +109,12 @@ class RnnEncoder(nn.Module):
         if lengths is None:
             lengths = find_lengths(message)
 
+        if self.execution(lengths, message.size(1)) == 'masked':
+            # the output of the last layer at <eos> is its last hidden state
+            seq_hidden, _ = self.cell(emb)
+            index = (lengths - 1).view(-1, 1, 1).expand(-1, 1, seq_hidden.size(2))
+            return seq_hidden.gather(1, index).squeeze(1)
+
         packed = nn.utils.rnn.pack_padded_sequence(
             emb, lengths.detach().cpu(), batch_first=True, enforce_sorted=False)
         _, rnn_hidden = self.cell(packed)
@@ -71,9 +133,22 @@ class RnnEncoderImpatient(nn.Module):
     Feeds a sequence into an RNN (vanilla RNN, GRU, LSTM) cell and returns a vector representation
     of it for each reading position: it returns the hidden states of all the intermediate positions.
     Assumes that the eos token has the id equal to 0.
+
+    The positions past <eos> are zero and, in both modes, the returned sequence has the width of the messages.
+
+    >>> encoder = RnnEncoderImpatient(vocab_size=5, embed_dim=4, n_hidden=3, cell='gru', mode='packed')
+    >>> message = torch.tensor([[1, 2, 0, 0], [3, 4, 0, 0], [2, 0, 0, 0]])
+    >>> packed = encoder(message)
+    >>> encoder.execution.mode = 'masked'
+    >>> masked = encoder(message)
+    >>> packed.size(), masked.size()
+    (torch.Size([4, 3, 3]), torch.Size([4, 3, 3]))
+    >>> torch.allclose(packed, masked, atol=1e-6) and (masked[3] == 0).all().item()
+    True
     """
 
-    def __init__(self, vocab_size: int, embed_dim: int, n_hidden: int, cell: str = 'rnn', num_layers: int = 1) -> None:
+    def __init__(self, vocab_size: int, embed_dim: int, n_hidden: int, cell: str = 'rnn', num_layers: int = 1,
+                 mode: str = 'auto') -> None:
         """
         Arguments:
             vocab_size {int} -- The size of the input vocabulary (including eos)
@@ -83,8 +158,12 @@ class RnnEncoderImpatient(nn.Module):
         Keyword Arguments:
             cell {str} -- Type of the cell ('rnn', 'gru', or 'lstm') (default: {'rnn'})
             num_layers {int} -- Number of the stacked RNN layers (default: {1})
+            mode {str} -- 'packed' (pack_padded_sequence), 'masked' (the padded messages are fed and the outputs past
+                <eos> are zeroed, no host synchronisation) or 'auto' (chosen from the fill ratio of the batches)
+                (default: {'auto'})
         """
         super(RnnEncoderImpatient, self).__init__()
+        self.execution = _ExecutionMode(mode)
 
         cell = cell.lower()
         cell_types = {'rnn': nn.RNN, 'gru': nn.GRU, 'lstm': nn.LSTM}
@@ -104,25 +183,25 @@ class RnnEncoderImpatient(nn.Module):
         Keyword Arguments:
             lengths {Optional[torch.Tensor]} -- An optional Long tensor with messages' lengths. (default: {None})
         Returns:
-            torch.Tensor -- A float tensor of [B, H]
+            torch.Tensor -- A float tensor of [T, B, H]
         """
         emb = self.embedding(message)
 
         if lengths is None:
             lengths = find_lengths(message)
 
+        if self.execution(lengths, message.size(1)) == 'masked':
+            return _run_masked(self.cell, emb, lengths).transpose(0, 1)
+
         packed = nn.utils.rnn.pack_padded_sequence(
             emb, lengths.detach().cpu(), batch_first=True, enforce_sorted=False)
 
         packed_seq_hidden, rnn_hidden = self.cell(packed)
 
-        seq_hidden = nn.utils.rnn.pad_packed_sequence(packed_seq_hidden)
-
-
+        seq_hidden, _ = nn.utils.rnn.pad_packed_sequence(packed_seq_hidden, total_length=message.size(1))
 
         if isinstance(self.cell, nn.LSTM):
             rnn_hidden, _ = rnn_hidden
-            seq_hidden, _ = seq_hidden
 
 
 
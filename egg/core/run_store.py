@@ -0,0 +1,214 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import json
+import shutil
+from typing import Optional
+
+import numpy as np
+
+INDEX_FILE = 'index.json'
+FORMAT_VERSION = 1
+
+
+def symbol_dtype(vocab_size: int) -> np.dtype:
+    """
+    The smallest integer type holding the symbols of a vocabulary.
+
+    >>> symbol_dtype(40), symbol_dtype(1000)
+    (dtype('int8'), dtype('int16'))
+    """
+    if vocab_size <= np.iinfo(np.int8).max + 1:
+        return np.dtype(np.int8)
+    if vocab_size <= np.iinfo(np.int16).max + 1:
+        return np.dtype(np.int16)
+    return np.dtype(np.int32)
+
+
+def pad_messages(messages, width: int):
+    """
+    :param messages: a list of 1-D messages, cut after their eos
+    :returns the [n, width] messages padded with eos (0), and their lengths
+
+    >>> pad_messages([np.array([2, 0]), np.array([1, 1, 3])], 4)
+    (array([[2, 0, 0, 0],
+           [1, 1, 3, 0]]), array([2, 3]))
+    """
+    lengths = np.array([len(message) for message in messages], dtype=np.int64)
+    values = np.concatenate([np.asarray(message) for message in messages]) if messages else np.zeros(0, np.int64)
+    padded = np.zeros((len(messages), width), dtype=values.dtype)
+    padded[np.arange(width) < lengths[:, None]] = values
+    return padded, lengths
+
+
+class RunStoreWriter:
+    """
+    Appends a record per epoch to a run store: a directory holding one binary file per column (the rows of all the
+    records, one after the other, with a fixed shape and dtype) and an index, index.json, listing the columns and the
+    epochs of the records. The messages are stored as a fixed-width [n_inputs, max_len] symbol matrix padded with eos,
+    in the smallest integer type of the vocabulary, plus their lengths; the other columns (accuracy, predictions...)
+    are fixed-shape arrays whose shape and dtype are set by their first record.
+
+    The data files are only appended to, and the index is replaced atomically once a record is written: a run
+    interrupted in the middle of a record leaves a store that holds its previous records. Reopening a store (without
+    `overwrite`) appends to it, after dropping the rows that are not in its index.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'run')
+    >>> writer = RunStoreWriter(path, n_inputs=3, max_len=4, vocab_size=5)
+    >>> for epoch in range(3):
+    ...     messages = np.array([[1, 2, 0, 0], [3, 0, 0, 0], [4, 4, 4, 4]]) * (epoch > 0)
+    ...     writer.append(epoch, messages, lengths=np.array([3, 2, 4]), accuracy=np.array([1., 0., epoch / 2]))
+    >>> store = RunStore(path)
+    >>> store.epochs, store.read('messages').dtype, store.read('accuracy', 1, 3)[:, 2]
+    (array([0, 1, 2]), dtype('int8'), memmap([0.5, 1. ]))
+    >>> store.message_list(2)
+    [array([1, 2, 0], dtype=int8), array([3, 0], dtype=int8), array([4, 4, 4, 4], dtype=int8)]
+    >>> writer = RunStoreWriter(path, n_inputs=3, max_len=4, vocab_size=5)  # a resumed run appends to the store
+    >>> writer.rewind(2)  # from the epoch of its checkpoint
+    >>> RunStore(path).epochs
+    array([0, 1])
+    """
+    def __init__(self, path: str, n_inputs: int, max_len: int, vocab_size: int, overwrite: bool = False):
+        self.path = path
+        if overwrite and os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=True)
+
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+            if (self.index['n_inputs'], self.index['max_len']) != (n_inputs, max_len):
+                raise ValueError(f'The run store {path} holds {self.index["n_inputs"]} messages of at most '
+                                 f'{self.index["max_len"]} symbols, not {n_inputs} of at most {max_len}')
+            # rows written after the last update of the index belong to an interrupted record
+            for name, column in self.index['columns'].items():
+                with open(self._file(name), 'ab') as f:
+                    f.truncate(self._row_bytes(column) * len(self.index['epochs']))
+        else:
+            self.index = {'format': FORMAT_VERSION, 'n_inputs': n_inputs, 'max_len': max_len,
+                          'vocab_size': vocab_size, 'epochs': [], 'columns': {}}
+            self._add_column('messages', symbol_dtype(vocab_size), (n_inputs, max_len))
+            self._add_column('lengths', np.dtype(np.int16), (n_inputs,))
+            self._write_index()
+
+    def rewind(self, epoch: int) -> None:
+        """
+        Drops the records of `epoch` and of the following epochs, e.g. the ones written after the checkpoint a run is
+        resumed from.
+        """
+        n_records = sum(1 for e in self.index['epochs'] if e < epoch)
+        self.index['epochs'] = self.index['epochs'][:n_records]
+        self._write_index()
+        for name, column in self.index['columns'].items():
+            with open(self._file(name), 'ab') as f:
+                f.truncate(self._row_bytes(column) * n_records)
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    @staticmethod
+    def _row_bytes(column):
+        return np.dtype(column['dtype']).itemsize * int(np.prod(column['shape']))
+
+    def _add_column(self, name, dtype, shape):
+        if self.index['epochs']:
+            raise ValueError(f'The column {name} is not in the previous records of the run store {self.path}')
+        self.index['columns'][name] = {'dtype': np.dtype(dtype).str, 'shape': list(shape)}
+        open(self._file(name), 'wb').close()
+
+    def _write_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def append(self, epoch: int, messages: np.ndarray, lengths: np.ndarray, **columns: np.ndarray) -> None:
+        """
+        :param messages: the [n_inputs, T] messages, T <= max_len, padded with eos after their end
+        :param lengths: the [n_inputs] lengths of the messages, eos included
+        :param columns: the other arrays of the record, e.g. the accuracy of each input
+        """
+        if self.index['epochs'] and epoch <= self.index['epochs'][-1]:
+            raise ValueError(f'Epoch {epoch} follows epoch {self.index["epochs"][-1]} in the run store {self.path}')
+
+        messages = np.asarray(messages)
+        padded = np.zeros((self.index['n_inputs'], self.index['max_len']), dtype=messages.dtype)
+        padded[:, :messages.shape[1]] = messages
+        columns = dict(columns, messages=padded, lengths=np.asarray(lengths))
+
+        if set(columns) != set(self.index['columns']):
+            for name in set(columns) - set(self.index['columns']):
+                self._add_column(name, np.asarray(columns[name]).dtype, np.shape(columns[name]))
+            missing = set(self.index['columns']) - set(columns)
+            if missing:
+                raise ValueError(f'The record of epoch {epoch} misses the columns {sorted(missing)}')
+
+        rows = {}
+        for name, column in self.index['columns'].items():
+            value = np.asarray(columns[name])
+            if list(value.shape) != column['shape']:
+                raise ValueError(f'The {name} of epoch {epoch} have the shape {value.shape}, not {column["shape"]}')
+            rows[name] = np.ascontiguousarray(value, dtype=column['dtype'])
+
+        for name, row in rows.items():
+            with open(self._file(name), 'ab') as f:
+                f.write(row.tobytes())
+        self.index['epochs'].append(int(epoch))
+        self._write_index()
+
+
+class RunStore:
+    """
+    Reads a run store written by RunStoreWriter. The columns are memory-mapped: reading a range of epochs returns a
+    [n_epochs, ...] view of the files, without loading or unpickling them.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        if self.index['format'] > FORMAT_VERSION:
+            raise ValueError(f'Unknown run store format: {self.index["format"]}')
+
+        self.epochs = np.array(self.index['epochs'], dtype=np.int64)
+        self.n_inputs, self.max_len = self.index['n_inputs'], self.index['max_len']
+        self.columns = {}
+        for name, column in self.index['columns'].items():
+            shape = (len(self.epochs), *column['shape'])
+            if len(self.epochs) == 0:
+                self.columns[name] = np.zeros(shape, dtype=column['dtype'])
+            else:
+                self.columns[name] = np.memmap(os.path.join(path, name + '.bin'), dtype=column['dtype'], mode='r',
+                                               shape=shape)
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def _records(self, start: Optional[int], stop: Optional[int]) -> slice:
+        first = 0 if start is None else int(np.searchsorted(self.epochs, start, side='left'))
+        last = len(self.epochs) if stop is None else int(np.searchsorted(self.epochs, stop, side='left'))
+        return slice(first, last)
+
+    def read(self, name: str, start: Optional[int] = None, stop: Optional[int] = None) -> np.ndarray:
+        """
+        :returns the [n_epochs, ...] rows of the column `name` for the epochs in [start, stop)
+        """
+        return self.columns[name][self._records(start, stop)]
+
+    def record(self, epoch: int) -> int:
+        position = int(np.searchsorted(self.epochs, epoch))
+        if position == len(self.epochs) or self.epochs[position] != epoch:
+            raise KeyError(f'Epoch {epoch} is not in the run store {self.path}')
+        return position
+
+    def message_list(self, epoch: int):
+        """
+        :returns the messages of an epoch cut after their eos, as the per-epoch message files of the training scripts
+        """
+        position = self.record(epoch)
+        messages, lengths = self.columns['messages'][position], self.columns['lengths'][position]
+        return [message[:length] for message, length in zip(np.asarray(messages), lengths)]
@@ -6,6 +6,7 @@
 import os
 import uuid
 import pathlib
+import contextlib
 from typing import List, Optional
 
 import torch
@@ -14,20 +15,67 @@ from torch.optim.lr_scheduler import ReduceLROnPlateau, StepLR
 
 from .util import get_opts, move_to
 from .callbacks import Callback, ConsoleLogger, Checkpoint, CheckpointSaver
+from .prefetch import PrefetchLoader
+from .compile import compile_game
 
 
-def _add_dicts(a, b):
-    result = dict(a)
-    for k, v in b.items():
-        result[k] = result.get(k, 0) + v
-    return result
+class MetricsAccumulator:
+    """
+    Sums the loss and the `rest` dicts returned by the games over an epoch without leaving the device: tensors are
+    detached and added as they are, and the totals are materialised only once, by `compute`, with a single
+    host-device synchronisation.
+
+    >>> acc = MetricsAccumulator()
+    >>> acc.update(torch.tensor(1.0), {'acc': torch.tensor(0.5), 'aux': 2})
+    >>> acc.update(torch.tensor(3.0), {'acc': torch.tensor(1.0), 'aux': 4})
+    >>> acc.compute()
+    (2.0, {'acc': 0.75, 'aux': 3.0})
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.loss = 0.0
+        self.rest = {}
+        self.n_batches = 0
+
+    @staticmethod
+    def _detach(v):
+        return v.detach() if torch.is_tensor(v) else v
+
+    def update(self, loss, rest):
+        self.loss = self.loss + self._detach(loss)
+        for k, v in rest.items():
+            self.rest[k] = self.rest.get(k, 0) + self._detach(v)
+        self.n_batches += 1
+
+    def compute(self):
+        """
+        :returns the mean loss and the dict of mean metrics since the last reset, as Python floats
+        """
+        n = max(self.n_batches, 1)
+        totals = [self.loss] + list(self.rest.values())
+
+        on_device = [v.float().reshape(()) for v in totals if torch.is_tensor(v)]
+        if on_device:
+            synced = iter(torch.stack(on_device).tolist())
+            totals = [next(synced) if torch.is_tensor(v) else v for v in totals]
+        means = [float(v) / n for v in totals]
 
+        return means[0], dict(zip(self.rest.keys(), means[1:]))
 
-def _div_dict(d, n):
-    result = dict(d)
-    for k in result:
-        result[k] /= n
-    return result
+
+def _autocast(device, precision):
+    """
+    The context in which the games are run: with precision='bfloat16', the forward passes are autocast to bfloat16
+    (matrix products and RNN cells), while the agents compute their log-softmax, and hence the entropies, the
+    log-probabilities, the losses and the REINFORCE baselines, in float32.
+    """
+    if precision == 'float32':
+        return contextlib.nullcontext()
+    if precision == 'bfloat16':
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    raise ValueError(f"Unknown precision: {precision}")
 
 
 class Trainer:
@@ -62,12 +110,17 @@ class Trainer:
         self.validation_freq = common_opts.validation_freq
         self.device = common_opts.device if device is None else device
         self.game.to(self.device)
+        compile_game(self.game, common_opts.compile)
+        self.precision = common_opts.precision
+        if common_opts.prefetch > 0:
+            self.train_data = PrefetchLoader(train_data, n_batches=common_opts.prefetch, device=self.device)
         # NB: some optimizers pre-allocate buffers before actually doing any steps
         # since model is placed on GPU within Trainer, this leads to having optimizer's state and model parameters
         # on different devices. Here, we protect from that by moving optimizer's internal state to the proper device
         self.optimizer.state = move_to(self.optimizer.state, self.device)
         self.should_stop = False
         self.start_epoch = 0  # Can be overwritten by checkpoint loader
+        self.starting_epoch = None  # the epoch of the checkpoint the trainer is initialised from, if any
         self.callbacks = callbacks
 
         if common_opts.load_from_checkpoint is not None:
@@ -80,6 +133,8 @@ class Trainer:
             self.checkpoint_path = d
             self.load_from_latest(d)
             checkpointer = CheckpointSaver(self.checkpoint_path)
+            # the epochs of the next checkpoints follow the one of the checkpoint loaded
+            checkpointer.epoch_counter = self.starting_epoch or 0
             self.callbacks.append(checkpointer)
         else:
             self.checkpoint_path = None if common_opts.checkpoint_dir is None \
@@ -103,42 +158,31 @@ class Trainer:
         return d
 
     def eval(self):
-        mean_loss = 0.0
-        mean_rest = {}
-
-        n_batches = 0
+        metrics = MetricsAccumulator()
         self.game.eval()
         with torch.no_grad():
             for batch in self.validation_data:
                 batch = move_to(batch, self.device)
-                optimized_loss, rest = self.game(*batch)
-                mean_loss += optimized_loss
-                mean_rest = _add_dicts(mean_rest, rest)
-                n_batches += 1
-        mean_loss /= n_batches
-        mean_rest = _div_dict(mean_rest, n_batches)
+                with _autocast(self.device, self.precision):
+                    optimized_loss, rest = self.game(*batch)
+                metrics.update(optimized_loss, rest)
 
-        return mean_loss.item(), mean_rest
+        return metrics.compute()
 
     def train_epoch(self):
-        mean_loss = 0
-        mean_rest = {}
-        n_batches = 0
+        metrics = MetricsAccumulator()
         self.game.train()
         for batch in self.train_data:
             self.optimizer.zero_grad()
             batch = move_to(batch, self.device)
-            optimized_loss, rest = self.game(*batch)
-            mean_rest = _add_dicts(mean_rest, rest)
+            with _autocast(self.device, self.precision):
+                optimized_loss, rest = self.game(*batch)
             optimized_loss.backward()
             self.optimizer.step()
 
-            n_batches += 1
-            mean_loss += optimized_loss
+            metrics.update(optimized_loss, rest)
 
-        mean_loss /= n_batches
-        mean_rest = _div_dict(mean_rest, n_batches)
-        return mean_loss.item(), mean_rest
+        return metrics.compute()
 
     def train(self, n_epochs):
         for callback in self.callbacks:
@@ -226,12 +270,17 @@ class CompoTrainer:
         self.validation_freq = common_opts.validation_freq
         self.device = common_opts.device if device is None else device
         self.game.to(self.device)
+        compile_game(self.game, common_opts.compile)
+        self.precision = common_opts.precision
+        if common_opts.prefetch > 0:
+            self.train_data = PrefetchLoader(train_data, n_batches=common_opts.prefetch, device=self.device)
         # NB: some optimizers pre-allocate buffers before actually doing any steps
         # since model is placed on GPU within Trainer, this leads to having optimizer's state and model parameters
         # on different devices. Here, we protect from that by moving optimizer's internal state to the proper device
         self.optimizer.state = move_to(self.optimizer.state, self.device)
         self.should_stop = False
         self.start_epoch = 0  # Can be overwritten by checkpoint loader
+        self.starting_epoch = None  # the epoch of the checkpoint the trainer is initialised from, if any
         self.callbacks = callbacks
         self.n_attributes=n_attributes
         self.n_values=n_values
@@ -246,6 +295,8 @@ class CompoTrainer:
             self.checkpoint_path = d
             self.load_from_latest(d)
             checkpointer = CheckpointSaver(self.checkpoint_path)
+            # the epochs of the next checkpoints follow the one of the checkpoint loaded
+            checkpointer.epoch_counter = self.starting_epoch or 0
             self.callbacks.append(checkpointer)
         else:
             self.checkpoint_path = None if common_opts.checkpoint_dir is None \
@@ -269,42 +320,31 @@ class CompoTrainer:
         return d
 
     def eval(self):
-        mean_loss = 0.0
-        mean_rest = {}
-
-        n_batches = 0
+        metrics = MetricsAccumulator()
         self.game.eval()
         with torch.no_grad():
             for batch in self.validation_data:
                 batch = move_to(batch, self.device)
-                optimized_loss, rest = self.game(*batch)
-                mean_loss += optimized_loss
-                mean_rest = _add_dicts(mean_rest, rest)
-                n_batches += 1
-        mean_loss /= n_batches
-        mean_rest = _div_dict(mean_rest, n_batches)
+                with _autocast(self.device, self.precision):
+                    optimized_loss, rest = self.game(*batch)
+                metrics.update(optimized_loss, rest)
 
-        return mean_loss.item(), mean_rest
+        return metrics.compute()
 
     def train_epoch(self):
-        mean_loss = 0
-        mean_rest = {}
-        n_batches = 0
+        metrics = MetricsAccumulator()
         self.game.train()
         for batch in self.train_data:
             self.optimizer.zero_grad()
             batch = move_to(batch, self.device)
-            optimized_loss, rest = self.game(*batch)
-            mean_rest = _add_dicts(mean_rest, rest)
+            with _autocast(self.device, self.precision):
+                optimized_loss, rest = self.game(*batch)
             optimized_loss.backward()
             self.optimizer.step()
 
-            n_batches += 1
-            mean_loss += optimized_loss
+            metrics.update(optimized_loss, rest)
 
-        mean_loss /= n_batches
-        mean_rest = _div_dict(mean_rest, n_batches)
-        return mean_loss.item(), mean_rest
+        return metrics.compute()
 
     def train(self, n_epochs):
 
@@ -37,13 +37,138 @@ class SinusoidalPositionEmbedding(nn.Module):
         return x + t
 
 
+# 'torch': nn.MultiheadAttention over T x B x C inputs; 'sdpa': F.scaled_dot_product_attention over B x T x C inputs,
+# with the same parameters
+ATTENTION_BACKENDS = ['torch', 'sdpa']
+
+
+def _check_attention(attention):
+    if attention not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend: {attention}")
+
+
+def _split_heads(x, num_heads, batch_first=False):
+    # T x B x C (or B x T x C) -> B x H x T x C/H
+    if not batch_first:
+        x = x.transpose(0, 1)
+    batch_size, length, embed_dim = x.size()
+    return x.view(batch_size, length, num_heads, embed_dim // num_heads).transpose(1, 2)
+
+
+def _merge_heads(x, batch_first=False):
+    # B x H x T x C/H -> T x B x C (or B x T x C)
+    batch_size, num_heads, length, head_dim = x.size()
+    x = x.transpose(1, 2).reshape(batch_size, length, num_heads * head_dim)
+    return x if batch_first else x.transpose(0, 1)
+
+
+def _forbidden_positions(key_padding_mask=None, attn_mask=None):
+    """
+    Merges a key padding mask (B x S) and an attention mask (T x S), given in the nn.MultiheadAttention convention
+    (True or -inf for the positions that can't be attended to), into a boolean mask broadcastable to B x H x T x S.
+    """
+    mask = None
+    if attn_mask is not None:
+        mask = attn_mask if attn_mask.dtype == torch.bool else torch.isinf(attn_mask)
+    if key_padding_mask is not None:
+        padding = key_padding_mask.bool()[:, None, None, :]
+        mask = padding if mask is None else mask | padding
+    return mask
+
+
+def _project_key_value(attn, x, batch_first=False):
+    """Computes the keys and values of `attn` (nn.MultiheadAttention) for the inputs x, split by head"""
+    _, w_k, w_v = attn.in_proj_weight.chunk(3)
+    _, b_k, b_v = attn.in_proj_bias.chunk(3)
+    return (_split_heads(F.linear(x, w_k, b_k), attn.num_heads, batch_first),
+            _split_heads(F.linear(x, w_v, b_v), attn.num_heads, batch_first))
+
+
+def _attend(attn, query, keys, values, mask=None, batch_first=False, dropout=0.):
+    """
+    Same computation as `attn(query, key, value, attn_mask=mask)`, when the keys and values are already projected by
+    `_project_key_value`. The boolean `mask` is True for the positions that can't be attended to.
+    """
+    w_q, _, _ = attn.in_proj_weight.chunk(3)
+    b_q, _, _ = attn.in_proj_bias.chunk(3)
+    q = _split_heads(F.linear(query, w_q, b_q), attn.num_heads, batch_first)
+
+    x = F.scaled_dot_product_attention(q, keys, values, attn_mask=None if mask is None else ~mask, dropout_p=dropout)
+    return attn.out_proj(_merge_heads(x, batch_first))
+
+
+def _self_attend(attn, x, mask=None, is_causal=False, dropout=0.):
+    """
+    Same computation as `attn(x, x, x, attn_mask=mask)` for batch-first inputs, with a single projection for the
+    queries, keys and values. With `is_causal`, the left-to-right mask is applied without being materialised.
+    """
+    q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+    q, k, v = [_split_heads(t, attn.num_heads, batch_first=True) for t in (q, k, v)]
+
+    x = F.scaled_dot_product_attention(q, k, v, attn_mask=None if mask is None else ~mask, dropout_p=dropout,
+                                       is_causal=is_causal)
+    return attn.out_proj(_merge_heads(x, batch_first=True))
+
+
+# how the representative embedding of a message is taken in the causal regime
+POOLINGS = ['after_eos', 'eos', 'mean', 'first']
+
+
+def pool_embeddings(transformed, lengths, pooling='after_eos'):
+    """
+    Selects the representative embedding of each message with a single gather (or masked reduction), on device.
+
+    :param transformed: the embeddings of the symbols, B x T x C
+    :param lengths: the message lengths, including <eos>
+    :param pooling: one of 'after_eos' (the position following <eos>, clamped to the last one: the historical choice
+        of the causal TransformerEncoder), 'eos' (the <eos> symbol), 'mean' (the mean over the symbols up to and
+        including <eos>) or 'first' (the first symbol)
+
+    >>> transformed = torch.arange(12.).view(1, 4, 3).expand(2, -1, -1)
+    >>> lengths = torch.tensor([2, 4])
+    >>> pool_embeddings(transformed, lengths)
+    tensor([[ 6.,  7.,  8.],
+            [ 9., 10., 11.]])
+    >>> pool_embeddings(transformed, lengths, 'eos')
+    tensor([[ 3.,  4.,  5.],
+            [ 9., 10., 11.]])
+    >>> pool_embeddings(transformed, lengths, 'mean')
+    tensor([[1.5000, 2.5000, 3.5000],
+            [4.5000, 5.5000, 6.5000]])
+    """
+    if pooling not in POOLINGS:
+        raise ValueError(f"Unknown pooling: {pooling}")
+
+    batch_size, max_len, embed_dim = transformed.size()
+    if pooling == 'first':
+        return transformed[:, 0, :]
+    if pooling == 'mean':
+        not_eosed = torch.arange(max_len, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+        return (transformed * not_eosed.unsqueeze(2)).sum(1) / lengths.unsqueeze(1).to(transformed.dtype)
+
+    index = lengths if pooling == 'after_eos' else lengths - 1
+    index = index.clamp(max=max_len - 1).view(batch_size, 1, 1).expand(-1, 1, embed_dim)
+    return transformed.gather(1, index).squeeze(1)
+
+
 class TransformerEncoder(nn.Module):
     """Implements a Transformer Encoder. The masking is done based on the positions of the <eos>
     token (with id 0).
     Two regimes are implemented:
     * 'causal' (left-to-right): the symbols are masked such that every symbol's embedding only can depend on the
-        symbols to the left of it. The embedding of the <eos> symbol is taken as the representative.
+        symbols to the left of it. The representative embedding is selected by `pooling` (see `pool_embeddings`).
     *  'non-causal': a special symbol <sos> is pre-pended to the input sequence, all symbols before <eos> are un-masked.
+
+    The attention is computed either by nn.MultiheadAttention ('torch') or by F.scaled_dot_product_attention over
+    batch-first inputs ('sdpa'); both backends have the same parameters and outputs.
+
+    >>> torch_encoder = TransformerEncoder(vocab_size=5, max_len=4, embed_dim=8, num_heads=2, hidden_size=16)
+    >>> sdpa_encoder = TransformerEncoder(vocab_size=5, max_len=4, embed_dim=8, num_heads=2, hidden_size=16,
+    ...                                   attention='sdpa')
+    >>> _ = sdpa_encoder.load_state_dict(torch_encoder.state_dict())
+    >>> message = torch.tensor([[1, 2, 0, 0], [3, 1, 4, 0]])
+    >>> torch.allclose(torch_encoder(message), sdpa_encoder(message), atol=1e-6)
+    True
     """
     def __init__(self,
                  vocab_size: int,
@@ -53,8 +178,12 @@ class TransformerEncoder(nn.Module):
                  hidden_size: int,
                  num_layers: int = 1,
                  positional_embedding=True,
-                 causal: bool = True) -> None:
+                 causal: bool = True,
+                 attention: str = 'torch',
+                 pooling: str = 'after_eos') -> None:
         super().__init__()
+        if pooling not in POOLINGS:
+            raise ValueError(f"Unknown pooling: {pooling}")
 
         # in the non-causal case, we will use a special symbol prepended to the input messages which would have
         # term id of `vocab_size`. Hence we increase the vocab size and the max length
@@ -68,10 +197,15 @@ class TransformerEncoder(nn.Module):
                                                    num_heads=num_heads,
                                                    num_layers=num_layers,
                                                    hidden_size=hidden_size,
-                                                   positional_embedding=positional_embedding)
+                                                   positional_embedding=positional_embedding,
+                                                   attention=attention)
         self.max_len = max_len
         self.sos_id = torch.tensor([vocab_size - 1]).long()
         self.causal = causal
+        self.pooling = pooling
+
+        causal_mask = torch.triu(torch.ones(max_len, max_len, dtype=torch.bool), diagonal=1)
+        self.register_buffer('causal_mask', causal_mask, persistent=False)
 
     def forward(self, message: torch.Tensor, lengths: Optional[torch.Tensor] = None) -> torch.Tensor:
         if lengths is None:
@@ -96,21 +230,15 @@ class TransformerEncoder(nn.Module):
             transformed = transformed[:, 0, :]
         else:
             max_len = message.size(1)
-            len_indicators = torch.arange(max_len).expand(
-                (batch_size, max_len)).to(lengths.device)
+            len_indicators = torch.arange(max_len, device=lengths.device).expand((batch_size, max_len))
             lengths_expanded = lengths.unsqueeze(1)
             padding_mask = len_indicators >= lengths_expanded
 
-            attn_mask = torch.triu(torch.ones(
-                max_len, max_len).byte(), diagonal=1).to(lengths.device)
-            attn_mask = attn_mask.float().masked_fill(attn_mask == 1, float('-inf'))
+            attn_mask = self.causal_mask[:max_len, :max_len]
             transformed = self.base_encoder(
                 message, key_padding_mask=padding_mask, attn_mask=attn_mask)
 
-            last_embeddings = []
-            for i, l in enumerate(lengths.clamp(max=self.max_len-1).cpu()):
-                last_embeddings.append(transformed[i, l, :])
-            transformed = torch.stack(last_embeddings)
+            transformed = pool_embeddings(transformed, lengths, self.pooling)
 
         return transformed
 
@@ -125,8 +253,11 @@ class TransformerBaseEncoder(torch.nn.Module):
 
     def __init__(self, vocab_size, max_len, embed_dim, num_heads, num_layers, hidden_size,
                  p_dropout=0.0,
-                 positional_embedding=True):
+                 positional_embedding=True,
+                 attention='torch'):
         super().__init__()
+        _check_attention(attention)
+        self.attention = attention
 
         # NB: they use a different one
         self.embedding = nn.Embedding(vocab_size, embed_dim)
@@ -142,7 +273,8 @@ class TransformerBaseEncoder(torch.nn.Module):
             TransformerEncoderLayer(
                 embed_dim=embed_dim,
                 num_heads=num_heads,
-                hidden_size=hidden_size
+                hidden_size=hidden_size,
+                attention=attention
             )
             for _ in range(num_layers)
         ])
@@ -163,6 +295,13 @@ class TransformerBaseEncoder(torch.nn.Module):
             x = self.embed_positions(x)
         x = F.dropout(x, p=self.dropout, training=self.training)
 
+        if self.attention == 'sdpa':
+            # the layers are batch-first, the masks are merged once
+            mask = _forbidden_positions(key_padding_mask, attn_mask)
+            for layer in self.layers:
+                x = layer(x, attn_mask=mask)
+            return self.layer_norm(x)
+
         # B x T x C -> T x B x C
         x = x.transpose(0, 1)
 
@@ -179,8 +318,11 @@ class TransformerBaseEncoder(torch.nn.Module):
 
 
 class TransformerEncoderLayer(nn.Module):
-    def __init__(self, embed_dim, num_heads, hidden_size, dropout=0.0, attention_dropout=0.0, activation_dropout=0.0):
+    def __init__(self, embed_dim, num_heads, hidden_size, dropout=0.0, attention_dropout=0.0, activation_dropout=0.0,
+                 attention='torch'):
         super().__init__()
+        _check_attention(attention)
+        self.attention = attention
         self.embed_dim = embed_dim
 
         self.self_attn = torch.nn.MultiheadAttention(embed_dim=self.embed_dim, num_heads=num_heads,
@@ -200,10 +342,15 @@ class TransformerEncoderLayer(nn.Module):
         self.init_parameters()
 
     def forward(self, x, key_padding_mask=None, attn_mask=None):
+        """x is T x B x C with the 'torch' attention and B x T x C with 'sdpa'"""
         residual = x
         x = self.self_attn_layer_norm(x)
-        x, _att = self.self_attn(
-            query=x, key=x, value=x, key_padding_mask=key_padding_mask, attn_mask=attn_mask)
+        if self.attention == 'sdpa':
+            x = _self_attend(self.self_attn, x, _forbidden_positions(key_padding_mask, attn_mask),
+                             dropout=self.self_attn.dropout if self.training else 0.)
+        else:
+            x, _att = self.self_attn(
+                query=x, key=x, value=x, key_padding_mask=key_padding_mask, attn_mask=attn_mask)
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
 
@@ -227,11 +374,30 @@ class TransformerDecoder(torch.nn.Module):
     """
     Does not handle the masking w.r.t. message lengths, left-to-right order, etc.
     This is supposed to be done on a higher level.
+
+    Besides the full `forward`, the decoder can be run incrementally over a causally-masked sequence with
+    `forward_incremental`: the self-attention keys and values of the previous positions are cached per layer, so that
+    every call only processes the newest positions.
+
+    >>> decoder = TransformerDecoder(embed_dim=8, max_len=5, num_layers=2, num_heads=2, hidden_size=16).eval()
+    >>> embedded, encoder_out = torch.randn(3, 4, 8), torch.randn(3, 8)
+    >>> full = decoder(embedded, encoder_out, attn_mask=decoder.causal_mask[:4, :4])
+    >>> caches = decoder.init_caches()
+    >>> steps = [decoder.forward_incremental(embedded[:, i:i+1], encoder_out, caches) for i in range(4)]
+    >>> torch.allclose(full, torch.cat(steps, dim=1), atol=1e-5)
+    True
+    >>> sdpa_decoder = TransformerDecoder(embed_dim=8, max_len=5, num_layers=2, num_heads=2, hidden_size=16,
+    ...                                   attention='sdpa').eval()
+    >>> _ = sdpa_decoder.load_state_dict(decoder.state_dict())
+    >>> torch.allclose(full, sdpa_decoder(embedded, encoder_out, is_causal=True), atol=1e-5)
+    True
     """
 
     def __init__(self, embed_dim, max_len, num_layers,
-                 num_heads, hidden_size, dropout=0.0):
+                 num_heads, hidden_size, dropout=0.0, attention='torch'):
         super().__init__()
+        _check_attention(attention)
+        self.attention = attention
 
         self.dropout = dropout
 
@@ -239,18 +405,39 @@ class TransformerDecoder(torch.nn.Module):
 
         self.layers = nn.ModuleList([])
         self.layers.extend([
-            TransformerDecoderLayer(num_heads, embed_dim, hidden_size)
+            TransformerDecoderLayer(num_heads, embed_dim, hidden_size, attention=attention)
             for _ in range(num_layers)
         ])
 
         self.layer_norm = torch.nn.LayerNorm(embed_dim)
 
-    def forward(self, embedded_input, encoder_out, key_mask=None, attn_mask=None):
+        # True above the diagonal: the positions a symbol can't attend to in the left-to-right order
+        causal_mask = torch.triu(torch.ones(max_len, max_len, dtype=torch.bool), diagonal=1)
+        self.register_buffer('causal_mask', causal_mask, persistent=False)
+
+    def forward(self, embedded_input, encoder_out, key_mask=None, attn_mask=None, is_causal=False):
+        """
+        :param is_causal: apply the left-to-right mask, in place of `attn_mask`
+        """
+        batch_first = self.attention == 'sdpa'
+        if is_causal and (not batch_first or key_mask is not None):
+            length = embedded_input.size(1)
+            attn_mask, is_causal = self.causal_mask[:length, :length], False
+
+        # the encoder state can be passed as a single vector per sequence
+        if encoder_out.dim() == 2:
+            encoder_out = encoder_out.unsqueeze(1 if batch_first else 0)
+
         # embed positions
         embedded_input = self.embed_positions(embedded_input)
 
         x = F.dropout(embedded_input, p=self.dropout, training=self.training)
 
+        if batch_first:
+            for layer in self.layers:
+                x, attn = layer(x, encoder_out, key_mask=key_mask, attn_mask=attn_mask, is_causal=is_causal)
+            return self.layer_norm(x)
+
         # B x T x C -> T x B x C
         x = x.transpose(0, 1)
 
@@ -266,13 +453,48 @@ class TransformerDecoder(torch.nn.Module):
 
         return x
 
+    def init_caches(self):
+        """Empty per-layer caches for `forward_incremental`"""
+        return [{} for _ in self.layers]
+
+    def forward_incremental(self, embedded_input, encoder_out, caches, n_committed=None):
+        """
+        Runs the decoder with a causal mask over the newest positions `embedded_input` (B x T_new x C) of a sequence
+        whose previous positions are held in `caches` (as returned by `init_caches`).
+        :param n_committed: number of leading new positions added to the caches (default: all of them); the
+            remaining ones are only used as queries at this step
+        :returns the outputs for the new positions, B x T_new x C
+        """
+        # the incremental path is batch-first, whatever the attention backend
+        if encoder_out.dim() == 2:
+            encoder_out = encoder_out.unsqueeze(1)
+        if n_committed is None:
+            n_committed = embedded_input.size(1)
+
+        n_past = caches[0]['self_k'].size(2) if 'self_k' in caches[0] else 0
+        n_new = embedded_input.size(1)
+
+        x = embedded_input + self.embed_positions.pe[:, n_past:n_past + n_new, :]
+        x = F.dropout(x, p=self.dropout, training=self.training)
+
+        # a single new position can attend to every cached one
+        attn_mask = self.causal_mask[n_past:n_past + n_new, :n_past + n_new] if n_new > 1 else None
+
+        for layer, cache in zip(self.layers, caches):
+            x = layer.forward_incremental(x, encoder_out, cache, n_committed, attn_mask)
+
+        return self.layer_norm(x)
+
 
 class TransformerDecoderLayer(nn.Module):
     """Decoder layer block. Follows an implementation in fairseq with args.decoder_normalize_before=True,
     i.e. order of operations is different from those in the original paper.
     """
-    def __init__(self, num_heads, embed_dim, hidden_size, dropout=0.0, attention_dropout=0.0, activation_dropout=0.0):
+    def __init__(self, num_heads, embed_dim, hidden_size, dropout=0.0, attention_dropout=0.0, activation_dropout=0.0,
+                 attention='torch'):
         super().__init__()
+        _check_attention(attention)
+        self.attention = attention
 
         self.embed_dim = embed_dim
         self.self_attn = torch.nn.MultiheadAttention(
@@ -313,7 +535,12 @@ class TransformerDecoderLayer(nn.Module):
                 x,
                 encoder_out,
                 key_mask=None,
-                attn_mask=None):
+                attn_mask=None,
+                is_causal=False):
+        """x and encoder_out are T x B x C with the 'torch' attention and B x T x C with 'sdpa'"""
+        if self.attention == 'sdpa':
+            return self._forward_sdpa(x, encoder_out, _forbidden_positions(key_mask, attn_mask), is_causal)
+
         residual = x
         x = self.self_attn_layer_norm(x)
         x, attn = self.self_attn(
@@ -333,11 +560,35 @@ class TransformerDecoderLayer(nn.Module):
             query=x,
             key=encoder_out,
             value=encoder_out,
-            static_kv=True,
         )
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
 
+        x = self.feed_forward(x)
+
+        return x, attn
+
+    def _forward_sdpa(self, x, encoder_out, mask, is_causal):
+        self_dropout = self.self_attn.dropout if self.training else 0.
+        encoder_dropout = self.encoder_attn.dropout if self.training else 0.
+
+        residual = x
+        x = self.self_attn_layer_norm(x)
+        x = _self_attend(self.self_attn, x, mask, is_causal=is_causal, dropout=self_dropout)
+        x = F.dropout(x, p=self.dropout, training=self.training)
+        x = residual + x
+
+        residual = x
+        x = self.encoder_attn_layer_norm(x)
+        keys, values = _project_key_value(self.encoder_attn, encoder_out, batch_first=True)
+        x = _attend(self.encoder_attn, x, keys, values, batch_first=True, dropout=encoder_dropout)
+        x = F.dropout(x, p=self.dropout, training=self.training)
+        x = residual + x
+
+        # the attention weights are not computed by scaled_dot_product_attention
+        return self.feed_forward(x), None
+
+    def feed_forward(self, x):
         residual = x
         x = self.layer_norm(x)
 
@@ -347,4 +598,34 @@ class TransformerDecoderLayer(nn.Module):
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
 
-        return x, attn
+        return x
+
+    def forward_incremental(self, x, encoder_out, cache, n_committed, attn_mask=None):
+        """
+        Same as `forward` for the newest positions x (B x T_new x C), the keys and values of the previous positions
+        being read from `cache`. The keys and values of the first `n_committed` new positions are appended to it,
+        the encoder keys and values are computed once, at the first step.
+        """
+        residual = x
+        x = self.self_attn_layer_norm(x)
+
+        keys, values = _project_key_value(self.self_attn, x, batch_first=True)
+        if 'self_k' in cache:
+            keys = torch.cat([cache['self_k'], keys], dim=2)
+            values = torch.cat([cache['self_v'], values], dim=2)
+        n_kept = keys.size(2) - x.size(1) + n_committed
+        cache['self_k'], cache['self_v'] = keys[:, :, :n_kept], values[:, :, :n_kept]
+
+        x = _attend(self.self_attn, x, keys, values, attn_mask, batch_first=True)
+        x = F.dropout(x, p=self.dropout, training=self.training)
+        x = residual + x
+
+        residual = x
+        x = self.encoder_attn_layer_norm(x)
+        if 'encoder_k' not in cache:
+            cache['encoder_k'], cache['encoder_v'] = _project_key_value(self.encoder_attn, encoder_out, batch_first=True)
+        x = _attend(self.encoder_attn, x, cache['encoder_k'], cache['encoder_v'], batch_first=True)
+        x = F.dropout(x, p=self.dropout, training=self.training)
+        x = residual + x
+
+        return self.feed_forward(x)
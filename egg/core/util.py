@@ -3,7 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import Union, Iterable, List, Optional, Any
+from typing import Union, Iterable, List, Optional, Any, Callable, NamedTuple
 
 import sys
 import random
@@ -43,6 +43,18 @@ def _populate_cl_params(arg_parser: argparse.ArgumentParser) -> argparse.Argumen
     # dataset
     arg_parser.add_argument('--batch_size', type=int, default=32,
                         help='Input batch size for training (default: 32)')
+    arg_parser.add_argument('--prefetch', type=int, default=0,
+                        help='Number of training batches generated ahead on a background thread and handed to the '
+                             'Trainer already on the device; 0 disables prefetching (default: 0)')
+
+    # compilation and precision
+    arg_parser.add_argument('--compile', type=str, default='none', choices=['none', 'agents', 'game'],
+                            help='Compile the game with torch.compile: none, the agents only, or the whole game; a '
+                                 'module that cannot be compiled runs eagerly (default: none)')
+
+    arg_parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'bfloat16'],
+                            help='Precision of the forward passes: with bfloat16, they are autocast while the '
+                                 'log-softmax, losses and baselines stay in float32 (default: float32)')
 
     # optimizer
     arg_parser.add_argument('--optimizer', type=str, default='adam',
@@ -169,174 +181,307 @@ def _set_seed(seed) -> None:
         torch.cuda.manual_seed_all(seed)
 
 
-def dump_sender_receiver(game: torch.nn.Module,
-                         dataset: 'torch.utils.data.DataLoader',
-                         gs: bool, variable_length: bool,
-                         device: Optional[torch.device] = None,
-                         impatient = False):
+class Dump(NamedTuple):
     """
-    A tool to dump the interaction between Sender and Receiver
-    :param game: A Game instance
-    :param dataset: Dataset of inputs to be used when analyzing the communication
-    :param gs: whether Gumbel-Softmax relaxation was used during training
-    :param variable_length: whether variable-length communication is used
-    :param device: device (e.g. 'cuda') to be used
-    :return:
+    The interactions of a game on a set of inputs. The messages are stored in a ragged format: the symbols of the
+    i-th message, eos included, are message_values[message_offsets[i]:message_offsets[i + 1]].
+
+    :param receiver_output: the output of Receiver for each input, read at the eos of the message for per-position
+        Receivers (Impatient Listeners, Gumbel-Softmax Receivers)
+    :param predictions: the argmax of the output of Receiver at every position of the messages, or None
     """
-    train_state = game.training  # persist so we restore it back
-    game.eval()
+    sender_input: Any
+    receiver_input: Any
+    labels: Any
+    message_values: torch.Tensor
+    message_offsets: torch.Tensor
+    receiver_output: torch.Tensor
+    predictions: Optional[torch.Tensor]
 
-    device = device if device is not None else common_opts.device
+    @property
+    def message_lengths(self) -> torch.Tensor:
+        return self.message_offsets[1:] - self.message_offsets[:-1]
 
-    sender_inputs, messages, receiver_inputs, receiver_outputs = [], [], [], []
-    labels = []
+    def messages(self) -> List[torch.Tensor]:
+        """
+        :returns the messages as a list of tensors, as the dump_* functions do
+        """
+        return list(self.message_values.split(self.message_lengths.tolist()))
 
-    with torch.no_grad():
-        for batch in dataset:
-            # by agreement, each batch is (sender_input, labels) plus optional (receiver_input)
-            sender_input = move_to(batch[0], device)
-            receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
+    def padded_messages(self, width: Optional[int] = None) -> torch.Tensor:
+        """
+        :returns the [N, width] messages, padded with eos (0) after their end
+        """
+        lengths = self.message_lengths
+        width = width if width is not None else int(lengths.max())
+        in_message = torch.arange(width, device=lengths.device) < lengths.unsqueeze(1)
+        padded = self.message_values.new_zeros(lengths.size(0), width)
+        padded[in_message] = self.message_values
+        return padded
 
-            message = game.sender(sender_input)
 
-            # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
-            # We don't need them.
-            if not gs: message = message[0]
+def ragged_messages(messages: torch.Tensor, lengths: torch.Tensor):
+    """
+    Cuts the [N, T] messages at their lengths and concatenates them.
 
-            #if impatient:
-            #   output=output[:,0,:]
+    :returns the values (the symbols of all the messages, one after the other) and the [N + 1] offsets of the
+        messages in the values
 
-            output = game.receiver(message, receiver_input)
-            if not gs: output = output[0]
+    >>> values, offsets = ragged_messages(torch.tensor([[3, 0, 0], [1, 2, 0], [4, 4, 4]]), torch.tensor([1, 3, 3]))
+    >>> values, offsets
+    (tensor([3, 1, 2, 0, 4, 4, 4]), tensor([0, 1, 4, 7]))
+    """
+    in_message = torch.arange(messages.size(1), device=messages.device) < lengths.unsqueeze(1)
+    offsets = torch.cat([lengths.new_zeros(1), lengths.cumsum(0)])
+    return messages[in_message], offsets
 
-            if batch[1] is not None:
-                labels.extend(batch[1])
 
-            if isinstance(sender_input, list) or isinstance(sender_input, tuple):
-                sender_inputs.extend(zip(*sender_input))
-            else:
-                sender_inputs.extend(sender_input)
+def _rows(x, start, end):
+    if x is None:
+        return None
+    if isinstance(x, list) or isinstance(x, tuple):
+        return [_rows(y, start, end) for y in x]
+    return x[start:end]
 
-            if receiver_input is not None:
-                receiver_inputs.extend(receiver_input)
 
-            if gs: message = message.argmax(dim=-1)  # actual symbols instead of one-hot encoded
+def _cat_rows(parts):
+    if parts[0] is None:
+        return None
+    if isinstance(parts[0], list) or isinstance(parts[0], tuple):
+        return [_cat_rows(x) for x in zip(*parts)]
+    return torch.cat(parts)
 
-            if not variable_length:
-                messages.extend(message)
-                receiver_outputs.extend(output)
-            else:
-                # A trickier part is to handle EOS in the messages. It also might happen that not every message has EOS.
-                # We cut messages at EOS if it is present or return the entire message otherwise. Note, EOS id is always
-                # set to 0.
 
-                for i in range(message.size(0)):
-                    eos_positions = (message[i, :] == 0).nonzero()
-                    message_end = eos_positions[0].item() if eos_positions.size(0) > 0 else -1
-                    assert message_end == -1 or message[i, message_end] == 0
-                    if message_end < 0:
-                        messages.append(message[i, :])
-                    else:
-                        messages.append(message[i, :message_end + 1])
+def _n_rows(x):
+    return _n_rows(x[0]) if isinstance(x, list) or isinstance(x, tuple) else x.size(0)
 
-                    if gs:
-                        receiver_outputs.append(output[i, message_end, ...])
-                    else:
-                        receiver_outputs.append(output[i, ...])
 
-    game.train(mode=train_state)
+def _dump_rows(game, sender_input, receiver_input, labels, gs, variable_length, per_position, with_predictions,
+               message_transform):
+    message = game.sender(sender_input)
+    # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
+    if not gs: message = message[0]
+    if message_transform is not None:
+        message = message_transform(message)
 
-    return sender_inputs, messages, receiver_inputs, receiver_outputs, labels
+    output = game.receiver(message, receiver_input)
+    if not gs: output = output[0]
 
-def dump_sender_receiver_test(game: torch.nn.Module,
-                              dataset: 'torch.utils.data.DataLoader',
-                              gs: bool, variable_length: bool,
-                              device: Optional[torch.device] = None,
-                              pos_min=0,
-                              pos_max=10):
-    """
-    A tool to dump the interaction between Sender and Receiver
+    if gs: message = message.argmax(dim=-1)  # actual symbols instead of one-hot encoded
+    if variable_length:
+        lengths = find_lengths(message)
+    else:
+        lengths = torch.full((message.size(0),), message.size(1), dtype=torch.long, device=message.device)
+
+    predictions = None
+    if with_predictions:
+        # chunked Impatient outputs compute their argmax chunk by chunk
+        predictions = output.predictions() if hasattr(output, 'predictions') else output.argmax(dim=-1)
+
+    if per_position:
+        rows, ends = torch.arange(message.size(0), device=message.device), lengths - 1
+        if hasattr(output, 'with_hidden'):
+            output = output.with_hidden(output.hidden[rows, ends].unsqueeze(1)).materialize().squeeze(1)
+        else:
+            output = output[rows, ends]
+
+    message_values, message_offsets = ragged_messages(message, lengths)
+    return Dump(sender_input, receiver_input, labels, message_values, message_offsets, output, predictions)
+
+
+def iter_dump(game: torch.nn.Module,
+              dataset: 'torch.utils.data.DataLoader',
+              gs: bool = False, variable_length: bool = True,
+              per_position: bool = False, with_predictions: bool = False,
+              message_transform: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+              chunk_size: int = 0,
+              device: Optional[torch.device] = None) -> Iterable[Dump]:
+    """
+    Dumps the interaction between Sender and Receiver, batch by batch: each batch of the dataset is run through the
+    game at once (by chunks of at most `chunk_size` inputs if chunk_size > 0, which bounds the memory used by large
+    input spaces), and its messages are cut at eos with find_lengths.
     :param game: A Game instance
     :param dataset: Dataset of inputs to be used when analyzing the communication
     :param gs: whether Gumbel-Softmax relaxation was used during training
     :param variable_length: whether variable-length communication is used
+    :param per_position: whether Receiver has an output per position of the message (Impatient Listener or
+        Gumbel-Softmax Receiver), read at the eos of the message
+    :param with_predictions: whether the argmax of the outputs of Receiver at every position is dumped
+    :param message_transform: applied to the messages of Sender before they are fed to Receiver
     :param device: device (e.g. 'cuda') to be used
-    :return:
+    :return: a Dump per chunk
     """
     train_state = game.training  # persist so we restore it back
     game.eval()
 
     device = device if device is not None else common_opts.device
 
-    sender_inputs, messages, receiver_inputs, receiver_outputs = [], [], [], []
-    labels = []
-
-    with torch.no_grad():
-        for batch in dataset:
-            # by agreement, each batch is (sender_input, labels) plus optional (receiver_input)
-            sender_input = move_to(batch[0], device)
-            receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
-
-            message = game.sender(sender_input)
-
-            # ETUDE DES POSITIONS
-            if pos_min>-1 and pos_max>-1:
-                for j in range(message[0].size()[0]):
-                    for k in range(pos_min,pos_max):
-                        message[0][j,k]=np.random.randint(20)
-
-            # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
-            # We don't need them.
-            if not gs: message = message[0]
-
-            output = game.receiver(message, receiver_input)
-            if not gs: output = output[0]
-
-            if batch[1] is not None:
-                labels.extend(batch[1])
-
-            if isinstance(sender_input, list) or isinstance(sender_input, tuple):
-                sender_inputs.extend(zip(*sender_input))
-            else:
-                sender_inputs.extend(sender_input)
-
-            if receiver_input is not None:
-                receiver_inputs.extend(receiver_input)
+    try:
+        with torch.no_grad():
+            for batch in dataset:
+                # by agreement, each batch is (sender_input, labels) plus optional (receiver_input)
+                sender_input = move_to(batch[0], device)
+                receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
+
+                n_inputs = _n_rows(sender_input)
+                step = chunk_size if chunk_size > 0 else n_inputs
+                for start in range(0, n_inputs, step):
+                    yield _dump_rows(game, _rows(sender_input, start, start + step),
+                                     _rows(receiver_input, start, start + step), _rows(batch[1], start, start + step),
+                                     gs, variable_length, per_position, with_predictions, message_transform)
+    finally:
+        game.train(mode=train_state)
+
+
+def dump_interactions(game: torch.nn.Module,
+                      dataset: 'torch.utils.data.DataLoader',
+                      gs: bool = False, variable_length: bool = True,
+                      per_position: bool = False, with_predictions: bool = False,
+                      message_transform: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+                      chunk_size: int = 0,
+                      device: Optional[torch.device] = None) -> Dump:
+    """
+    Dumps the interaction between Sender and Receiver on the whole dataset, see iter_dump for the parameters.
+
+    >>> from .reinforce_wrappers import RnnSenderReinforce, RnnReceiverImpatient
+    >>> class Game(torch.nn.Module):
+    ...     def __init__(self):
+    ...         super().__init__()
+    ...         self.sender = RnnSenderReinforce(torch.nn.Linear(6, 8), vocab_size=5, embed_dim=4, hidden_size=8,
+    ...                                          max_len=4)
+    ...         self.receiver = RnnReceiverImpatient(None, vocab_size=5, embed_dim=4, hidden_size=8, max_len=4,
+    ...                                              n_features=6)
+    >>> game = Game()
+    >>> dump = dump_interactions(game, [[torch.eye(6), None]], per_position=True, with_predictions=True,
+    ...                          chunk_size=4, device='cpu')
+    >>> dump.message_offsets.size(), dump.receiver_output.size(), dump.predictions.size()
+    (torch.Size([7]), torch.Size([6, 6]), torch.Size([6, 4]))
+    >>> _ = game.eval()  # greedy messages, as in the dump
+    >>> messages = game.sender(torch.eye(6))[0]
+    >>> lengths = find_lengths(messages)
+    >>> [torch.equal(x, m[:n]) for x, m, n in zip(dump.messages(), messages, lengths)] == [True] * 6
+    True
+    >>> torch.equal(dump.predictions[torch.arange(6), lengths - 1], dump.receiver_output.argmax(dim=1))
+    True
+    >>> torch.equal(dump.padded_messages(4), messages * (torch.arange(4) < lengths.unsqueeze(1)))
+    True
+    """
+    chunks = list(iter_dump(game, dataset, gs=gs, variable_length=variable_length, per_position=per_position,
+                            with_predictions=with_predictions, message_transform=message_transform,
+                            chunk_size=chunk_size, device=device))
+
+    offsets = [chunks[0].message_offsets[:1]]
+    for chunk in chunks:
+        offsets.append(chunk.message_offsets[1:] + offsets[-1][-1])
+
+    return Dump(sender_input=_cat_rows([chunk.sender_input for chunk in chunks]),
+                receiver_input=_cat_rows([chunk.receiver_input for chunk in chunks]),
+                labels=_cat_rows([chunk.labels for chunk in chunks]),
+                message_values=torch.cat([chunk.message_values for chunk in chunks]),
+                message_offsets=torch.cat(offsets),
+                receiver_output=torch.cat([chunk.receiver_output for chunk in chunks]),
+                predictions=_cat_rows([chunk.predictions for chunk in chunks]))
+
+
+def _as_lists(dump: Dump):
+    # the format of the dump_* functions: lists of per-input rows
+    if isinstance(dump.sender_input, list) or isinstance(dump.sender_input, tuple):
+        sender_inputs = list(zip(*dump.sender_input))
+    else:
+        sender_inputs = list(dump.sender_input)
+    receiver_inputs = list(dump.receiver_input) if dump.receiver_input is not None else []
+    labels = list(dump.labels) if dump.labels is not None else []
 
-            if gs: message = message.argmax(dim=-1)  # actual symbols instead of one-hot encoded
+    return sender_inputs, dump.messages(), receiver_inputs, list(dump.receiver_output), labels
 
-            if not variable_length:
-                messages.extend(message)
-                receiver_outputs.extend(output)
-            else:
-                # A trickier part is to handle EOS in the messages. It also might happen that not every message has EOS.
-                # We cut messages at EOS if it is present or return the entire message otherwise. Note, EOS id is always
-                # set to 0.
 
-                for i in range(message.size(0)):
-                    eos_positions = (message[i, :] == 0).nonzero()
-                    message_end = eos_positions[0].item() if eos_positions.size(0) > 0 else -1
-                    assert message_end == -1 or message[i, message_end] == 0
-                    if message_end < 0:
-                        messages.append(message[i, :])
-                    else:
-                        messages.append(message[i, :message_end + 1])
+def _substitute_position(position: int, voc_size: int):
+    # replaces the symbol at `position` by a random non-eos symbol
+    def transform(message):
+        message = message.clone()
+        symbols = np.random.randint(1, voc_size, size=message.size(0))
+        message[:, position] = torch.from_numpy(symbols).to(message)
+        return message
+    return transform
 
-                    if gs:
-                        receiver_outputs.append(output[i, message_end, ...])
-                    else:
-                        receiver_outputs.append(output[i, ...])
 
-    game.train(mode=train_state)
+def dump_sender_receiver(game: torch.nn.Module,
+                         dataset: 'torch.utils.data.DataLoader',
+                         gs: bool, variable_length: bool,
+                         device: Optional[torch.device] = None,
+                         impatient = False):
+    """
+    A tool to dump the interaction between Sender and Receiver
+    :param game: A Game instance
+    :param dataset: Dataset of inputs to be used when analyzing the communication
+    :param gs: whether Gumbel-Softmax relaxation was used during training
+    :param variable_length: whether variable-length communication is used
+    :param device: device (e.g. 'cuda') to be used
+    :return:
+    """
+    # It also might happen that not every message has EOS: we cut messages at EOS if it is present or return the
+    # entire message otherwise. Note, EOS id is always set to 0.
+    dump = dump_interactions(game, dataset, gs=gs, variable_length=variable_length,
+                             per_position=gs and variable_length, device=device)
+    return _as_lists(dump)
 
-    return sender_inputs, messages, receiver_inputs, receiver_outputs, labels
+def dump_sender_receiver_test(game: torch.nn.Module,
+                              dataset: 'torch.utils.data.DataLoader',
+                              gs: bool, variable_length: bool,
+                              device: Optional[torch.device] = None,
+                              pos_min=0,
+                              pos_max=10):
+    """
+    A tool to dump the interaction between Sender and Receiver, the symbols of the messages at positions
+    [pos_min, pos_max) being replaced by random symbols
+    :param game: A Game instance
+    :param dataset: Dataset of inputs to be used when analyzing the communication
+    :param gs: whether Gumbel-Softmax relaxation was used during training
+    :param variable_length: whether variable-length communication is used
+    :param device: device (e.g. 'cuda') to be used
+    :return:
+    """
+    def randomize_positions(message):
+        # ETUDE DES POSITIONS
+        if pos_min > -1 and pos_max > -1:
+            message = message.clone()
+            symbols = np.random.randint(20, size=message[:, pos_min:pos_max].size())
+            message[:, pos_min:pos_max] = torch.from_numpy(symbols).to(message)
+        return message
+
+    dump = dump_interactions(game, dataset, gs=gs, variable_length=variable_length,
+                             per_position=gs and variable_length, message_transform=randomize_positions,
+                             device=device)
+    return _as_lists(dump)
+
+def _impose_reference_message(message):
+    # Test vocab: a random relabelling of the symbols 1..9
+    conv = np.random.choice(10, size=10, replace=False)
+    conv = torch.from_numpy(conv[conv != 0]).to(message)
+
+    # Test replacement with reference message: the first 30 messages are the message 77, with their symbol at
+    # position j (row j) replaced by a random symbol (N-gram with N=1)
+    message = message.clone()
+    np.random.seed(43)
+    message[:30, :30] = message[77, :30]
+    diagonal = torch.arange(30, device=message.device)
+    message[diagonal, diagonal] = torch.from_numpy(np.random.randint(1, 10, size=30)).to(message)
+
+    # Test changer le milieu: the symbols of the first 200 messages from position 3 to 5 positions before eos are 1
+    lengths = find_lengths(message[:200, :30])
+    positions = torch.arange(30, device=message.device)
+    middle = (positions >= 3) & (positions < lengths.unsqueeze(1) - 5)
+    message[:200, :30] = message[:200, :30].masked_fill(middle, 1)
+
+    return torch.where(message != 0, conv[(message - 1).clamp(min=0)], message)
 
 def dump_impose_message(game: torch.nn.Module,
                               dataset: 'torch.utils.data.DataLoader',
                               gs: bool, variable_length: bool,
                               device: Optional[torch.device] = None):
     """
-    A tool to dump the interaction between Sender and Receiver
+    A tool to dump the interaction between Sender and Receiver, the messages being modified by
+    _impose_reference_message
     :param game: A Game instance
     :param dataset: Dataset of inputs to be used when analyzing the communication
     :param gs: whether Gumbel-Softmax relaxation was used during training
@@ -344,107 +489,11 @@ def dump_impose_message(game: torch.nn.Module,
     :param device: device (e.g. 'cuda') to be used
     :return:
     """
-    train_state = game.training  # persist so we restore it back
-    game.eval()
-
-    device = device if device is not None else common_opts.device
+    dump = dump_interactions(game, dataset, gs=gs, variable_length=variable_length,
+                             per_position=gs and variable_length, message_transform=_impose_reference_message,
+                             device=device)
+    return _as_lists(dump)
 
-    sender_inputs, messages, receiver_inputs, receiver_outputs = [], [], [], []
-    labels = []
-
-    with torch.no_grad():
-        for batch in dataset:
-            # by agreement, each batch is (sender_input, labels) plus optional (receiver_input)
-            sender_input = move_to(batch[0], device)
-            receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
-
-            message = game.sender(sender_input)
-
-            # Test vocab
-            conv=np.random.choice(10,size=10,replace=False)
-            not_found=True
-            k=0
-            while not_found:
-              if conv[k]==0:
-                conv=np.concatenate((conv[:k],conv[k+1:]),axis=0)
-                not_found=False
-              k+=1
-
-            # Test replacement with reference message
-            mes=message[0][77]
-            N=1 # N-gram
-            np.random.seed(43)
-            for j in range(30):
-              for i in range(30):
-                message[0][j,i]=mes[i]
-              for i in range(N-1,30):
-                if i==j:
-                  for k in range(N):
-                    message[0][j,i-k]=np.random.randint(1,10)
-
-            # Test changer le milieu
-            for j in range(200):
-              longueur=0
-              not_found=True
-              while not_found:
-                longueur+=1
-                if message[0][j,longueur-1]==0 or longueur==30:
-                  not_found=False
-
-              for i in range(3,longueur-5):
-                  message[0][j,i]=1
-
-
-            for i in range(message[0].size()[0]):
-              for j in range(message[0].size()[1]):
-                if message[0][i,j]!=0:
-                  message[0][i,j]=int(conv[int(message[0][i,j]-1)])
-
-            # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
-            # We don't need them.
-            if not gs: message = message[0]
-
-            output = game.receiver(message, receiver_input)
-            if not gs: output = output[0]
-
-            if batch[1] is not None:
-                labels.extend(batch[1])
-
-            if isinstance(sender_input, list) or isinstance(sender_input, tuple):
-                sender_inputs.extend(zip(*sender_input))
-            else:
-                sender_inputs.extend(sender_input)
-
-            if receiver_input is not None:
-                receiver_inputs.extend(receiver_input)
-
-            if gs: message = message.argmax(dim=-1)  # actual symbols instead of one-hot encoded
-
-            if not variable_length:
-                messages.extend(message)
-                receiver_outputs.extend(output)
-            else:
-                # A trickier part is to handle EOS in the messages. It also might happen that not every message has EOS.
-                # We cut messages at EOS if it is present or return the entire message otherwise. Note, EOS id is always
-                # set to 0.
-
-                for i in range(message.size(0)):
-                    eos_positions = (message[i, :] == 0).nonzero()
-                    message_end = eos_positions[0].item() if eos_positions.size(0) > 0 else -1
-                    assert message_end == -1 or message[i, message_end] == 0
-                    if message_end < 0:
-                        messages.append(message[i, :])
-                    else:
-                        messages.append(message[i, :message_end + 1])
-
-                    if gs:
-                        receiver_outputs.append(output[i, message_end, ...])
-                    else:
-                        receiver_outputs.append(output[i, ...])
-
-    game.train(mode=train_state)
-
-    return sender_inputs, messages, receiver_inputs, receiver_outputs, labels
 
 def move_to(x: Any, device: torch.device) \
         -> Any:
@@ -492,6 +541,43 @@ def find_lengths(messages: torch.Tensor) -> torch.Tensor:
     return lengths
 
 
+
+def stratified_positions(message_lengths: torch.Tensor, n_positions: int):
+    """
+    Samples `n_positions` reading positions per message for the Impatient loss: the eos position of each message,
+    and one position drawn uniformly in each of `n_positions - 1` strata of (almost) equal size that split the
+    positions before it. A position stands for all the positions of its stratum, i.e. weighting it by the size of
+    its stratum makes the weighted sum over the sampled positions an unbiased estimate of the sum over all the
+    positions up to eos. Empty strata (short messages) have a zero size.
+
+    :param message_lengths: the lengths of the messages, including eos
+    :param n_positions: the number of positions sampled per message, at least 2
+    :returns the [B, n_positions] sampled positions, and the [B, n_positions] float sizes of their strata
+
+    >>> positions, sizes = stratified_positions(torch.tensor([1, 3, 30]), 4)
+    >>> positions[:, -1]
+    tensor([ 0,  2, 29])
+    >>> sizes
+    tensor([[ 0.,  0.,  0.,  1.],
+            [ 0.,  1.,  1.,  1.],
+            [ 9., 10., 10.,  1.]])
+    >>> bool(((positions[2, :-1] - torch.tensor([0, 9, 19])) < sizes[2, :-1]).all())
+    True
+    """
+    assert n_positions >= 2, 'At least the eos position and one stratum are sampled'
+    n_strata = n_positions - 1
+    before_eos = (message_lengths - 1).unsqueeze(1)
+
+    bounds = torch.div(before_eos * torch.arange(n_strata + 1, device=message_lengths.device), n_strata,
+                       rounding_mode='floor')
+    starts, sizes = bounds[:, :-1], bounds[:, 1:] - bounds[:, :-1]
+    offsets = (torch.rand(sizes.size(), device=sizes.device) * sizes).long()
+    offsets = torch.minimum(offsets, (sizes - 1).clamp(min=0))
+
+    positions = torch.cat([starts + offsets, before_eos], dim=1)
+    sizes = torch.cat([sizes, torch.ones_like(before_eos)], dim=1).float()
+    return positions, sizes
+
 def dump_test_position(game: torch.nn.Module,
                               dataset: 'torch.utils.data.DataLoader',
                               position: int,
@@ -499,7 +585,8 @@ def dump_test_position(game: torch.nn.Module,
                               gs: bool, variable_length: bool,
                               device: Optional[torch.device] = None):
     """
-    A tool to dump the interaction between Sender and Receiver
+    A tool to dump the interaction between Sender and Receiver, the symbol of the messages at `position` being
+    replaced by a random symbol
     :param game: A Game instance
     :param dataset: Dataset of inputs to be used when analyzing the communication
     :param gs: whether Gumbel-Softmax relaxation was used during training
@@ -507,70 +594,10 @@ def dump_test_position(game: torch.nn.Module,
     :param device: device (e.g. 'cuda') to be used
     :return:
     """
-    train_state = game.training  # persist so we restore it back
-    game.eval()
-
-    device = device if device is not None else common_opts.device
-
-    sender_inputs, messages, receiver_inputs, receiver_outputs = [], [], [], []
-    labels = []
-
-    with torch.no_grad():
-        for batch in dataset:
-            # by agreement, each batch is (sender_input, labels) plus optional (receiver_input)
-            sender_input = move_to(batch[0], device)
-            receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
-
-            message = game.sender(sender_input)
-
-            for i in range(message[0].size()[0]):
-                message[0][i,position]=np.random.randint(1,voc_size)
-
-            # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
-            # We don't need them.
-            if not gs: message = message[0]
-
-            output = game.receiver(message, receiver_input)
-            if not gs: output = output[0]
-
-            if batch[1] is not None:
-                labels.extend(batch[1])
-
-            if isinstance(sender_input, list) or isinstance(sender_input, tuple):
-                sender_inputs.extend(zip(*sender_input))
-            else:
-                sender_inputs.extend(sender_input)
-
-            if receiver_input is not None:
-                receiver_inputs.extend(receiver_input)
-
-            if gs: message = message.argmax(dim=-1)  # actual symbols instead of one-hot encoded
-
-            if not variable_length:
-                messages.extend(message)
-                receiver_outputs.extend(output)
-            else:
-                # A trickier part is to handle EOS in the messages. It also might happen that not every message has EOS.
-                # We cut messages at EOS if it is present or return the entire message otherwise. Note, EOS id is always
-                # set to 0.
-
-                for i in range(message.size(0)):
-                    eos_positions = (message[i, :] == 0).nonzero()
-                    message_end = eos_positions[0].item() if eos_positions.size(0) > 0 else -1
-                    assert message_end == -1 or message[i, message_end] == 0
-                    if message_end < 0:
-                        messages.append(message[i, :])
-                    else:
-                        messages.append(message[i, :message_end + 1])
-
-                    if gs:
-                        receiver_outputs.append(output[i, message_end, ...])
-                    else:
-                        receiver_outputs.append(output[i, ...])
-
-    game.train(mode=train_state)
-
-    return sender_inputs, messages, receiver_inputs, receiver_outputs, labels
+    dump = dump_interactions(game, dataset, gs=gs, variable_length=variable_length,
+                             per_position=gs and variable_length,
+                             message_transform=_substitute_position(position, voc_size), device=device)
+    return _as_lists(dump)
 
 def dump_sender_receiver_impatient(game: torch.nn.Module,
                          dataset: 'torch.utils.data.DataLoader',
@@ -580,98 +607,36 @@ def dump_sender_receiver_impatient(game: torch.nn.Module,
                          test_mode=False,
                          save_dir=""):
     """
-    A tool to dump the interaction between Sender and Receiver
+    A tool to dump the interaction between Sender and an Impatient Listener, whose output is read at the eos of the
+    messages. It prints the Impatient score: the number of positions at which the i-th input is predicted to be i.
     :param game: A Game instance
     :param dataset: Dataset of inputs to be used when analyzing the communication
     :param gs: whether Gumbel-Softmax relaxation was used during training
     :param variable_length: whether variable-length communication is used
     :param device: device (e.g. 'cuda') to be used
+    :param test_mode: whether the [N, T] predictions at every position are saved in save_dir/predictions.npy
     :return:
     """
-    train_state = game.training  # persist so we restore it back
-    game.eval()
-
-    device = device if device is not None else common_opts.device
-
-    sender_inputs, messages, receiver_inputs, receiver_outputs = [], [], [], []
-    labels = []
-
-    with torch.no_grad():
-        for batch in dataset:
-            # by agreement, each batch is (sender_input, labels) plus optional (receiver_input)
-            sender_input = move_to(batch[0], device)
-            receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
-
-            message = game.sender(sender_input)
-
-            # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
-            # We don't need them.
-            if not gs: message = message[0]
-
-            output = game.receiver(message, receiver_input)
-
-            if not gs: output = output[0]
+    dump = dump_interactions(game, dataset, gs=gs, variable_length=variable_length, per_position=True,
+                             with_predictions=True, device=device)
 
-            # AJOUT
-            preds=output[:,:,:].argmax(2)
+    if test_mode:
+        np.save(save_dir+"predictions.npy", dump.predictions.cpu().numpy())
 
-            if test_mode:
-                np.save(save_dir+"predictions.npy",preds.cpu().numpy())
+    print("Impatient score="+str(impatient_score(dump.predictions)), flush=True)
 
-            message_lengths = find_lengths(message)
+    return _as_lists(dump)
 
-            outputs=[]
-
-            for i in range(output.size(0)):
-                outputs.append(output[i,message_lengths[i]-1,:])
-
-            output=torch.stack(outputs,0)
-
-
-            sc=0.
-            for i in range(preds.size(0)):
-                sc+=(preds[i,:]==i).sum()
-
-            print("Impatient score="+str(int(sc)),flush=True)
-
-            if batch[1] is not None:
-                labels.extend(batch[1])
-
-            if isinstance(sender_input, list) or isinstance(sender_input, tuple):
-                sender_inputs.extend(zip(*sender_input))
-            else:
-                sender_inputs.extend(sender_input)
-
-            if receiver_input is not None:
-                receiver_inputs.extend(receiver_input)
-
-            if gs: message = message.argmax(dim=-1)  # actual symbols instead of one-hot encoded
-
-            if not variable_length:
-                messages.extend(message)
-                receiver_outputs.extend(output)
-            else:
-                # A trickier part is to handle EOS in the messages. It also might happen that not every message has EOS.
-                # We cut messages at EOS if it is present or return the entire message otherwise. Note, EOS id is always
-                # set to 0.
-
-                for i in range(message.size(0)):
-                    eos_positions = (message[i, :] == 0).nonzero()
-                    message_end = eos_positions[0].item() if eos_positions.size(0) > 0 else -1
-                    assert message_end == -1 or message[i, message_end] == 0
-                    if message_end < 0:
-                        messages.append(message[i, :])
-                    else:
-                        messages.append(message[i, :message_end + 1])
-
-                    if gs:
-                        receiver_outputs.append(output[i, message_end, ...])
-                    else:
-                        receiver_outputs.append(output[i, ...])
-
-    game.train(mode=train_state)
+def impatient_score(predictions: torch.Tensor) -> int:
+    """
+    :param predictions: the [N, T] predictions at every position of the messages of the N inputs 0..N-1
+    :returns the number of positions at which the i-th input is predicted to be i
 
-    return sender_inputs, messages, receiver_inputs, receiver_outputs, labels
+    >>> impatient_score(torch.tensor([[0, 1, 0], [1, 1, 1], [0, 0, 0]]))
+    5
+    """
+    inputs = torch.arange(predictions.size(0), device=predictions.device).unsqueeze(1)
+    return int((predictions == inputs).sum())
 
 def dump_test_position_impatient(game: torch.nn.Module,
                               dataset: 'torch.utils.data.DataLoader',
@@ -680,7 +645,7 @@ def dump_test_position_impatient(game: torch.nn.Module,
                               gs: bool, variable_length: bool,
                               device: Optional[torch.device] = None):
     """
-    A tool to dump the interaction between Sender and Receiver
+    dump_test_position for an Impatient Listener, whose output is read at the eos of the messages
     :param game: A Game instance
     :param dataset: Dataset of inputs to be used when analyzing the communication
     :param gs: whether Gumbel-Softmax relaxation was used during training
@@ -688,83 +653,14 @@ def dump_test_position_impatient(game: torch.nn.Module,
     :param device: device (e.g. 'cuda') to be used
     :return:
     """
-    train_state = game.training  # persist so we restore it back
-    game.eval()
-
-    device = device if device is not None else common_opts.device
-
-    sender_inputs, messages, receiver_inputs, receiver_outputs = [], [], [], []
-    labels = []
-
-    with torch.no_grad():
-        for batch in dataset:
-            # by agreement, each batch is (sender_input, labels) plus optional (receiver_input)
-            sender_input = move_to(batch[0], device)
-            receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
-
-            message = game.sender(sender_input)
-
-            for i in range(message[0].size()[0]):
-                message[0][i,position]=np.random.randint(1,voc_size)
-
-            # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
-            # We don't need them.
-            if not gs: message = message[0]
-
-            output = game.receiver(message, receiver_input)
-            if not gs: output = output[0]
-
-            ### AJOUT CHANGEMENT###
-            #output=output[:,-1,:]
-
-            message_lengths = find_lengths(message)
-
-            outputs=[]
-
-            for i in range(output.size(0)):
-                outputs.append(output[i,message_lengths[i]-1,:])
-
-            output=torch.stack(outputs,0)
-            ####
-
-            if batch[1] is not None:
-                labels.extend(batch[1])
-
-            if isinstance(sender_input, list) or isinstance(sender_input, tuple):
-                sender_inputs.extend(zip(*sender_input))
-            else:
-                sender_inputs.extend(sender_input)
+    dump = dump_interactions(game, dataset, gs=gs, variable_length=variable_length, per_position=True,
+                             message_transform=_substitute_position(position, voc_size), device=device)
+    return _as_lists(dump)
 
-            if receiver_input is not None:
-                receiver_inputs.extend(receiver_input)
-
-            if gs: message = message.argmax(dim=-1)  # actual symbols instead of one-hot encoded
-
-            if not variable_length:
-                messages.extend(message)
-                receiver_outputs.extend(output)
-            else:
-                # A trickier part is to handle EOS in the messages. It also might happen that not every message has EOS.
-                # We cut messages at EOS if it is present or return the entire message otherwise. Note, EOS id is always
-                # set to 0.
-
-                for i in range(message.size(0)):
-                    eos_positions = (message[i, :] == 0).nonzero()
-                    message_end = eos_positions[0].item() if eos_positions.size(0) > 0 else -1
-                    assert message_end == -1 or message[i, message_end] == 0
-                    if message_end < 0:
-                        messages.append(message[i, :])
-                    else:
-                        messages.append(message[i, :message_end + 1])
-
-                    if gs:
-                        receiver_outputs.append(output[i, message_end, ...])
-                    else:
-                        receiver_outputs.append(output[i, ...])
-
-    game.train(mode=train_state)
-
-    return sender_inputs, messages, receiver_inputs, receiver_outputs, labels
+def _as_lists_by_attribute(dump: Dump):
+    # the receiver outputs are the lists of the predicted values of the attributes
+    sender_inputs, messages, receiver_inputs, _, labels = _as_lists(dump)
+    return sender_inputs, messages, receiver_inputs, dump.receiver_output.argmax(dim=-1).tolist(), labels
 
 def dump_sender_receiver_compositionality(game: torch.nn.Module,
                          dataset: 'torch.utils.data.DataLoader',
@@ -772,7 +668,8 @@ def dump_sender_receiver_compositionality(game: torch.nn.Module,
                          device: Optional[torch.device] = None,
                          impatient = False):
     """
-    A tool to dump the interaction between Sender and Receiver
+    A tool to dump the interaction between Sender and Receiver, for inputs with several attributes: the receiver
+    outputs are the lists of the predicted values of the attributes
     :param game: A Game instance
     :param dataset: Dataset of inputs to be used when analyzing the communication
     :param gs: whether Gumbel-Softmax relaxation was used during training
@@ -780,86 +677,8 @@ def dump_sender_receiver_compositionality(game: torch.nn.Module,
     :param device: device (e.g. 'cuda') to be used
     :return:
     """
-    train_state = game.training  # persist so we restore it back
-    game.eval()
-
-    device = device if device is not None else common_opts.device
-
-    sender_inputs, messages, receiver_inputs, receiver_outputs = [], [], [], []
-    labels = []
-
-    with torch.no_grad():
-        for batch in dataset:
-            # by agreement, each batch is (sender_input, labels) plus optional (receiver_input)
-            sender_input = move_to(batch[0], device)
-            receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
-
-            message = game.sender(sender_input)
-
-            # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
-            # We don't need them.
-            if not gs: message = message[0]
-
-            output = game.receiver(message, receiver_input)
-
-            if not gs: output = output[0]
-
-            # AJOUT
-            preds_by_att=[]
-            for i in range(output.size(1)):
-                preds_by_att.append(output[:,i,:].argmax(1))
-
-
-            message_lengths = find_lengths(message)
-
-            output=[]
-
-            for j in range(preds_by_att[i].size(0)):
-              output_sing=[]
-              for attribute in range(len(preds_by_att)):
-                output_sing.append(int(preds_by_att[attribute][j]))
-              output.append(output_sing)
-
-            receiver_outputs=output
-
-            if batch[1] is not None:
-                labels.extend(batch[1])
-
-            if isinstance(sender_input, list) or isinstance(sender_input, tuple):
-                sender_inputs.extend(zip(*sender_input))
-            else:
-                sender_inputs.extend(sender_input)
-
-            if receiver_input is not None:
-                receiver_inputs.extend(receiver_input)
-
-            if gs: message = message.argmax(dim=-1)  # actual symbols instead of one-hot encoded
-
-            if not variable_length:
-                messages.extend(message)
-                #receiver_outputs.extend(output)
-            else:
-                # A trickier part is to handle EOS in the messages. It also might happen that not every message has EOS.
-                # We cut messages at EOS if it is present or return the entire message otherwise. Note, EOS id is always
-                # set to 0.
-
-                for i in range(message.size(0)):
-                    eos_positions = (message[i, :] == 0).nonzero()
-                    message_end = eos_positions[0].item() if eos_positions.size(0) > 0 else -1
-                    assert message_end == -1 or message[i, message_end] == 0
-                    if message_end < 0:
-                        messages.append(message[i, :])
-                    else:
-                        messages.append(message[i, :message_end + 1])
-
-                    #if gs:
-                    #    receiver_outputs.append(output[i, message_end, ...])
-                    #else:
-                        #receiver_outputs.append(output[i, ...])
-
-    game.train(mode=train_state)
-
-    return sender_inputs, messages, receiver_inputs, receiver_outputs, labels
+    dump = dump_interactions(game, dataset, gs=gs, variable_length=variable_length, device=device)
+    return _as_lists_by_attribute(dump)
 
 def dump_sender_receiver_impatient_compositionality(game: torch.nn.Module,
                          dataset: 'torch.utils.data.DataLoader',
@@ -867,7 +686,7 @@ def dump_sender_receiver_impatient_compositionality(game: torch.nn.Module,
                          device: Optional[torch.device] = None,
                          impatient = False):
     """
-    A tool to dump the interaction between Sender and Receiver
+    dump_sender_receiver_compositionality for an Impatient Listener, whose output is read at the eos of the messages
     :param game: A Game instance
     :param dataset: Dataset of inputs to be used when analyzing the communication
     :param gs: whether Gumbel-Softmax relaxation was used during training
@@ -875,86 +694,9 @@ def dump_sender_receiver_impatient_compositionality(game: torch.nn.Module,
     :param device: device (e.g. 'cuda') to be used
     :return:
     """
-    train_state = game.training  # persist so we restore it back
-    game.eval()
-
-    device = device if device is not None else common_opts.device
-
-    sender_inputs, messages, receiver_inputs, receiver_outputs = [], [], [], []
-    labels = []
-
-    with torch.no_grad():
-        for batch in dataset:
-            # by agreement, each batch is (sender_input, labels) plus optional (receiver_input)
-            sender_input = move_to(batch[0], device)
-            receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
-
-            message = game.sender(sender_input)
-
-            # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
-            # We don't need them.
-            if not gs: message = message[0]
-
-            output = game.receiver(message, receiver_input)
-
-            if not gs: output = output[0]
-
-            # AJOUT
-            preds_by_att=[]
-            for i in range(output.size(2)):
-                preds_by_att.append(output[:,:,i,:].argmax(2))
-
-
-            message_lengths = find_lengths(message)
-
-            output=[]
-
-            for j in range(preds_by_att[i].size(0)):
-              output_sing=[]
-              for attribute in range(len(preds_by_att)):
-                output_sing.append(int(preds_by_att[attribute][j,message_lengths[j]-1]))
-              output.append(output_sing)
-
-            receiver_outputs=output
-
-            if batch[1] is not None:
-                labels.extend(batch[1])
-
-            if isinstance(sender_input, list) or isinstance(sender_input, tuple):
-                sender_inputs.extend(zip(*sender_input))
-            else:
-                sender_inputs.extend(sender_input)
-
-            if receiver_input is not None:
-                receiver_inputs.extend(receiver_input)
-
-            if gs: message = message.argmax(dim=-1)  # actual symbols instead of one-hot encoded
-
-            if not variable_length:
-                messages.extend(message)
-                #receiver_outputs.extend(output)
-            else:
-                # A trickier part is to handle EOS in the messages. It also might happen that not every message has EOS.
-                # We cut messages at EOS if it is present or return the entire message otherwise. Note, EOS id is always
-                # set to 0.
-
-                for i in range(message.size(0)):
-                    eos_positions = (message[i, :] == 0).nonzero()
-                    message_end = eos_positions[0].item() if eos_positions.size(0) > 0 else -1
-                    assert message_end == -1 or message[i, message_end] == 0
-                    if message_end < 0:
-                        messages.append(message[i, :])
-                    else:
-                        messages.append(message[i, :message_end + 1])
-
-                    #if gs:
-                    #    receiver_outputs.append(output[i, message_end, ...])
-                    #else:
-                        #receiver_outputs.append(output[i, ...])
-
-    game.train(mode=train_state)
-
-    return sender_inputs, messages, receiver_inputs, receiver_outputs, labels
+    dump = dump_interactions(game, dataset, gs=gs, variable_length=variable_length, per_position=True,
+                             device=device)
+    return _as_lists_by_attribute(dump)
 
 def dump_test_position_compositionality(game: torch.nn.Module,
                          dataset: 'torch.utils.data.DataLoader',
@@ -964,7 +706,7 @@ def dump_test_position_compositionality(game: torch.nn.Module,
                          device: Optional[torch.device] = None,
                          impatient = False):
     """
-    A tool to dump the interaction between Sender and Receiver
+    dump_test_position for inputs with several attributes, see dump_sender_receiver_compositionality
     :param game: A Game instance
     :param dataset: Dataset of inputs to be used when analyzing the communication
     :param gs: whether Gumbel-Softmax relaxation was used during training
@@ -972,89 +714,9 @@ def dump_test_position_compositionality(game: torch.nn.Module,
     :param device: device (e.g. 'cuda') to be used
     :return:
     """
-    train_state = game.training  # persist so we restore it back
-    game.eval()
-
-    device = device if device is not None else common_opts.device
-
-    sender_inputs, messages, receiver_inputs, receiver_outputs = [], [], [], []
-    labels = []
-
-    with torch.no_grad():
-        for batch in dataset:
-            # by agreement, each batch is (sender_input, labels) plus optional (receiver_input)
-            sender_input = move_to(batch[0], device)
-            receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
-
-            message = game.sender(sender_input)
-
-            for i in range(message[0].size()[0]):
-                message[0][i,position]=np.random.randint(1,voc_size)
-
-            # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
-            # We don't need them.
-            if not gs: message = message[0]
-
-            output = game.receiver(message, receiver_input)
-
-            if not gs: output = output[0]
-
-            # AJOUT
-            preds_by_att=[]
-            for i in range(output.size(1)):
-                preds_by_att.append(output[:,i,:].argmax(1))
-
-
-            message_lengths = find_lengths(message)
-
-            output=[]
-
-            for j in range(preds_by_att[i].size(0)):
-              output_sing=[]
-              for attribute in range(len(preds_by_att)):
-                output_sing.append(int(preds_by_att[attribute][j]))
-              output.append(output_sing)
-
-            receiver_outputs=output
-
-            if batch[1] is not None:
-                labels.extend(batch[1])
-
-            if isinstance(sender_input, list) or isinstance(sender_input, tuple):
-                sender_inputs.extend(zip(*sender_input))
-            else:
-                sender_inputs.extend(sender_input)
-
-            if receiver_input is not None:
-                receiver_inputs.extend(receiver_input)
-
-            if gs: message = message.argmax(dim=-1)  # actual symbols instead of one-hot encoded
-
-            if not variable_length:
-                messages.extend(message)
-                #receiver_outputs.extend(output)
-            else:
-                # A trickier part is to handle EOS in the messages. It also might happen that not every message has EOS.
-                # We cut messages at EOS if it is present or return the entire message otherwise. Note, EOS id is always
-                # set to 0.
-
-                for i in range(message.size(0)):
-                    eos_positions = (message[i, :] == 0).nonzero()
-                    message_end = eos_positions[0].item() if eos_positions.size(0) > 0 else -1
-                    assert message_end == -1 or message[i, message_end] == 0
-                    if message_end < 0:
-                        messages.append(message[i, :])
-                    else:
-                        messages.append(message[i, :message_end + 1])
-
-                    #if gs:
-                    #    receiver_outputs.append(output[i, message_end, ...])
-                    #else:
-                        #receiver_outputs.append(output[i, ...])
-
-    game.train(mode=train_state)
-
-    return sender_inputs, messages, receiver_inputs, receiver_outputs, labels
+    dump = dump_interactions(game, dataset, gs=gs, variable_length=variable_length,
+                             message_transform=_substitute_position(position, voc_size), device=device)
+    return _as_lists_by_attribute(dump)
 
 def dump_test_position_impatient_compositionality(game: torch.nn.Module,
                          dataset: 'torch.utils.data.DataLoader',
@@ -1064,7 +726,8 @@ def dump_test_position_impatient_compositionality(game: torch.nn.Module,
                          device: Optional[torch.device] = None,
                          impatient = False):
     """
-    A tool to dump the interaction between Sender and Receiver
+    dump_test_position for an Impatient Listener and inputs with several attributes, see
+    dump_sender_receiver_impatient_compositionality
     :param game: A Game instance
     :param dataset: Dataset of inputs to be used when analyzing the communication
     :param gs: whether Gumbel-Softmax relaxation was used during training
@@ -1072,86 +735,6 @@ def dump_test_position_impatient_compositionality(game: torch.nn.Module,
     :param device: device (e.g. 'cuda') to be used
     :return:
     """
-    train_state = game.training  # persist so we restore it back
-    game.eval()
-
-    device = device if device is not None else common_opts.device
-
-    sender_inputs, messages, receiver_inputs, receiver_outputs = [], [], [], []
-    labels = []
-
-    with torch.no_grad():
-        for batch in dataset:
-            # by agreement, each batch is (sender_input, labels) plus optional (receiver_input)
-            sender_input = move_to(batch[0], device)
-            receiver_input = None if len(batch) == 2 else move_to(batch[2], device)
-
-            message = game.sender(sender_input)
-
-            for i in range(message[0].size()[0]):
-                message[0][i,position]=np.random.randint(1,voc_size)
-
-            # Under GS, the only output is a message; under Reinforce, two additional tensors are returned.
-            # We don't need them.
-            if not gs: message = message[0]
-
-            output = game.receiver(message, receiver_input)
-
-            if not gs: output = output[0]
-
-            # AJOUT
-            preds_by_att=[]
-            for i in range(output.size(2)):
-                preds_by_att.append(output[:,:,i,:].argmax(2))
-
-
-            message_lengths = find_lengths(message)
-
-            output=[]
-
-            for j in range(preds_by_att[i].size(0)):
-              output_sing=[]
-              for attribute in range(len(preds_by_att)):
-                output_sing.append(int(preds_by_att[attribute][j,message_lengths[j]-1]))
-              output.append(output_sing)
-
-            receiver_outputs=output
-
-            if batch[1] is not None:
-                labels.extend(batch[1])
-
-            if isinstance(sender_input, list) or isinstance(sender_input, tuple):
-                sender_inputs.extend(zip(*sender_input))
-            else:
-                sender_inputs.extend(sender_input)
-
-            if receiver_input is not None:
-                receiver_inputs.extend(receiver_input)
-
-            if gs: message = message.argmax(dim=-1)  # actual symbols instead of one-hot encoded
-
-            if not variable_length:
-                messages.extend(message)
-                #receiver_outputs.extend(output)
-            else:
-                # A trickier part is to handle EOS in the messages. It also might happen that not every message has EOS.
-                # We cut messages at EOS if it is present or return the entire message otherwise. Note, EOS id is always
-                # set to 0.
-
-                for i in range(message.size(0)):
-                    eos_positions = (message[i, :] == 0).nonzero()
-                    message_end = eos_positions[0].item() if eos_positions.size(0) > 0 else -1
-                    assert message_end == -1 or message[i, message_end] == 0
-                    if message_end < 0:
-                        messages.append(message[i, :])
-                    else:
-                        messages.append(message[i, :message_end + 1])
-
-                    #if gs:
-                    #    receiver_outputs.append(output[i, message_end, ...])
-                    #else:
-                        #receiver_outputs.append(output[i, ...])
-
-    game.train(mode=train_state)
-
-    return sender_inputs, messages, receiver_inputs, receiver_outputs, labels
+    dump = dump_interactions(game, dataset, gs=gs, variable_length=variable_length, per_position=True,
+                             message_transform=_substitute_position(position, voc_size), device=device)
+    return _as_lists_by_attribute(dump)
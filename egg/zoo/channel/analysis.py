@@ -0,0 +1,333 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Length statistics of the runs of the channel game (Zipf's Law of Abbreviation), computed for all the epochs of a run
+at once. A run is a --dir_save directory of train.py: its run store (dir_save/run) or, for older runs, the per-epoch
+files dir_save/messages/messages_epoch_<e>_n_features_<n>.npy and
+dir_save/accuracy/accuracy_epoch_<e>_n_features_<n>.npy.
+
+For each epoch:
+- acc, w_acc: the accuracy, averaged uniformly over the inputs and weighted by their frequency
+- len, w_len: the mean length of the messages (eos included), uniform and weighted by the frequency of the inputs
+- opt: w_len divided by the mean length of optimal coding (see optimal_coding.py)
+- zla: the Spearman correlation between the length of the messages and the frequency of their input (ZLA: < 0)
+- <name>: w_len divided by the mean length of a reference code given with --baselines name=lengths.npy, e.g. the
+  lengths of the most frequent words of a natural language, ranked by frequency
+For a run with a position sieve (see position_analysis.py), the fraction of informative symbols and their mean
+absolute and relative positions are added (info, info_pos, info_rel).
+
+The runs are analyzed in parallel, e.g.:
+
+python -m egg.zoo.channel.analysis runs/seed_* --probs=powerlaw --vocab_size=40 --max_len=30 --workers=4
+"""
+
+import os
+import re
+import json
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from egg.core.run_store import RunStore, INDEX_FILE
+from egg.zoo.channel.features import build_probs
+from egg.zoo.channel.optimal_coding import optimal_lengths
+
+_MESSAGES_FILE = re.compile(r'messages_epoch_(\d+)_n_features_(\d+)\.npy$')
+
+
+class Run(NamedTuple):
+    epochs: np.ndarray
+    # [n_epochs, n_inputs] lengths of the messages and accuracies (None if unknown)
+    lengths: np.ndarray
+    accuracy: Optional[np.ndarray]
+    max_len: Optional[int] = None
+    vocab_size: Optional[int] = None
+
+
+def _load_store(path):
+    store = RunStore(path)
+    accuracy = np.asarray(store.read('accuracy'), dtype=np.float64) if 'accuracy' in store.columns else None
+    return Run(store.epochs, np.asarray(store.read('lengths'), dtype=np.int64), accuracy,
+               store.max_len, store.index.get('vocab_size'))
+
+
+def _legacy_lengths(path):
+    messages = np.load(path, allow_pickle=True)
+    if messages.ndim == 2:
+        # messages of equal lengths are saved as a [n_inputs, length] array
+        return np.full(len(messages), messages.shape[1])
+    return np.fromiter(map(len, messages), dtype=np.int64, count=len(messages))
+
+
+def _load_legacy(run_dir, n_features=None):
+    files = {}
+    for name in os.listdir(os.path.join(run_dir, 'messages')):
+        match = _MESSAGES_FILE.match(name)
+        if match and (n_features is None or int(match.group(2)) == n_features):
+            files.setdefault(int(match.group(2)), {})[int(match.group(1))] = name
+    if len(files) != 1:
+        raise ValueError(f'{run_dir} holds the messages of {len(files)} input spaces {sorted(files)}: '
+                         f'select one with --n_features')
+    n_features, files = files.popitem()
+
+    epochs = np.array(sorted(files))
+    lengths = np.stack([_legacy_lengths(os.path.join(run_dir, 'messages', files[epoch])) for epoch in epochs])
+
+    accuracy = np.full(lengths.shape, np.nan)
+    for i, epoch in enumerate(epochs):
+        path = os.path.join(run_dir, 'accuracy', f'accuracy_epoch_{epoch}_n_features_{n_features}.npy')
+        if os.path.exists(path):
+            accuracy[i] = np.load(path)
+    return Run(epochs, lengths, accuracy)
+
+
+def load_run(run_dir: str, n_features: Optional[int] = None) -> Run:
+    """
+    Loads the lengths of the messages and the accuracies of all the epochs of a run, from its run store if it has one
+    (run_dir or run_dir/run), or from its per-epoch .npy files.
+    """
+    for path in (run_dir, os.path.join(run_dir, 'run')):
+        if os.path.exists(os.path.join(path, INDEX_FILE)):
+            run = _load_store(path)
+            if n_features is not None and run.lengths.shape[1] != n_features:
+                raise ValueError(f'{path} holds {run.lengths.shape[1]} inputs, not {n_features}')
+            return run
+    return _load_legacy(run_dir, n_features)
+
+
+def average_ranks(x: np.ndarray) -> np.ndarray:
+    """
+    The ranks (from 1) of the values of each row, ties getting the average of their ranks.
+
+    >>> average_ranks(np.array([[3, 1, 3, 2], [1, 1, 1, 1]]))
+    array([[3.5, 1. , 3.5, 2. ],
+           [2.5, 2.5, 2.5, 2.5]])
+    """
+    x = np.atleast_2d(x)
+    n = x.shape[1]
+    order = np.argsort(x, axis=1, kind='stable')
+    sorted_x = np.take_along_axis(x, order, axis=1)
+
+    positions = np.arange(n)
+    starts = np.ones(x.shape, dtype=bool)
+    starts[:, 1:] = sorted_x[:, 1:] != sorted_x[:, :-1]
+    ends = np.ones(x.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    # first and last sorted positions of the group of equal values of each position
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, positions, n - 1)[:, ::-1], axis=1)[:, ::-1]
+
+    ranks = np.empty(x.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2 + 1, axis=1)
+    return ranks
+
+
+def spearman(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    The Spearman correlations between each row of x and y, nan for constant rows.
+
+    >>> spearman(np.array([[1, 2, 3], [3, 3, 1], [2, 2, 2]]), np.array([0.5, 0.3, 0.2]))
+    array([-1.       ,  0.8660254,        nan])
+    """
+    x_ranks = average_ranks(x)
+    y_ranks = average_ranks(y)[0]
+    x_ranks -= x_ranks.mean(axis=1, keepdims=True)
+    y_ranks -= y_ranks.mean()
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return x_ranks @ y_ranks / np.sqrt((x_ranks ** 2).sum(axis=1) * (y_ranks ** 2).sum())
+
+
+def length_statistics(lengths: np.ndarray, probs: np.ndarray, accuracy: Optional[np.ndarray] = None,
+                      optimal_length: Optional[float] = None, baselines: Optional[dict] = None) -> dict:
+    """
+    :param lengths: the [n_epochs, n_inputs] lengths of the messages
+    :param probs: the frequencies of the inputs
+    :param accuracy: the [n_epochs, n_inputs] accuracies
+    :param optimal_length: the mean length of optimal coding
+    :param baselines: the mean lengths of reference codes, by name
+    :returns the [n_epochs] statistics, by name (see the documentation of the module)
+
+    >>> stats = length_statistics(np.array([[2, 3], [1, 3]]), np.array([0.75, 0.25]), optimal_length=1.25)
+    >>> stats['w_len'], stats['opt'], stats['zla']
+    (array([2.25, 1.5 ]), array([1.8, 1.2]), array([-1., -1.]))
+    """
+    lengths = np.asarray(lengths, dtype=np.float64)
+    stats = {}
+    if accuracy is not None:
+        stats['acc'] = accuracy.mean(axis=1)
+        stats['w_acc'] = accuracy @ probs
+    stats['len'] = lengths.mean(axis=1)
+    stats['w_len'] = lengths @ probs
+    if optimal_length is not None:
+        stats['opt'] = stats['w_len'] / optimal_length
+    stats['zla'] = spearman(lengths, probs)
+    for name, baseline in (baselines or {}).items():
+        stats[name] = stats['w_len'] / baseline
+    return stats
+
+
+def baseline_mean_length(lengths: np.ndarray, probs: np.ndarray) -> float:
+    """
+    The mean length of a reference code whose lengths are ranked by frequency, given to the inputs ranked by `probs`.
+
+    >>> baseline_mean_length(np.array([1, 2, 2, 5]), np.array([0.25, 0.75]))
+    1.25
+    """
+    if len(lengths) < len(probs):
+        raise ValueError(f'The reference code has {len(lengths)} lengths for {len(probs)} inputs')
+    return float(np.sort(probs)[::-1] @ np.asarray(lengths[:len(probs)], dtype=np.float64))
+
+
+def informative_positions(sieve: np.ndarray, threshold: float = 1.) -> dict:
+    """
+    Statistics of the informative symbols of a position sieve (see position_analysis.py): sieve[i, p] is the accuracy
+    on input i when the symbol at position p is perturbed, -1 after eos. A symbol (eos excluded) is informative if
+    this accuracy is below `threshold`. The [N, T, n_attributes] sieves of position_analysis_compositionality.py are
+    reduced to their lowest accuracy over the attributes: a symbol is informative if it is for any attribute.
+
+    :returns the fraction of informative symbols, and their mean position and mean relative position (0 for the
+        first symbol of a message, 1 for its last one before eos)
+
+    >>> sieve = np.array([[0., 1., 1., -1], [1., 0., 0.5, 1.]])
+    >>> informative_positions(sieve)
+    {'info': 0.6, 'info_pos': 1.0, 'info_rel': 0.5}
+    >>> informative_positions(np.stack([sieve, np.where(sieve < 0, -1., 1.)], axis=2))
+    {'info': 0.6, 'info_pos': 1.0, 'info_rel': 0.5}
+    """
+    if sieve.ndim == 3:
+        sieve = sieve.min(axis=2)
+    elif sieve.ndim != 2:
+        raise ValueError(f'A position sieve has 2 or 3 dimensions, not {sieve.ndim}')
+    n_symbols = (sieve >= 0).sum(axis=1, keepdims=True) - 1
+    positions = np.arange(sieve.shape[1])
+    informative = (positions < n_symbols) & (sieve < threshold)
+
+    relative = positions / np.maximum(n_symbols - 1, 1)
+    n_informative = max(int(informative.sum()), 1)
+    return {'info': float(informative.sum() / max(int(n_symbols.sum()), 1)),
+            'info_pos': float((positions * informative).sum() / n_informative),
+            'info_rel': float((relative * informative).sum() / n_informative)}
+
+
+def analyze_run(run_dir: str, probs: str = 'powerlaw', vocab_size: Optional[int] = None,
+                max_len: Optional[int] = None, n_features: Optional[int] = None, baselines: Optional[dict] = None,
+                sieve_file: str = 'position_sieve.npy', threshold: float = 1.) -> dict:
+    """
+    :returns the epochs of the run, their statistics (see length_statistics) and the statistics of the position
+        sieve of the run, if any
+    """
+    run = load_run(run_dir, n_features)
+    input_probs = build_probs(probs, run.lengths.shape[1]).astype(np.float64)
+
+    vocab_size = vocab_size or run.vocab_size
+    max_len = max_len or run.max_len
+    optimal_length = None
+    if vocab_size and max_len:
+        optimal_length = float(input_probs @ optimal_lengths(input_probs, vocab_size, max_len))
+
+    baselines = {name: baseline_mean_length(np.load(path), input_probs) for name, path in (baselines or {}).items()}
+    stats = length_statistics(run.lengths, input_probs, run.accuracy, optimal_length, baselines)
+
+    sieve_path = os.path.join(run_dir, sieve_file)
+    sieve = informative_positions(np.load(sieve_path), threshold) if os.path.exists(sieve_path) else {}
+
+    return {'run': run_dir, 'epochs': run.epochs, 'stats': stats, 'sieve': sieve, 'optimal_length': optimal_length}
+
+
+def _rows(result, every):
+    epochs = result['epochs']
+    selected = np.arange(len(epochs))
+    if every > 0:
+        selected = selected[(epochs % every == 0) | (selected == len(epochs) - 1)]
+    else:
+        selected = selected[-1:]
+
+    for i in selected:
+        row = {'run': result['run'], 'epoch': int(epochs[i])}
+        row.update({name: float(values[i]) for name, values in result['stats'].items()})
+        row.update(result['sieve'])
+        yield row
+
+
+def format_table(rows) -> str:
+    """
+    >>> print(format_table([{'run': 'a', 'epoch': 3, 'len': 2.5}, {'run': 'bb', 'epoch': 10, 'len': float('nan')}]))
+    run  epoch    len
+    a        3  2.500
+    bb      10    nan
+    """
+    columns = list(dict.fromkeys(name for row in rows for name in row))
+
+    def cell(value):
+        if isinstance(value, float):
+            return f'{value:.3f}'
+        return '' if value is None else str(value)
+
+    cells = [[cell(row.get(name)) for name in columns] for row in rows]
+    widths = [max([len(name)] + [len(line[j]) for line in cells]) for j, name in enumerate(columns)]
+    lines = ['  '.join(name.ljust(width) if j == 0 else name.rjust(width)
+                       for j, (name, width) in enumerate(zip(columns, widths))).rstrip()]
+    for line in cells:
+        lines.append('  '.join(value.ljust(width) if j == 0 else value.rjust(width)
+                               for j, (value, width) in enumerate(zip(line, widths))).rstrip())
+    return '\n'.join(lines)
+
+
+def main(params):
+    parser = argparse.ArgumentParser(description='Length statistics of the runs of the channel game')
+    parser.add_argument('runs', nargs='+', help='The --dir_save directories of the runs')
+    parser.add_argument('--probs', type=str, default='powerlaw',
+                        help='Distribution of the inputs: uniform, powerlaw or comma-separated weights '
+                             '(default: powerlaw)')
+    parser.add_argument('--vocab_size', type=int, default=None,
+                        help='Vocabulary size of the runs, for optimal coding (default: that of the run store)')
+    parser.add_argument('--max_len', type=int, default=None,
+                        help='Max length of the messages of the runs, for optimal coding (default: that of the run '
+                             'store)')
+    parser.add_argument('--n_features', type=int, default=None,
+                        help='Number of inputs, to select the per-epoch files of a run (default: the only one)')
+    parser.add_argument('--baselines', type=str, default='',
+                        help='Comma-separated name=path of reference codes: .npy lengths ranked by frequency '
+                             '(e.g. the words of a natural language)')
+    parser.add_argument('--sieve_file', type=str, default='position_sieve.npy',
+                        help='Position sieve of a run, relative to its directory (default: position_sieve.npy)')
+    parser.add_argument('--informative_threshold', type=float, default=1.,
+                        help='A symbol is informative if the accuracy when it is perturbed is below this threshold '
+                             '(default: 1)')
+    parser.add_argument('--every', type=int, default=0,
+                        help='Reports the epochs that are multiple of this value, and the last one (default: 0, '
+                             'the last epoch only)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes analyzing the runs (default: 1)')
+    parser.add_argument('--json', default=False, action='store_true',
+                        help='Prints a json line per row instead of a table')
+    args = parser.parse_args(params)
+
+    baselines = dict(baseline.split('=', 1) for baseline in args.baselines.split(',') if baseline)
+    analyze = functools.partial(analyze_run, probs=args.probs, vocab_size=args.vocab_size, max_len=args.max_len,
+                                n_features=args.n_features, baselines=baselines, sieve_file=args.sieve_file,
+                                threshold=args.informative_threshold)
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            results = list(executor.map(analyze, args.runs))
+    else:
+        results = [analyze(run) for run in args.runs]
+
+    rows = [row for result in results for row in _rows(result, args.every)]
+    if args.json:
+        for row in rows:
+            print(json.dumps(row))
+    else:
+        print(format_table(rows))
+
+
+if __name__ == "__main__":
+    import sys
+    main(sys.argv[1:])
@@ -3,7 +3,9 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class Receiver(nn.Module):
@@ -16,11 +18,23 @@ class Receiver(nn.Module):
 
 
 class Sender(nn.Module):
+    """
+    Maps the input to the initial hidden state of the Sender. The input is either a batch of one-hot vectors or,
+    as produced by the loaders with `as_index=True`, a batch of input ids. In the latter case, the columns of `fc1`
+    are looked up directly, which is equivalent to multiplying the one-hot vectors by the Linear layer.
+
+    >>> sender = Sender(n_hidden=4, n_features=6)
+    >>> ids = torch.tensor([5, 0, 2])
+    >>> torch.allclose(sender(ids), sender(torch.eye(6)[ids]))
+    True
+    """
     def __init__(self, n_hidden, n_features):
         super(Sender, self).__init__()
         self.fc1 = nn.Linear(n_features, n_hidden)
 
     def forward(self, x):
+        if not torch.is_floating_point(x):
+            return F.embedding(x, self.fc1.weight.t()) + self.fc1.bias
         x = self.fc1(x)
         return x
 
@@ -0,0 +1,118 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Measures the training throughput (steps/sec) of the channel game for several --compile modes, --precision values
+and --impatient_positions. The game is built by train.py from the same options and trained by core.Trainer, e.g. for
+the configuration of the README, on CPU:
+
+python -m egg.zoo.channel.benchmark --modes=none,agents,game --vocab_size=40 --max_len=30 --impatient=True \
+    --reg=True --n_features=100 --probs="powerlaw" --batch_size=512 --sender_cell="lstm" --receiver_cell="lstm" \
+    --sender_hidden=250 --receiver_hidden=600 --receiver_embedding=100 --sender_embedding=10 --lr=0.001 \
+    --sender_entropy_coeff=2. --random_seed=7 --no_cuda
+
+With --convergence_epochs=N, the game is instead trained for up to N epochs of --batches_per_epoch batches, until
+the validation accuracy (at the eos position, for Impatient Listener) exceeds --early_stopping_thr, and the number of
+epochs needed is reported: this checks that a precision, a compile mode or a number of reading positions does not
+change the convergence of the game.
+"""
+
+import json
+import time
+import argparse
+import egg.core as core
+from egg.core import EarlyStopperAccuracy
+from egg.core.util import _set_seed
+from egg.zoo.channel.features import OneHotLoader, UniformLoader, build_probs
+from egg.zoo.channel.samplers import build_sampler
+from egg.zoo.channel.train import get_params, build_game, impatient_positions
+
+
+def build_trainer(opts, n_batches, callbacks=None):
+    _set_seed(opts.random_seed)
+
+    probs = build_probs(opts.probs, opts.n_features)
+    sampler = build_sampler(opts.sampler, probs, device=opts.device)
+    loader = OneHotLoader(n_features=opts.n_features, batch_size=opts.batch_size, batches_per_epoch=n_batches,
+                          probs=probs, as_index=opts.input_ids, sampler=sampler)
+    test_loader = UniformLoader(opts.n_features, as_index=opts.input_ids)
+
+    game = build_game(opts, probs)
+    optimizer = core.build_optimizer(game.parameters())
+    return core.Trainer(game=game, optimizer=optimizer, train_data=loader, validation_data=test_loader,
+                        callbacks=callbacks)
+
+
+def benchmark(opts, n_steps, n_warmup):
+    trainer = build_trainer(opts, n_warmup)
+    start = time.time()
+    trainer.train_epoch()
+    warmup_time = time.time() - start
+
+    getattr(trainer.train_data, 'loader', trainer.train_data).batches_per_epoch = n_steps
+    start = time.time()
+    trainer.train_epoch()  # ends with a host-device synchronisation
+    elapsed = time.time() - start
+
+    return {'steps_per_sec': n_steps / elapsed, 'warmup_sec': warmup_time}
+
+
+def convergence(opts, n_epochs, print_validation=False):
+    # the 'acc' of Impatient Listener averages its predictions over all the reading positions: the game is solved when
+    # it predicts the input once it has read the whole message
+    field_name = 'eos_acc' if opts.impatient else 'acc'
+    stopper = EarlyStopperAccuracy(opts.early_stopping_thr, field_name=field_name)
+    callbacks = [stopper, core.ConsoleLogger(as_json=True)] if print_validation else [stopper]
+    trainer = build_trainer(opts, opts.batches_per_epoch, callbacks=callbacks)
+    start = time.time()
+    trainer.train(n_epochs)
+
+    validation = stopper.validation_stats[-1][1]
+    return {'epochs': stopper.epoch, 'validation_acc': validation['acc'],
+            f'validation_{field_name}': validation[field_name], 'reached_thr': bool(trainer.should_stop),
+            'sec': time.time() - start}
+
+
+def main(params):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', type=str, default='none',
+                        help='Comma-separated --compile modes to be measured (default: none)')
+    parser.add_argument('--precisions', type=str, default='float32',
+                        help='Comma-separated --precision values to be measured (default: float32)')
+    parser.add_argument('--positions', type=str, default=None,
+                        help='Comma-separated --impatient_positions values to be measured (default: that of the '
+                             'game options)')
+    parser.add_argument('--benchmark_steps', type=int, default=20,
+                        help='Number of timed training steps (default: 20)')
+    parser.add_argument('--warmup_steps', type=int, default=5,
+                        help='Number of training steps run before timing, compilations included (default: 5)')
+    parser.add_argument('--convergence_epochs', type=int, default=0,
+                        help='If positive, reports the number of epochs needed to reach --early_stopping_thr '
+                             'instead of the throughput (default: 0)')
+    parser.add_argument('--print_validation', default=False, action='store_true',
+                        help='Prints the validation metrics of every epoch of the convergence runs')
+    args, params = parser.parse_known_args(params)
+
+    opts = get_params(params)
+    positions = [opts.impatient_positions]
+    if args.positions:
+        positions = [impatient_positions(k) for k in args.positions.split(',')]
+    for mode in args.modes.split(','):
+        for precision in args.precisions.split(','):
+            for n_positions in positions:
+                # Trainer reads them from the common options
+                opts.compile, opts.precision = mode, precision
+                opts.impatient_positions = n_positions
+                if args.convergence_epochs > 0:
+                    result = convergence(opts, args.convergence_epochs, args.print_validation)
+                else:
+                    result = benchmark(opts, args.benchmark_steps, args.warmup_steps)
+                print(json.dumps(dict(mode=mode, precision=precision, impatient_positions=n_positions, **result)),
+                      flush=True)
+
+
+if __name__ == "__main__":
+    import sys
+    main(sys.argv[1:])
@@ -6,10 +6,33 @@
 import torch.utils.data as data
 import torch.nn.parallel
 import torch
+import torch.nn.functional as F
 import numpy as np
 import itertools
 
 
+def build_probs(probs, n_features):
+    """
+    The input distribution given by a --probs option: 'uniform', 'powerlaw' (the probability of the i-th input is
+    proportional to 1/i) or comma-separated weights.
+
+    >>> build_probs('powerlaw', 4).round(2)
+    array([0.48, 0.24, 0.16, 0.12], dtype=float32)
+    >>> build_probs('3,1', 2)
+    array([0.75, 0.25], dtype=float32)
+    """
+    if probs == 'uniform':
+        probs = np.ones(n_features)
+    elif probs == 'powerlaw':
+        probs = 1 / np.arange(1, n_features+1, dtype=np.float32)
+    else:
+        probs = np.array([float(x) for x in probs.split(',')], dtype=np.float32)
+        if len(probs) != n_features:
+            raise ValueError(f'{len(probs)} probabilities are given for {n_features} inputs')
+    probs /= probs.sum()
+    return probs
+
+
 class _OneHotIterator:
     """
     >>> it_1 = _OneHotIterator(n_features=128, n_batches_per_epoch=2, batch_size=64, probs=np.ones(128)/128, seed=1)
@@ -34,16 +57,38 @@ class _OneHotIterator:
     256.0
     >>> batch[:, 2:].sum().item()
     0.0
+    >>> it = _OneHotIterator(n_features=128, n_batches_per_epoch=1, batch_size=256, probs=probs, seed=1, as_index=True)
+    >>> ids = list(it)[0][0]
+    >>> ids.size(), ids.dtype
+    (torch.Size([256]), torch.int64)
+    >>> (ids < 2).all().item()
+    True
+    >>> probs = build_probs('powerlaw', 128)
+    >>> it = _OneHotIterator(n_features=128, n_batches_per_epoch=1, batch_size=256, probs=probs, seed=1, as_index=True)
+    >>> ids = list(it)[0][0].numpy()
+    >>> (ids == np.random.RandomState(1).choice(128, size=256, p=probs)).all().item()
+    True
     """
-    def __init__(self, n_features, n_batches_per_epoch, batch_size, probs, seed=None):
+    def __init__(self, n_features, n_batches_per_epoch, batch_size, probs, seed=None, as_index=False, sampler=None):
         self.n_batches_per_epoch = n_batches_per_epoch
         self.n_features = n_features
         self.batch_size = batch_size
+        self.as_index = as_index
 
         self.probs = probs
         self.batches_generated = 0
         self.random_state = np.random.RandomState(seed)
 
+        # the cumulative table RandomState.choice would rebuild at each batch, computed once per epoch
+        self.cdf = None
+        if as_index and sampler is None:
+            self.cdf = np.cumsum(probs, dtype=np.float64)
+            self.cdf /= self.cdf[-1]
+
+        self.sampler = sampler
+        if sampler is not None:
+            sampler.reset(seed)
+
     def __iter__(self):
         return self
 
@@ -51,8 +96,21 @@ class _OneHotIterator:
         if self.batches_generated >= self.n_batches_per_epoch:
             raise StopIteration()
 
-        batch_data = self.random_state.multinomial(1, self.probs, size=self.batch_size)
         self.batches_generated += 1
+        if self.sampler is not None:
+            batch_data = self.sampler.sample(self.batch_size)
+            if not self.as_index:
+                batch_data = F.one_hot(batch_data, self.n_features).float()
+            return batch_data, torch.zeros(1)
+
+        if self.as_index:
+            # integer ids instead of a dense (batch_size, n_features) one-hot matrix, drawn by a binary search in the
+            # cumulative table: O(batch_size * log(n_features)) per batch, with the same stream as RandomState.choice
+            uniform = self.random_state.random_sample(self.batch_size)
+            batch_data = self.cdf.searchsorted(uniform, side='right')
+            return torch.from_numpy(batch_data).long(), torch.zeros(1)
+
+        batch_data = self.random_state.multinomial(1, self.probs, size=self.batch_size)
         return torch.from_numpy(batch_data).float(), torch.zeros(1)
 
 
@@ -71,13 +129,29 @@ class OneHotLoader(torch.utils.data.DataLoader):
     ...     all_equal = all_equal and (a[0] == b[0]).all()
     >>> all_equal.item()
     0
+
+    With `as_index=True`, batches hold the ids of the sampled inputs instead of their one-hot encoding:
+
+    >>> data_loader = OneHotLoader(n_features=8, batches_per_epoch=1, batch_size=2, probs=probs, seed=1, as_index=True)
+    >>> [b[0].size() for b in data_loader]
+    [torch.Size([2])]
+
+    A `sampler` from egg.zoo.channel.samplers replaces the per-batch RandomState.multinomial call:
+
+    >>> from egg.zoo.channel.samplers import AliasSampler
+    >>> data_loader = OneHotLoader(n_features=8, batches_per_epoch=1, batch_size=2, probs=probs, seed=1,
+    ...                            sampler=AliasSampler(probs))
+    >>> [b[0].sum(dim=1) for b in data_loader]
+    [tensor([1., 1.])]
     """
-    def __init__(self, n_features, batches_per_epoch, batch_size, probs, seed=None):
+    def __init__(self, n_features, batches_per_epoch, batch_size, probs, seed=None, as_index=False, sampler=None):
         self.seed = seed
         self.batches_per_epoch = batches_per_epoch
         self.n_features = n_features
         self.batch_size = batch_size
         self.probs = probs
+        self.as_index = as_index
+        self.sampler = sampler
 
     def __iter__(self):
         if self.seed is None:
@@ -86,12 +160,20 @@ class OneHotLoader(torch.utils.data.DataLoader):
             seed = self.seed
 
         return _OneHotIterator(n_features=self.n_features, n_batches_per_epoch=self.batches_per_epoch,
-                               batch_size=self.batch_size, probs=self.probs, seed=seed)
+                               batch_size=self.batch_size, probs=self.probs, seed=seed, as_index=self.as_index,
+                               sampler=self.sampler)
 
 
 class UniformLoader(torch.utils.data.DataLoader):
-    def __init__(self, n_features):
-        self.batch = torch.eye(n_features), torch.zeros(1)
+    """
+    A single batch with every input once: the identity matrix or, with `as_index=True`, the ids 0..n_features-1.
+
+    >>> UniformLoader(3, as_index=True).batch[0]
+    tensor([0, 1, 2])
+    """
+    def __init__(self, n_features, as_index=False):
+        inputs = torch.arange(n_features) if as_index else torch.eye(n_features)
+        self.batch = inputs, torch.zeros(1)
 
     def __iter__(self):
         return iter([self.batch])
@@ -125,7 +207,8 @@ class _OneHotIteratorCompositionality:
     0.0
     """
 
-    def __init__(self, n_values, n_attributes, n_batches_per_epoch, batch_size, probs,probs_attributes , seed=None):
+    def __init__(self, n_values, n_attributes, n_batches_per_epoch, batch_size, probs,probs_attributes , seed=None,
+                 samplers=None):
         self.n_batches_per_epoch = n_batches_per_epoch
         self.batch_size = batch_size
         self.n_values=n_values
@@ -135,6 +218,12 @@ class _OneHotIteratorCompositionality:
         self.batches_generated = 0
         self.random_state = np.random.RandomState(seed)
 
+        # one sampler by attribute, each with its own stream derived from the seed
+        self.samplers = samplers
+        if samplers is not None:
+            for i, sampler in enumerate(samplers):
+                sampler.reset(None if seed is None else (seed + i) % 2 ** 32)
+
     def __iter__(self):
         return self
 
@@ -142,6 +231,12 @@ class _OneHotIteratorCompositionality:
         if self.batches_generated >= self.n_batches_per_epoch:
             raise StopIteration()
 
+        if self.samplers is not None:
+            self.batches_generated += 1
+            batch_data = torch.cat([F.one_hot(sampler.sample(self.batch_size), self.n_values)
+                                    for sampler in self.samplers], dim=1)
+            return batch_data.float(), torch.zeros(1)
+
         batch_data_att=[]
         for i in range(self.n_attributes):
 
@@ -205,7 +300,8 @@ class OneHotLoaderCompositionality(torch.utils.data.DataLoader):
     >>> all_equal.item()
     0
     """
-    def __init__(self, n_values, n_attributes, batches_per_epoch, batch_size, probs, probs_attributes, seed=None):
+    def __init__(self, n_values, n_attributes, batches_per_epoch, batch_size, probs, probs_attributes, seed=None,
+                 samplers=None):
         self.seed = seed
         self.batches_per_epoch = batches_per_epoch
         self.n_values=n_values
@@ -213,6 +309,7 @@ class OneHotLoaderCompositionality(torch.utils.data.DataLoader):
         self.batch_size = batch_size
         self.probs_attributes=probs_attributes
         self.probs = probs
+        self.samplers = samplers
 
     def __iter__(self):
         if self.seed is None:
@@ -221,7 +318,8 @@ class OneHotLoaderCompositionality(torch.utils.data.DataLoader):
             seed = self.seed
 
         return _OneHotIteratorCompositionality(n_values=self.n_values, n_attributes=self.n_attributes, n_batches_per_epoch=self.batches_per_epoch,
-                               batch_size=self.batch_size, probs=self.probs, probs_attributes=self.probs_attributes, seed=seed)
+                               batch_size=self.batch_size, probs=self.probs, probs_attributes=self.probs_attributes, seed=seed,
+                               samplers=self.samplers)
 
 
 class TestLoaderCompositionality(torch.utils.data.DataLoader):
@@ -0,0 +1,196 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+import torch.nn.functional as F
+from egg.core.output_heads import ImpatientLogits
+
+
+def input_ids(sender_input):
+    """
+    Returns the ids of the inputs, which are given either as one-hot vectors (batch_size, n_features) or,
+    when the loaders are used with `as_index=True`, directly as ids (batch_size).
+
+    >>> input_ids(torch.eye(3)[[2, 0]])
+    tensor([2, 0])
+    >>> input_ids(torch.tensor([2, 0]))
+    tensor([2, 0])
+    """
+    if torch.is_floating_point(sender_input):
+        return sender_input.argmax(dim=1)
+    return sender_input
+
+
+def _uniform_weights(positions, message_length):
+    return torch.ones_like(positions, dtype=torch.float).expand(message_length.size(0), -1)
+
+
+def _decreasing_weights(positions, message_length):
+    max_len = positions.size(0)
+    return (max_len - positions).float().expand(message_length.size(0), -1)
+
+
+def _last_weights(positions, message_length):
+    return (positions.unsqueeze(0) == (message_length - 1).unsqueeze(1)).float()
+
+
+POSITION_WEIGHTINGS = {
+    'uniform': _uniform_weights,
+    'decreasing': _decreasing_weights,
+    'last': _last_weights,
+}
+
+
+def impatient_position_weights(message_length, max_len, weighting='uniform'):
+    """
+    Builds the normalised positional weights of the Impatient loss: positions after the EOS-token get a zero weight,
+    the remaining ones are weighted by the selected scheme and normalised to sum to 1 for every message.
+
+    Params:
+    - message_length: message length (including EOS) | size=(batch_size)
+    - max_len: number of reading positions
+    - weighting: one of 'uniform' (every position counts equally), 'decreasing' (early positions count more, as
+      in the compositionality experiments) or 'last' (only the position of the EOS-token, i.e. the standard loss)
+
+    >>> impatient_position_weights(torch.tensor([1, 3]), 4)
+    tensor([[1.0000, 0.0000, 0.0000, 0.0000],
+            [0.3333, 0.3333, 0.3333, 0.0000]])
+    >>> impatient_position_weights(torch.tensor([2]), 3, weighting='decreasing')
+    tensor([[0.6000, 0.4000, 0.0000]])
+    >>> impatient_position_weights(torch.tensor([2]), 3, weighting='last')
+    tensor([[0., 1., 0.]])
+    """
+    if weighting not in POSITION_WEIGHTINGS:
+        raise ValueError(f"Unknown positional weighting: {weighting}")
+
+    positions = torch.arange(max_len, device=message_length.device)
+    len_mask = (positions.unsqueeze(0) < message_length.unsqueeze(1)).float()
+
+    weights = POSITION_WEIGHTINGS[weighting](positions, message_length) * len_mask
+    return weights / weights.sum(1, keepdim=True)
+
+
+def loss_impatient(sender_input, _message, message_length, _receiver_input, receiver_output, _labels,
+                   weighting='uniform', positions=None, position_counts=None):
+    """
+    Compute the loss function for the Impatient Listener.
+    It is equal to the weighted average cross entropy of all the intermediate predictions.
+    All the positions are scored at once with a single cross entropy over the flattened receiver output or, if it is
+    an ImpatientLogits, by chunks, without materialising it.
+    If the receiver output was only computed at some reading positions (see stratified_positions), the loss and the
+    accuracy are estimated from them, each position being weighted by its positional weight times `position_counts`.
+
+    Params:
+    - sender_input: ground truth 1-hot vector | size=(batch_size,n_features), or input ids | size=(batch_size)
+    - receiver_output: receiver predictions | size=(batch_size,T,n_features), T<=max_len, or an ImpatientLogits
+    - message_lengh: message length | size=(batch_size)
+    - weighting: positional weighting scheme, see `impatient_position_weights`
+    - positions: the reading positions of receiver_output, if not all of them | size=(batch_size,K)
+    - position_counts: the number of positions each reading position stands for | size=(batch_size,K)
+
+    Returns:
+    - loss: weighted loss over the positions before EOS | size=(batch_size)
+    - {acc:acc}: mean accuracy | size=(batch_size)
+    - crible_acc: accuracy by position, zero at the positions that are not read | size=(batch_size,max_len)
+
+    >>> sender_input = torch.eye(3)[[0, 2]]
+    >>> message = torch.tensor([[1, 0, 0], [2, 0, 0]])
+    >>> receiver_output = torch.log(torch.tensor([[[0.8, 0.1, 0.1], [0.1, 0.8, 0.1]],
+    ...                                           [[0.8, 0.1, 0.1], [0.1, 0.1, 0.8]]]))
+    >>> loss, rest, crible_acc = loss_impatient(sender_input, message, torch.tensor([2, 2]), None, receiver_output, None)
+    >>> rest['acc']
+    tensor([0.5000, 0.5000])
+    >>> crible_acc
+    tensor([[1., 0., 0.],
+            [0., 1., 0.]])
+    >>> positions, counts = torch.tensor([[1], [1]]), torch.tensor([[2.], [2.]])
+    >>> loss, rest, crible_acc = loss_impatient(sender_input, message, torch.tensor([2, 2]), None,
+    ...                                         receiver_output[:, 1:], None, positions=positions, position_counts=counts)
+    >>> rest['acc']
+    tensor([0., 1.])
+    >>> crible_acc
+    tensor([[0., 0., 0.],
+            [0., 1., 0.]])
+    """
+    batch_size, n_positions, n_features = receiver_output.size()
+    target = input_ids(sender_input)
+
+    if isinstance(receiver_output, ImpatientLogits):
+        crible_loss, crible_acc = receiver_output.cross_entropy_accuracy(target)
+    else:
+        crible_loss = F.cross_entropy(receiver_output.reshape(batch_size * n_positions, n_features),
+                                      target.repeat_interleave(n_positions), reduction="none")
+        crible_loss = crible_loss.view(batch_size, n_positions)
+        crible_acc = (receiver_output.argmax(dim=2) == target.unsqueeze(1)).detach().float()
+
+    len_mask = impatient_position_weights(message_length, _message.size(1), weighting)
+    if positions is not None:
+        len_mask = len_mask.gather(1, positions) * position_counts
+    else:
+        # the receiver only unrolls up to the longest message of the batch
+        len_mask = len_mask[:, :n_positions]
+
+    loss = (crible_loss * len_mask).sum(1)
+    acc = (crible_acc * len_mask).sum(1)
+
+    if positions is not None:
+        crible_acc = torch.zeros_like(len_mask[:, :1]).expand(-1, _message.size(1)).scatter(1, positions, crible_acc)
+    else:
+        crible_acc = F.pad(crible_acc, (0, _message.size(1) - n_positions))
+
+    return loss, {'acc': acc}, crible_acc
+
+
+def loss_impatient_compositionality(sender_input, _message, message_length, _receiver_input, receiver_output, _labels,
+                                    n_attributes, n_values, att_weights, weighting='uniform'):
+    """
+    Impatient loss for inputs with several attributes. Each attribute is scored independently and the per-position
+    loss is the average over the attributes; an attribute that is not sampled (all-zero one-hot) has no weight.
+
+    Params:
+    - sender_input: concatenation of the attributes 1-hot vectors | size=(batch_size,n_attributes*n_values)
+    - receiver_output: receiver predictions | size=(batch_size,T,n_attributes,n_values)
+    - message_lengh: message length | size=(batch_size)
+
+    Returns:
+    - loss | size=(batch_size)
+    - {acc:acc}: mean accuracy over the attributes | size=(batch_size)
+    - crible_acc: accuracy by position | size=(batch_size,max_len)
+
+    >>> # the second attribute of the second input is not sampled
+    >>> sender_input = torch.tensor([[1., 0., 0., 1.], [0., 1., 0., 0.]])
+    >>> message = torch.tensor([[1, 0], [0, 0]])
+    >>> receiver_output = torch.log(torch.tensor([[[[0.8, 0.2], [0.8, 0.2]], [[0.8, 0.2], [0.2, 0.8]]],
+    ...                                           [[[0.2, 0.8], [0.8, 0.2]], [[0.2, 0.8], [0.8, 0.2]]]]))
+    >>> loss, rest, crible_acc = loss_impatient_compositionality(sender_input, message, torch.tensor([2, 1]), None,
+    ...                                                          receiver_output, None, 2, 2, None)
+    >>> loss
+    tensor([0.5697, 0.1116])
+    >>> rest['acc']
+    tensor([0.7500, 1.0000])
+    >>> crible_acc
+    tensor([[0.5000, 1.0000],
+            [1.0000, 1.0000]])
+    """
+    batch_size, n_positions = receiver_output.size(0), receiver_output.size(1)
+
+    sender_input = sender_input.reshape(batch_size, n_attributes, n_values)
+    target = sender_input.argmax(dim=2)
+    att_mask = sender_input.max(dim=2).values
+
+    crible_loss = F.cross_entropy(receiver_output.reshape(-1, n_values),
+                                  target.unsqueeze(1).expand(-1, n_positions, -1).reshape(-1), reduction="none")
+    crible_loss = (crible_loss.view(batch_size, n_positions, n_attributes) * att_mask.unsqueeze(1)).sum(2) / n_attributes
+    crible_acc = (receiver_output.argmax(dim=3) == target.unsqueeze(1)).detach().float().sum(2) / n_attributes
+
+    # the receiver only unrolls up to the longest message of the batch
+    len_mask = impatient_position_weights(message_length, _message.size(1), weighting)[:, :n_positions]
+
+    loss = (crible_loss * len_mask).sum(1)
+    acc = (crible_acc * len_mask).sum(1)
+
+    crible_acc = F.pad(crible_acc, (0, _message.size(1) - n_positions))
+
+    return loss, {'acc': acc}, crible_acc
@@ -0,0 +1,196 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""
+Optimal coding of the inputs of the channel game: the code minimizing the mean length of the messages (eos included),
+the inputs being drawn from `probs` and all the messages being different. The shortest messages go to the most
+frequent inputs; there are (vocab_size - 1)^(l - 1) messages of length l, l <= max_len. Everything is computed with a
+sort of the inputs, in O(n log n + n * max_len).
+
+The codes are cached on disk, in a .npz file per (probs, n_features, vocab_size, max_len), e.g.:
+
+python -m egg.zoo.channel.optimal_coding --probs=powerlaw --n_features=100000 --vocab_size=40 --max_len=30
+"""
+
+import os
+import json
+import hashlib
+import argparse
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from egg.core.run_store import symbol_dtype
+from egg.zoo.channel.features import build_probs
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'egg', 'optimal_coding')
+
+
+class OptimalCode(NamedTuple):
+    mean_length: float
+    # histogram[l - 1]: number of inputs with a message of length l
+    histogram: np.ndarray
+    # the length of the message of each input
+    lengths: np.ndarray
+    # the [n_features, max_len] messages, padded with eos
+    codebook: np.ndarray
+
+
+def _capacities(n: int, vocab_size: int, max_len: int):
+    capacities, capacity = [], 1
+    for _ in range(max_len):
+        capacities.append(min(capacity, n))
+        capacity *= vocab_size - 1
+    return np.array(capacities, dtype=np.int64)
+
+
+def optimal_lengths(probs: np.ndarray, vocab_size: int, max_len: int) -> np.ndarray:
+    """
+    The lengths (eos included) of the messages of optimal coding.
+
+    >>> optimal_lengths(np.array([0.1, 0.4, 0.2, 0.3]), vocab_size=3, max_len=3)
+    array([3, 1, 2, 2])
+    """
+    n = len(probs)
+    ends = np.cumsum(_capacities(n, vocab_size, max_len))
+    if ends[-1] < n:
+        raise ValueError(f'{n} inputs cannot get different messages of at most {max_len} symbols out of {vocab_size}')
+
+    lengths = np.empty(n, dtype=np.int64)
+    lengths[np.argsort(-np.asarray(probs), kind='stable')] = np.searchsorted(ends, np.arange(n), side='right') + 1
+    return lengths
+
+
+def optimal_codebook(probs: np.ndarray, vocab_size: int, max_len: int) -> np.ndarray:
+    """
+    The messages of optimal coding: the k-th message of length l is written with the l - 1 digits of k in base
+    vocab_size - 1, shifted by one to skip eos, followed by eos.
+
+    >>> optimal_codebook(np.array([0.1, 0.4, 0.2, 0.3]), vocab_size=3, max_len=3)
+    array([[1, 1, 0],
+           [0, 0, 0],
+           [2, 0, 0],
+           [1, 0, 0]], dtype=int8)
+    """
+    n = len(probs)
+    lengths = optimal_lengths(probs, vocab_size, max_len)
+    order = np.argsort(-np.asarray(probs), kind='stable')
+    starts = np.concatenate([[0], np.cumsum(_capacities(n, vocab_size, max_len))])
+    # the index of each message among those of its length
+    ranks = np.empty(n, dtype=np.int64)
+    ranks[order] = np.arange(n)
+    indices = ranks - starts[lengths - 1]
+
+    base = vocab_size - 1
+    # powers above n divide no index: capping them keeps them in int64
+    powers = np.ones(max_len, dtype=np.int64)
+    for e in range(1, max_len):
+        powers[e] = min(powers[e - 1] * base, n + 1)
+
+    codebook = np.zeros((n, max_len), dtype=symbol_dtype(vocab_size))
+    for position in range(max_len - 1):
+        digits = lengths - 2 - position
+        in_message = digits >= 0
+        symbols = indices[in_message] // powers[digits[in_message]] % base + 1
+        codebook[in_message, position] = symbols
+    return codebook
+
+
+def optimal_code(probs: np.ndarray, vocab_size: int, max_len: int) -> OptimalCode:
+    """
+    >>> code = optimal_code(np.array([0.1, 0.4, 0.2, 0.3]), vocab_size=3, max_len=3)
+    >>> round(code.mean_length, 2), code.histogram
+    (1.7, array([1, 2, 1]))
+    """
+    probs = np.asarray(probs, dtype=np.float64)
+    lengths = optimal_lengths(probs, vocab_size, max_len)
+    return OptimalCode(mean_length=float(probs @ lengths / probs.sum()),
+                       histogram=np.bincount(lengths - 1, minlength=max_len),
+                       lengths=lengths,
+                       codebook=optimal_codebook(probs, vocab_size, max_len))
+
+
+def cache_key(probs: str, n_features: int, vocab_size: int, max_len: int) -> str:
+    """
+    >>> cache_key('powerlaw', 100, 40, 30) == cache_key('powerlaw', 100, 40, 30) != cache_key('uniform', 100, 40, 30)
+    True
+    """
+    params = json.dumps({'probs': probs, 'n_features': n_features, 'vocab_size': vocab_size, 'max_len': max_len},
+                        sort_keys=True)
+    return hashlib.sha1(params.encode()).hexdigest()
+
+
+def cached_optimal_code(probs: str, n_features: int, vocab_size: int, max_len: int,
+                        cache_dir: Optional[str] = DEFAULT_CACHE_DIR) -> OptimalCode:
+    """
+    The optimal code of the input distribution given by a --probs option (see features.build_probs), read from
+    `cache_dir` if it was computed before with the same parameters. No cache is used if `cache_dir` is None.
+
+    >>> import tempfile
+    >>> cache_dir = tempfile.mkdtemp()
+    >>> code = cached_optimal_code('powerlaw', 1000, vocab_size=10, max_len=5, cache_dir=cache_dir)
+    >>> len(os.listdir(cache_dir)), code.histogram
+    (1, array([  1,   9,  81, 729, 180]))
+    >>> cached = cached_optimal_code('powerlaw', 1000, vocab_size=10, max_len=5, cache_dir=cache_dir)
+    >>> cached.mean_length == code.mean_length, np.array_equal(cached.codebook, code.codebook)
+    (True, True)
+    """
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, cache_key(probs, n_features, vocab_size, max_len) + '.npz')
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                return OptimalCode(mean_length=float(cached['mean_length']), histogram=cached['histogram'],
+                                   lengths=cached['lengths'], codebook=cached['codebook'])
+
+    code = optimal_code(build_probs(probs, n_features), vocab_size, max_len)
+
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written under a temporary name, so that concurrent sweeps never read a partial file
+        tmp_path = f'{path[:-len(".npz")]}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, **code._asdict())
+        os.replace(tmp_path, path)
+    return code
+
+
+def main(params):
+    parser = argparse.ArgumentParser(description='Optimal coding of the inputs of the channel game')
+    parser.add_argument('--probs', type=str, default='powerlaw',
+                        help='Distribution of the inputs: uniform, powerlaw or comma-separated weights '
+                             '(default: powerlaw)')
+    parser.add_argument('--n_features', type=int, default=100,
+                        help='Number of inputs (default: 100)')
+    parser.add_argument('--vocab_size', type=int, default=40,
+                        help='Vocabulary size, eos included (default: 40)')
+    parser.add_argument('--max_len', type=int, default=30,
+                        help='Max length of the messages, eos included (default: 30)')
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help=f'Directory of the cached codes (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--no_cache', default=False, action='store_true',
+                        help='Neither reads nor writes the cache')
+    parser.add_argument('--codebook', type=str, default=None,
+                        help='Saves the [n_features, max_len] messages of the code to this .npy file')
+    parser.add_argument('--json', default=False, action='store_true',
+                        help='Prints the mean length and the histogram as a json line')
+    args = parser.parse_args(params)
+
+    code = cached_optimal_code(args.probs, args.n_features, args.vocab_size, args.max_len,
+                               cache_dir=None if args.no_cache else args.cache_dir)
+    if args.codebook:
+        np.save(args.codebook, code.codebook)
+
+    histogram = {length: int(count) for length, count in enumerate(code.histogram, start=1) if count}
+    if args.json:
+        print(json.dumps({'mean_length': code.mean_length, 'histogram': histogram}))
+    else:
+        print(f'mean length: {code.mean_length:.4f}')
+        for length, count in histogram.items():
+            print(f'length {length}: {count} messages')
+
+
+if __name__ == "__main__":
+    import sys
+    main(sys.argv[1:])
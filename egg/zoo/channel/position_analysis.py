@@ -3,6 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 import json
 import argparse
 import numpy as np
@@ -14,11 +15,11 @@ from egg.zoo.channel.features import OneHotLoader, UniformLoader
 from egg.zoo.channel.archs import Sender, Receiver
 from egg.core.util import dump_sender_receiver_test
 from egg.core.util import dump_impose_message
-from egg.core.util import dump_test_position
-from egg.core.util import dump_test_position_impatient
 from egg.core.reinforce_wrappers import RnnReceiverImpatient
 from egg.core.reinforce_wrappers import SenderImpatientReceiverRnnReinforce
 from egg.core.util import dump_sender_receiver_impatient
+from egg.core.util import find_lengths
+from egg.core.interventions import INTERVENTIONS, intervene
 
 
 def get_params(params):
@@ -54,6 +55,12 @@ def get_params(params):
 
     parser.add_argument('--sender_generate_style', type=str, default='in-place', choices=['standard', 'in-place'],
                         help='How the next symbol is generated within the TransformerDecoder (default: in-place)')
+    parser.add_argument('--attention', type=str, default='torch', choices=['torch', 'sdpa'],
+                        help='Attention backend of the Transformer agents: nn.MultiheadAttention or '
+                             'F.scaled_dot_product_attention (default: torch)')
+    parser.add_argument('--receiver_pooling', type=str, default='after_eos', choices=['after_eos', 'eos', 'mean', 'first'],
+                        help='Embedding taken as the representative of the message by a causal Transformer Receiver '
+                             '(default: after_eos)')
 
     parser.add_argument('--sender_cell', type=str, default='rnn',
                         help='Type of the cell used for Sender {rnn, gru, lstm, transformer} (default: rnn)')
@@ -81,40 +88,22 @@ def get_params(params):
                         help="Weights of the sender agent")
     parser.add_argument('--save_dir',type=str ,default="analysis/",
                         help="Directory to save the results of the analysis")
+    parser.add_argument('--dir_save', type=str, default=None,
+                        help="Directory of the trained run: if given, the position sieve is saved there instead of "
+                             "--save_dir, where analysis.py reads it (default: None)")
     parser.add_argument('--impatient', type=bool, default=False,
                         help="Impatient listener")
     parser.add_argument('--unigram_pen', type=float, default=0.0,
                         help="Add a penalty for redundancy")
+    parser.add_argument('--intervention', type=str, default='substitute', choices=INTERVENTIONS,
+                        help="Perturbation applied to each position of the messages (default: substitute)")
+    parser.add_argument('--intervention_samples', type=int, default=1,
+                        help="Number of random draws of the perturbation at each position (default: 1)")
 
     args = core.init(parser, params)
 
     return args
 
-def dump(game, n_features, device, gs_mode):
-    # tiny "dataset"
-    dataset = [[torch.eye(n_features).to(device), None]]
-
-    sender_inputs, messages, receiver_inputs, receiver_outputs, _ = \
-        core.dump_sender_receiver(game, dataset, gs=gs_mode, device=device, variable_length=True)
-
-    unif_acc = 0.
-    powerlaw_acc = 0.
-    powerlaw_probs = 1 / np.arange(1, n_features+1, dtype=np.float32)
-    powerlaw_probs /= powerlaw_probs.sum()
-
-    for sender_input, message, receiver_output in zip(sender_inputs, messages, receiver_outputs):
-        input_symbol = sender_input.argmax()
-        output_symbol = receiver_output.argmax()
-        acc = (input_symbol == output_symbol).float().item()
-
-        unif_acc += acc
-        powerlaw_acc += powerlaw_probs[input_symbol] * acc
-        #print(f'input: {input_symbol.item()} -> message: {",".join([str(x.item()) for x in message])} -> output: {output_symbol.item()}', flush=True)
-
-    unif_acc /= n_features
-
-    return acc, messages
-
 def loss(sender_input, _message, _receiver_input, receiver_output, _labels):
     acc = (receiver_output.argmax(dim=1) == sender_input.argmax(dim=1)).detach().float()
     loss = F.cross_entropy(receiver_output, sender_input.argmax(dim=1), reduction="none")
@@ -149,7 +138,7 @@ def main(params):
                                                  hidden_size=opts.sender_hidden,
                                                  force_eos=opts.force_eos,
                                                  generate_style=opts.sender_generate_style,
-                                                 causal=opts.causal_sender)
+                                                 causal=opts.causal_sender, attention=opts.attention)
     else:
         sender = Sender(n_features=opts.n_features, n_hidden=opts.sender_hidden)
 
@@ -161,7 +150,8 @@ def main(params):
         receiver = Receiver(n_features=opts.n_features, n_hidden=opts.receiver_embedding)
         receiver = core.TransformerReceiverDeterministic(receiver, opts.vocab_size, opts.max_len,
                                                          opts.receiver_embedding, opts.receiver_num_heads, opts.receiver_hidden,
-                                                         opts.receiver_num_layers, causal=opts.causal_receiver)
+                                                         opts.receiver_num_layers, causal=opts.causal_receiver,
+                                                         attention=opts.attention, pooling=opts.receiver_pooling)
     else:
 
         receiver = Receiver(n_features=opts.n_features, n_hidden=opts.receiver_hidden)
@@ -198,64 +188,19 @@ def main(params):
 
 
     # Debut test position
-
-    position_sieve=np.zeros((opts.n_features,opts.max_len))
-
-    for position in range(opts.max_len):
-
-        dataset = [[torch.eye(opts.n_features).to(device), None]]
-
-        if opts.impatient:
-            sender_inputs, messages, receiver_inputs, receiver_outputs, _ = \
-                dump_test_position_impatient(trainer.game,
-                                    dataset,
-                                    position=position,
-                                    voc_size=opts.vocab_size,
-                                    gs=False,
-                                    device=device,
-                                    variable_length=True)
-        else:
-            sender_inputs, messages, receiver_inputs, receiver_outputs, _ = \
-                dump_test_position(trainer.game,
-                                    dataset,
-                                    position=position,
-                                    voc_size=opts.vocab_size,
-                                    gs=False,
-                                    device=device,
-                                    variable_length=True)
-
-        acc_pos=[]
-
-        for sender_input, message, receiver_output in zip(sender_inputs, messages, receiver_outputs):
-            input_symbol = sender_input.argmax()
-            output_symbol = receiver_output.argmax()
-            acc = (input_symbol == output_symbol).float().item()
-            acc_pos.append(acc)
-
-        acc_pos=np.array(acc_pos)
-
-        position_sieve[:,position]=acc_pos
+    # all the positions of all the messages are perturbed in a single batched pass; position_sieve[i, p] is the
+    # accuracy of Receiver on input i when the symbol at position p is perturbed, averaged over the random draws
+    sender_input = torch.eye(opts.n_features).to(device)
+    messages, predictions = intervene(trainer.game, sender_input, opts.intervention,
+                                      n_samples=opts.intervention_samples, vocab_size=opts.vocab_size,
+                                      impatient=opts.impatient, device=device)
+    position_sieve = (predictions == sender_input.argmax(1)[:, None, None]).float().mean(2).cpu().numpy()
 
     # Put -1 for position after message_length
-    _, messages = dump(trainer.game, opts.n_features, device, False)
-
-    # Convert messages to numpy array
-    messages_np=[]
-    for x in messages:
-        x = x.cpu().numpy()
-        messages_np.append(x)
-
-    for i in range(len(messages_np)):
-        # Message i
-        message_i=messages_np[i]
-        id_0=np.where(message_i==0)[0]
-
-        if id_0.shape[0]>0:
-          for j in range(id_0[0]+1,opts.max_len):
-              position_sieve[i,j]=-1
-
+    after_eos = torch.arange(messages.size(1), device=device)[None, :] >= find_lengths(messages)[:, None]
+    position_sieve[after_eos.cpu().numpy()] = -1
 
-    np.save("analysis/position_sieve.npy",position_sieve)
+    np.save(os.path.join(opts.dir_save or opts.save_dir, "position_sieve.npy"), position_sieve)
 
     core.close()
 
@@ -3,6 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import os
 import json
 import argparse
 import numpy as np
@@ -15,12 +16,14 @@ from egg.zoo.channel.features import OneHotLoader, UniformLoader
 from egg.zoo.channel.archs import Sender, Receiver
 from egg.core.util import dump_sender_receiver_test
 from egg.core.util import dump_impose_message
-from egg.core.util import dump_test_position, dump_test_position_impatient, dump_test_position_compositionality, dump_test_position_impatient_compositionality, dump_sender_receiver_compositionality, dump_sender_receiver_impatient_compositionality
+from egg.core.util import dump_sender_receiver_compositionality, dump_sender_receiver_impatient_compositionality
 from egg.core.reinforce_wrappers import RnnReceiverImpatient
 from egg.core.reinforce_wrappers import SenderImpatientReceiverRnnReinforce
 from egg.core.reinforce_wrappers import RnnReceiverImpatient, RnnReceiverImpatientCompositionality, RnnReceiverCompositionality
 from egg.core.reinforce_wrappers import SenderImpatientReceiverRnnReinforce, CompositionalitySenderImpatientReceiverRnnReinforce, CompositionalitySenderReceiverRnnReinforce
 from egg.core.util import dump_sender_receiver_impatient
+from egg.core.util import find_lengths
+from egg.core.interventions import INTERVENTIONS, intervene
 
 from egg.core.trainers import CompoTrainer
 
@@ -85,6 +88,9 @@ def get_params(params):
                         help="Weights of the sender agent")
     parser.add_argument('--save_dir',type=str ,default="analysis/",
                         help="Directory to save the results of the analysis")
+    parser.add_argument('--dir_save', type=str, default=None,
+                        help="Directory of the trained run: if given, the position sieve is saved there instead of "
+                             "--save_dir, where analysis.py reads it (default: None)")
     parser.add_argument('--impatient', type=bool, default=False,
                         help="Impatient listener")
     parser.add_argument('--unigram_pen', type=float, default=0.0,
@@ -97,6 +103,10 @@ def get_params(params):
                         help='Number of attributes (default: 2)')
     parser.add_argument('--n_values', type=int, default=3,
                         help='Number of values by attribute')
+    parser.add_argument('--intervention', type=str, default='substitute', choices=INTERVENTIONS,
+                        help="Perturbation applied to each position of the messages (default: substitute)")
+    parser.add_argument('--intervention_samples', type=int, default=1,
+                        help="Number of random draws of the perturbation at each position (default: 1)")
 
     args = core.init(parser, params)
 
@@ -331,77 +341,27 @@ def main(params):
 
 
     # Debut test position
+    one_hots = torch.eye(opts.n_values)
 
-    position_sieve=np.zeros((opts.n_attributes**opts.n_values,opts.max_len,opts.n_attributes))
+    val=np.arange(opts.n_values)
+    combination=torch.tensor(list(itertools.product(val,repeat=opts.n_attributes)))
 
-    for position in range(opts.max_len):
-
-        one_hots = torch.eye(opts.n_values)
-
-        val=np.arange(opts.n_values)
-        combination=list(itertools.product(val,repeat=opts.n_attributes))
-
-        dataset=[]
-
-        for i in range(len(combination)):
-          new_input=torch.zeros(0)
-          for j in combination[i]:
-            new_input=torch.cat((new_input,one_hots[j]))
-          dataset.append(new_input)
-
-        dataset=torch.stack(dataset)
-
-        dataset=[[dataset,None]]
-
-        if opts.impatient:
-            sender_inputs, messages, receiver_inputs, receiver_outputs, _ = \
-                dump_test_position_impatient_compositionality(trainer.game,
-                                    dataset,
-                                    position=position,
-                                    voc_size=opts.vocab_size,
-                                    gs=False,
-                                    device=device,
-                                    variable_length=True)
-        else:
-            sender_inputs, messages, receiver_inputs, receiver_outputs, _ = \
-                dump_test_position_compositionality(trainer.game,
-                                    dataset,
-                                    position=position,
-                                    voc_size=opts.vocab_size,
-                                    gs=False,
-                                    device=device,
-                                    variable_length=True)
-
-        for i in range(len(receiver_outputs)):
-          message=messages[i]
-          correct=True
-          for j in range(len(list(combination[i]))):
-            if receiver_outputs[i][j]==list(combination[i])[j]:
-              position_sieve[i,position,j]=1
+    # concatenation of the one-hot vectors of the attributes
+    sender_input = one_hots[combination].view(combination.size(0), -1).to(device)
 
+    # all the positions of all the messages are perturbed in a single batched pass; position_sieve[i, p, a] is the
+    # accuracy of Receiver on attribute a of input i when the symbol at position p is perturbed, averaged over the
+    # random draws
+    messages, predictions = intervene(trainer.game, sender_input, opts.intervention,
+                                      n_samples=opts.intervention_samples, vocab_size=opts.vocab_size,
+                                      impatient=opts.impatient, device=device)
+    position_sieve = (predictions == combination.to(device)[:, None, None, :]).float().mean(2).cpu().numpy()
 
     # Put -1 for position after message_length
-    if not opts.impatient:
-        acc_vec,messages=dump_compositionality(trainer.game, opts.n_attributes, opts.n_values, device, False,0)
-    else:
-        acc_vec,messages=dump_impatient_compositionality(trainer.game, opts.n_attributes, opts.n_values, device, False,0)
-
-    # Convert messages to numpy array
-    messages_np=[]
-    for x in messages:
-        x = x.cpu().numpy()
-        messages_np.append(x)
-
-    for i in range(len(messages_np)):
-        # Message i
-        message_i=messages_np[i]
-        id_0=np.where(message_i==0)[0]
-
-        if id_0.shape[0]>0:
-          for j in range(id_0[0]+1,opts.max_len):
-              position_sieve[i,j]=-1
+    after_eos = torch.arange(messages.size(1), device=device)[None, :] >= find_lengths(messages)[:, None]
+    position_sieve[after_eos.cpu().numpy()] = -1
 
-    np.save("analysis/position_sieve.npy",position_sieve)
+    np.save(os.path.join(opts.dir_save or opts.save_dir, "position_sieve.npy"), position_sieve)
 
     core.close()
 
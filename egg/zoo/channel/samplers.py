@@ -0,0 +1,123 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+# This source code is licensed under the MIT license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+
+def build_alias_table(probs):
+    """
+    Builds the table of Vose's alias method for a categorical distribution: after this O(n_features) preprocessing,
+    each draw costs O(1), whatever the number of categories.
+
+    :param probs: (unnormalised) probabilities of the categories
+    :returns A tuple (prob, alias) of arrays of size n_features. A draw picks a column `i` uniformly and returns `i`
+        with probability `prob[i]` and `alias[i]` otherwise.
+
+    >>> prob, alias = build_alias_table([0.5, 0.25, 0.25])
+    >>> prob.tolist(), alias.tolist()
+    ([1.0, 0.75, 0.75], [0, 0, 0])
+    """
+    probs = np.asarray(probs, dtype=np.float64)
+    n = probs.shape[0]
+    scaled = probs * n / probs.sum()
+
+    prob = np.ones(n)
+    alias = np.arange(n)
+
+    small = list(np.flatnonzero(scaled < 1.))
+    large = list(np.flatnonzero(scaled >= 1.))
+
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+
+        scaled[l] = scaled[l] + scaled[s] - 1.
+        if scaled[l] < 1.:
+            small.append(l)
+        else:
+            large.append(l)
+    # the remaining columns are full, up to rounding errors
+
+    return prob, alias
+
+
+class AliasSampler:
+    """
+    Draws input ids on the CPU with an alias table built once from `probs`.
+    The stream of ids is fully determined by the seed passed to `reset`.
+
+    >>> sampler = AliasSampler(np.ones(8) / 8)
+    >>> sampler.reset(seed=1)
+    >>> first = sampler.sample(5)
+    >>> sampler.reset(seed=1)
+    >>> torch.equal(first, sampler.sample(5))
+    True
+    >>> probs = np.zeros(128)
+    >>> probs[0] = probs[1] = 0.5
+    >>> sampler = AliasSampler(probs)
+    >>> sampler.reset(seed=1)
+    >>> (sampler.sample(256) < 2).all().item()
+    True
+    """
+    def __init__(self, probs):
+        self.n_features = len(probs)
+        self.prob, self.alias = build_alias_table(probs)
+        self.random_state = np.random.RandomState()
+
+    def reset(self, seed=None):
+        self.random_state = np.random.RandomState(seed)
+
+    def sample(self, size):
+        columns = self.random_state.randint(0, self.n_features, size=size)
+        coins = self.random_state.random_sample(size=size)
+        ids = np.where(coins < self.prob[columns], columns, self.alias[columns])
+        return torch.from_numpy(ids).long()
+
+
+class TorchAliasSampler:
+    """
+    Same as AliasSampler, but the table lives on `device` and the draws are done there with a seeded
+    torch.Generator, so that the sampled batches need no host-to-device copy.
+
+    >>> sampler = TorchAliasSampler(np.ones(8) / 8, device='cpu')
+    >>> sampler.reset(seed=1)
+    >>> first = sampler.sample(5)
+    >>> sampler.reset(seed=1)
+    >>> torch.equal(first, sampler.sample(5))
+    True
+    """
+    def __init__(self, probs, device='cpu'):
+        prob, alias = build_alias_table(probs)
+        self.n_features = len(probs)
+        self.device = torch.device(device)
+        self.prob = torch.from_numpy(prob).float().to(self.device)
+        self.alias = torch.from_numpy(alias).long().to(self.device)
+        self.generator = torch.Generator(device=self.device)
+
+    def reset(self, seed=None):
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def sample(self, size):
+        columns = torch.randint(0, self.n_features, (size,), generator=self.generator, device=self.device)
+        coins = torch.rand(size, generator=self.generator, device=self.device)
+        return torch.where(coins < self.prob[columns], columns, self.alias[columns])
+
+
+def build_sampler(name, probs, device='cpu'):
+    """
+    :param name: 'multinomial' (the loaders draw with RandomState.multinomial, returns None), 'alias' (AliasSampler)
+        or 'torch' (TorchAliasSampler on `device`)
+    """
+    if name == 'multinomial':
+        return None
+    if name == 'alias':
+        return AliasSampler(probs)
+    if name == 'torch':
+        return TorchAliasSampler(probs, device=device)
+    raise ValueError(f"Unknown sampler: {name}")
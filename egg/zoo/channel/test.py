@@ -10,8 +10,9 @@ import torch.utils.data
 import torch.nn.functional as F
 import egg.core as core
 from egg.core import EarlyStopperAccuracy
-from egg.zoo.channel.features import OneHotLoader, UniformLoader
+from egg.zoo.channel.features import OneHotLoader, UniformLoader, build_probs
 from egg.zoo.channel.archs import Sender, Receiver
+from egg.zoo.channel.losses import loss_impatient
 from egg.core.util import dump_sender_receiver_test
 from egg.core.util import dump_impose_message
 from egg.core.reinforce_wrappers import RnnReceiverImpatient
@@ -52,6 +53,12 @@ def get_params(params):
 
     parser.add_argument('--sender_generate_style', type=str, default='in-place', choices=['standard', 'in-place'],
                         help='How the next symbol is generated within the TransformerDecoder (default: in-place)')
+    parser.add_argument('--attention', type=str, default='torch', choices=['torch', 'sdpa'],
+                        help='Attention backend of the Transformer agents: nn.MultiheadAttention or '
+                             'F.scaled_dot_product_attention (default: torch)')
+    parser.add_argument('--receiver_pooling', type=str, default='after_eos', choices=['after_eos', 'eos', 'mean', 'first'],
+                        help='Embedding taken as the representative of the message by a causal Transformer Receiver '
+                             '(default: after_eos)')
 
     parser.add_argument('--sender_cell', type=str, default='rnn',
                         help='Type of the cell used for Sender {rnn, gru, lstm, transformer} (default: rnn)')
@@ -200,13 +207,7 @@ def main(params):
 
     force_eos = opts.force_eos == 1
 
-    if opts.probs == 'uniform':
-        probs = np.ones(opts.n_features)
-    elif opts.probs == 'powerlaw':
-        probs = 1 / np.arange(1, opts.n_features+1, dtype=np.float32)
-    else:
-        probs = np.array([float(x) for x in opts.probs.split(',')], dtype=np.float32)
-    probs /= probs.sum()
+    probs = build_probs(opts.probs, opts.n_features)
 
     train_loader = OneHotLoader(n_features=opts.n_features, batch_size=opts.batch_size,
                                 batches_per_epoch=opts.batches_per_epoch, probs=probs)
@@ -222,7 +223,7 @@ def main(params):
                                                  hidden_size=opts.sender_hidden,
                                                  force_eos=opts.force_eos,
                                                  generate_style=opts.sender_generate_style,
-                                                 causal=opts.causal_sender)
+                                                 causal=opts.causal_sender, attention=opts.attention)
     else:
         sender = Sender(n_features=opts.n_features, n_hidden=opts.sender_hidden)
 
@@ -234,7 +235,8 @@ def main(params):
         receiver = Receiver(n_features=opts.n_features, n_hidden=opts.receiver_embedding)
         receiver = core.TransformerReceiverDeterministic(receiver, opts.vocab_size, opts.max_len,
                                                          opts.receiver_embedding, opts.receiver_num_heads, opts.receiver_hidden,
-                                                         opts.receiver_num_layers, causal=opts.causal_receiver)
+                                                         opts.receiver_num_layers, causal=opts.causal_receiver,
+                                                         attention=opts.attention, pooling=opts.receiver_pooling)
     else:
 
         receiver = Receiver(n_features=opts.n_features, n_hidden=opts.receiver_hidden)
@@ -263,7 +265,7 @@ def main(params):
                                            receiver_entropy_coeff=opts.receiver_entropy_coeff,
                                            length_cost=opts.length_cost,unigram_penalty=opts.unigram_pen)
     else:
-        game = SenderImpatientReceiverRnnReinforce(sender, receiver, loss, sender_entropy_coeff=opts.sender_entropy_coeff,
+        game = SenderImpatientReceiverRnnReinforce(sender, receiver, loss_impatient, sender_entropy_coeff=opts.sender_entropy_coeff,
                                            receiver_entropy_coeff=opts.receiver_entropy_coeff,
                                            length_cost=opts.length_cost,unigram_penalty=opts.unigram_pen)
 
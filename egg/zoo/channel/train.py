@@ -5,6 +5,7 @@
 
 import json
 import argparse
+import functools
 import numpy as np
 import torch.utils.data
 import torch.nn.functional as F
@@ -12,12 +13,23 @@ import egg.core as core
 from egg.core import EarlyStopperAccuracy
 from egg.zoo.channel.features import OneHotLoader, UniformLoader
 from egg.zoo.channel.archs import Sender, Receiver
+from egg.zoo.channel.samplers import build_sampler
+from egg.zoo.channel.losses import loss_impatient, input_ids
 from egg.core.reinforce_wrappers import RnnReceiverImpatient
 from egg.core.reinforce_wrappers import SenderImpatientReceiverRnnReinforce
-from egg.core.util import dump_sender_receiver_impatient
+from egg.core.util import impatient_score
+from egg.core.run_store import symbol_dtype
 import platform
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+def impatient_positions(value):
+    """
+    Parses --impatient_positions: 0 (all the positions) or at least 2 (the eos position and one stratum before it).
+    """
+    n_positions = int(value)
+    if n_positions != 0 and n_positions < 2:
+        raise argparse.ArgumentTypeError(f'{value} reading positions: 0 (all the positions) or at least 2 are expected')
+    return n_positions
+
 
 def get_params(params):
     parser = argparse.ArgumentParser()
@@ -76,6 +88,14 @@ def get_params(params):
     # AJOUT
     parser.add_argument('--dir_save', type=str, default="expe_1",
                         help="Directory in which we will save the information")
+    parser.add_argument('--npy_dumps', default=True, action='store_true',
+                        help='Also save the messages and the accuracies of each epoch as .npy files in '
+                             'dir_save/messages and dir_save/accuracy, besides the run store dir_save/run '
+                             '(default: True, will be False in the next release)')
+    parser.add_argument('--no_npy_dumps', dest='npy_dumps', action='store_false',
+                        help='Only save the messages and the accuracies of each epoch in the run store dir_save/run')
+    parser.add_argument('--store_predictions', default=False, action='store_true',
+                        help='Save the predictions of Impatient Listener at every position in the run store')
     parser.add_argument('--unigram_pen', type=float, default=0.0,
                         help="Add a penalty for redundancy")
     parser.add_argument('--impatient', type=bool, default=False,
@@ -84,6 +104,42 @@ def get_params(params):
                         help='Print message ?')
     parser.add_argument('--reg', type=bool, default=False,
                         help='Add regularization ?')
+    parser.add_argument('--sampler', type=str, default='multinomial', choices=['multinomial', 'alias', 'torch'],
+                        help='How the training inputs are drawn: RandomState.multinomial, an alias table on the CPU '
+                             'or an alias table on the training device (default: multinomial)')
+    parser.add_argument('--early_exit', default=False, action='store_true',
+                        help='Stop unrolling Sender once every message of the batch has ended (default: False)')
+    parser.add_argument('--adaptive_max_len', default=False, action='store_true',
+                        help='Adapt the unrolling horizon of Sender to the lengths of the training messages '
+                             '(default: False)')
+    parser.add_argument('--receiver_buckets', type=int, default=1,
+                        help='Number of length buckets the messages are split into before being fed to Receiver, '
+                             'each one truncated to its longest message (default: 1, no bucketing)')
+    parser.add_argument('--receiver_chunk_size', type=int, default=0,
+                        help='If positive, the output layer and the Impatient loss are evaluated by chunks of that '
+                             'many (message, position) pairs, without materialising the [batch, max_len, n_features] '
+                             'predictions (default: 0)')
+    parser.add_argument('--dump_chunk_size', type=int, default=256,
+                        help='Number of inputs run at once through the game by the evaluation at the end of each '
+                             'epoch (default: 256)')
+    parser.add_argument('--impatient_positions', type=impatient_positions, default=0,
+                        help='If positive, the Impatient loss is estimated during training from that many reading '
+                             'positions per message: the eos position and one position per stratum of the positions '
+                             'before it, with unbiased weights (default: 0, all the positions)')
+    parser.add_argument('--receiver_head', type=str, default='dense', choices=core.OUTPUT_HEADS,
+                        help='Output layer of Receiver: a dense softmax, an adaptive softmax with clusters derived '
+                             'from the input frequencies, or a dense softmax trained with a sampled softmax. The '
+                             'exact softmax is used at evaluation time (default: dense)')
+    parser.add_argument('--head_cutoff_masses', type=str, default='0.8,0.95',
+                        help='For --receiver_head=adaptive, the probability masses covered by the clusters of most '
+                             'frequent inputs (default: 0.8,0.95)')
+    parser.add_argument('--sampled_negatives', type=int, default=1024,
+                        help='For --receiver_head=sampled, the number of negatives drawn from the input '
+                             'distribution (default: 1024)')
+    parser.add_argument('--input_ids', default=False, action='store_true',
+                        help='Feed the inputs as ids instead of one-hot vectors (default: False)')
+    parser.add_argument('--position_weighting', type=str, default='uniform', choices=['uniform', 'decreasing', 'last'],
+                        help='Weights of the reading positions in the Impatient loss (default: uniform)')
 
     args = core.init(parser, params)
 
@@ -91,65 +147,11 @@ def get_params(params):
 
 
 def loss(sender_input, _message, _receiver_input, receiver_output, _labels):
-    acc = (receiver_output.argmax(dim=1) == sender_input.argmax(dim=1)).detach().float()
-    loss = F.cross_entropy(receiver_output, sender_input.argmax(dim=1), reduction="none")
+    target = input_ids(sender_input)
+    acc = (receiver_output.argmax(dim=1) == target).detach().float()
+    loss = F.cross_entropy(receiver_output, target, reduction="none")
     return loss, {'acc': acc}
 
-def loss_impatient(sender_input, _message, message_length, _receiver_input, receiver_output, _labels):
-
-    """
-    Compute the loss function for the Impatient Listener.
-    It is equal to the average cross entropy of all the intermediate predictions
-
-    Params:
-    - sender_input: ground truth 1-hot vector | size=(batch_size,n_features)
-    - receiver_output: receiver predictions | size=(batch_size,max_len,n_features)
-    - message_lengh: message length | size=(batch_size)
-
-    Returns:
-    - loss: |  size= ????
-    - {acc:acc}: mean accuracy | size=(batch_size)
-    - crible_acc: accuracy by position | size=(batch_size,max_len)
-    """
-
-    # 1. len_mask selects only the symbols before EOS-token
-    to_onehot=torch.eye(_message.size(1)).to(device)
-    to_onehot=torch.cat((to_onehot,torch.zeros((1,_message.size(1))).to(device)),0)
-    len_mask=[]
-    for i in range(message_length.size(0)):
-      len_mask.append(to_onehot[message_length[i]])
-    len_mask=torch.stack(len_mask,dim=0)
-
-    len_mask=torch.cumsum(len_mask,dim=1)
-    len_mask=torch.ones(len_mask.size()).to(device).add_(-len_mask)
-
-    # 2. coef applies weights on each position. By default it is equal
-    coef=(1/message_length.to(float)).repeat(_message.size(1),1).transpose(1,0) # useless ?
-    coef2=coef # useless ?
-    len_mask.mul_((coef2)) # useless ?
-    len_mask.mul_((1/len_mask.sum(1)).repeat((_message.size(1),1)).transpose(1,0))
-
-    # Test: change positional wieghts
-    #coef2=coef*torch.arange(_message.size(1),0,-1).repeat(_message.size(0),1).to("cuda")
-
-
-    # 3. crible_acc gathers accuracy for each input/position, crible_loss gathers losses for each input/position
-    crible_acc=torch.zeros(size=_message.size()).to(device)
-    crible_loss=torch.zeros(size=_message.size()).to(device)
-
-    for i in range(receiver_output.size(1)):
-      crible_acc[:,i].add_((receiver_output[:,i,:].argmax(dim=1) == sender_input.argmax(dim=1)).detach().float())
-      crible_loss[:,i].add_(F.cross_entropy(receiver_output[:,i,:], sender_input.argmax(dim=1), reduction="none"))
-
-    # 4. Apply mask to remove the positions after EOS-token
-    acc=crible_acc*len_mask
-    loss=crible_loss*len_mask
-
-    acc = acc.sum(1)
-    loss= loss.sum(1)
-
-    return loss, {'acc': acc}, crible_acc
-
 #def loss_impatient2(sender_input, _message, message_length, _receiver_input, receiver_output, _labels):
 
 #    to_onehot=torch.eye(_message.size(1)).to("cuda")
@@ -232,40 +234,75 @@ def dump(game, n_features, device, gs_mode, epoch):
 
     return acc_vec, messages
 
-def dump_impatient(game, n_features, device, gs_mode,epoch):
+def dump_impatient(game, n_features, device, gs_mode,epoch,as_index=False,chunk_size=0):
     # tiny "dataset"
-    dataset = [[torch.eye(n_features).to(device), None]]
+    dataset = [[UniformLoader(n_features, as_index=as_index).batch[0].to(device), None]]
 
-    sender_inputs, messages, receiver_inputs, receiver_outputs, _ = \
-        dump_sender_receiver_impatient(game, dataset, gs=gs_mode, device=device, variable_length=True)
+    dump = core.dump_interactions(game, dataset, gs=gs_mode, device=device, per_position=True, with_predictions=True,
+                                  chunk_size=chunk_size)
+    print("Impatient score="+str(impatient_score(dump.predictions)), flush=True)
 
-    unif_acc = 0.
-    powerlaw_acc = 0.
     powerlaw_probs = 1 / np.arange(1, n_features+1, dtype=np.float32)
     powerlaw_probs /= powerlaw_probs.sum()
 
-    acc_vec=np.zeros(n_features)
-
-    for sender_input, message, receiver_output in zip(sender_inputs, messages, receiver_outputs):
-        input_symbol = sender_input.argmax()
-        output_symbol = receiver_output.argmax()
-        acc = (input_symbol == output_symbol).float().item()
+    input_symbols = dump.sender_input if as_index else dump.sender_input.argmax(dim=1)
+    output_symbols = dump.receiver_output.argmax(dim=1)
+    acc = (input_symbols == output_symbols).double().cpu().numpy()
+    input_symbols, output_symbols = input_symbols.cpu().numpy(), output_symbols.cpu().numpy()
 
-        acc_vec[int(input_symbol)]=acc
+    acc_vec=np.zeros(n_features)
+    acc_vec[input_symbols]=acc
 
-        unif_acc += acc
-        powerlaw_acc += powerlaw_probs[input_symbol] * acc
-        if epoch%100==0:
-            print(f'input: {input_symbol.item()} -> message: {",".join([str(x.item()) for x in message])} -> output: {output_symbol.item()}', flush=True)
+    unif_acc = acc.sum() / n_features
+    powerlaw_acc = (powerlaw_probs[input_symbols] * acc).sum()
 
-    unif_acc /= n_features
+    if epoch%100==0:
+        messages = np.split(dump.message_values.cpu().numpy(), dump.message_offsets[1:-1].cpu().numpy())
+        for input_symbol, message, output_symbol in zip(input_symbols, messages, output_symbols):
+            print(f'input: {input_symbol} -> message: {",".join([str(x) for x in message])} -> output: {output_symbol}', flush=True)
 
     #print(f'Mean accuracy wrt uniform distribution is {unif_acc}')
     #print(f'Mean accuracy wrt powerlaw distribution is {powerlaw_acc}')
     if epoch%25==0:
         print(json.dumps({'powerlaw': float(powerlaw_acc), 'unif': float(unif_acc)}))
 
-    return acc_vec, messages
+    return acc_vec, dump
+
+def build_game(opts, probs=None):
+    """
+    Builds the Sender/Impatient Receiver game described by the command line options. `probs` is the distribution
+    of the training inputs, from which the adaptive and sampled output heads of Receiver are built.
+    """
+    force_eos = opts.force_eos == 1
+
+    sender = Sender(n_features=opts.n_features, n_hidden=opts.sender_hidden)
+    sender = core.RnnSenderReinforce(sender,
+                                opts.vocab_size, opts.sender_embedding, opts.sender_hidden,
+                                cell=opts.sender_cell, max_len=opts.max_len, num_layers=opts.sender_num_layers,
+                                force_eos=force_eos, early_exit=opts.early_exit)
+
+    output_head = core.build_output_head(opts.receiver_head, opts.receiver_hidden, opts.n_features, probs,
+                                         n_samples=opts.sampled_negatives,
+                                         masses=[float(m) for m in opts.head_cutoff_masses.split(',')])
+
+    receiver = Receiver(n_features=opts.receiver_hidden, n_hidden=opts.vocab_size)
+    receiver = RnnReceiverImpatient(receiver, opts.vocab_size, opts.receiver_embedding,
+                                    opts.receiver_hidden, cell=opts.receiver_cell,
+                                    num_layers=opts.receiver_num_layers, max_len=opts.max_len, n_features=opts.n_features,
+                                    chunk_size=opts.receiver_chunk_size, output_head=output_head)
+
+    impatient_loss = functools.partial(loss_impatient, weighting=opts.position_weighting)
+
+    max_len_controller = core.AdaptiveMaxLen(sender.max_len) if opts.adaptive_max_len else None
+
+    game = SenderImpatientReceiverRnnReinforce(sender, receiver, impatient_loss, sender_entropy_coeff=opts.sender_entropy_coeff,
+                                           receiver_entropy_coeff=opts.receiver_entropy_coeff,
+                                           length_cost=opts.length_cost,unigram_penalty=opts.unigram_pen,reg=opts.reg,
+                                           max_len_controller=max_len_controller, receiver_buckets=opts.receiver_buckets,
+                                           impatient_positions=opts.impatient_positions)
+
+    return game
+
 
 def main(params):
     
@@ -292,42 +329,39 @@ def main(params):
     print(opts, flush=True)
     
     device = opts.device
-    force_eos = opts.force_eos == 1
 
     probs = 1 / np.arange(1, opts.n_features+1, dtype=np.float32)
     probs /= probs.sum()
 
     print('the probs are: ', probs, flush=True)
 
+    sampler = build_sampler(opts.sampler, probs, device=device)
     train_loader = OneHotLoader(n_features=opts.n_features, batch_size=opts.batch_size,
-                                batches_per_epoch=opts.batches_per_epoch, probs=probs)
+                                batches_per_epoch=opts.batches_per_epoch, probs=probs, as_index=opts.input_ids,
+                                sampler=sampler)
 
-    test_loader = UniformLoader(opts.n_features)
+    test_loader = UniformLoader(opts.n_features, as_index=opts.input_ids)
 
-    sender = Sender(n_features=opts.n_features, n_hidden=opts.sender_hidden)
-    sender = core.RnnSenderReinforce(sender,
-                                opts.vocab_size, opts.sender_embedding, opts.sender_hidden,
-                                cell=opts.sender_cell, max_len=opts.max_len, num_layers=opts.sender_num_layers,
-                                force_eos=force_eos)
-
-    receiver = Receiver(n_features=opts.receiver_hidden, n_hidden=opts.vocab_size)
-    receiver = RnnReceiverImpatient(receiver, opts.vocab_size, opts.receiver_embedding,
-                                    opts.receiver_hidden, cell=opts.receiver_cell,
-                                    num_layers=opts.receiver_num_layers, max_len=opts.max_len, n_features=opts.n_features)
-
-
-
-    game = SenderImpatientReceiverRnnReinforce(sender, receiver, loss_impatient, sender_entropy_coeff=opts.sender_entropy_coeff,
-                                           receiver_entropy_coeff=opts.receiver_entropy_coeff,
-                                           length_cost=opts.length_cost,unigram_penalty=opts.unigram_pen,reg=opts.reg)
+    game = build_game(opts, probs)
+    sender, receiver = game.sender, game.receiver
 
     optimizer = core.build_optimizer(game.parameters())
 
     trainer = core.Trainer(game=game, optimizer=optimizer, train_data=train_loader,
                            validation_data=test_loader, callbacks=[EarlyStopperAccuracy(opts.early_stopping_thr)])
 
+    # messages, accuracies (and predictions) of each epoch. A run resumed from a checkpoint appends to its store,
+    # from the epoch of the checkpoint
+    resumed = trainer.starting_epoch is not None
+    run_store = core.RunStoreWriter(opts.dir_save + '/run', n_inputs=opts.n_features, max_len=opts.max_len,
+                                    vocab_size=opts.vocab_size, overwrite=not resumed)
+    first_epoch = 0
+    if resumed:
+        first_epoch = trainer.starting_epoch
+        run_store.rewind(first_epoch)
 
-    for epoch in range(int(opts.n_epochs)):
+
+    for epoch in range(first_epoch, int(opts.n_epochs)):
 
         print("Epoch: "+str(epoch))
 
@@ -339,20 +373,25 @@ def main(params):
             trainer.save_checkpoint(name=f'{opts.name}_vocab{opts.vocab_size}_rs{opts.random_seed}_lr{opts.lr}_shid{opts.sender_hidden}_rhid{opts.receiver_hidden}_sentr{opts.sender_entropy_coeff}_reg{opts.length_cost}_max_len{opts.max_len}')
 
 
-        acc_vec,messages=dump_impatient(trainer.game, opts.n_features, device, False,epoch)
-
-        all_messages=[]
-        for x in messages:
-            x = x.cpu().numpy()
-            all_messages.append(x)
+        acc_vec,dump=dump_impatient(trainer.game, opts.n_features, device, False,epoch,as_index=opts.input_ids,
+                                    chunk_size=opts.dump_chunk_size)
 
         if epoch%50==0:
             torch.save(sender.state_dict(), opts.dir_save+"/sender/sender_weights_epoch_"+str(epoch)+"_n_features_"+str(opts.n_features)+".pth")
             torch.save(receiver.state_dict(), opts.dir_save+"/receiver/receiver_weights_epoch_"+str(epoch)+"_n_features_"+str(opts.n_features)+".pth")
 
-        np.save(opts.dir_save + '/messages/messages_epoch_' + str(epoch) + '_n_features_' + str(opts.n_features) + '.npy', np.array(all_messages, dtype=object), allow_pickle=True)
-        np.save(opts.dir_save+'/accuracy/accuracy_epoch_'+str(epoch)+'_n_features_'+str(opts.n_features)+'.npy', acc_vec)
- 
+        columns = {'accuracy': acc_vec}
+        if opts.store_predictions:
+            # padded to max_len with -1 (no position), as the width of the messages may vary
+            predictions = np.full((opts.n_features, opts.max_len), -1, dtype=symbol_dtype(opts.n_features))
+            predictions[:, :dump.predictions.size(1)] = dump.predictions.cpu().numpy()
+            columns['predictions'] = predictions
+        run_store.append(epoch, dump.padded_messages().cpu().numpy(), dump.message_lengths.cpu().numpy(), **columns)
+
+        if opts.npy_dumps:
+            all_messages = [x.cpu().numpy() for x in dump.messages()]
+            np.save(opts.dir_save + '/messages/messages_epoch_' + str(epoch) + '_n_features_' + str(opts.n_features) + '.npy', np.array(all_messages, dtype=object), allow_pickle=True)
+            np.save(opts.dir_save+'/accuracy/accuracy_epoch_'+str(epoch)+'_n_features_'+str(opts.n_features)+'.npy', acc_vec)
 
     core.close()
 
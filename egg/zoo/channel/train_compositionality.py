@@ -15,11 +15,14 @@ import egg.core as core
 from egg.core import EarlyStopperAccuracy
 from egg.zoo.channel.features import OneHotLoader, UniformLoader, OneHotLoaderCompositionality, TestLoaderCompositionality
 from egg.zoo.channel.archs import Sender, Receiver
+from egg.zoo.channel.samplers import build_sampler
+from egg.zoo.channel.losses import loss_impatient_compositionality
 from egg.core.reinforce_wrappers import RnnReceiverImpatient, RnnReceiverImpatientCompositionality, RnnReceiverCompositionality
 from egg.core.reinforce_wrappers import SenderImpatientReceiverRnnReinforce, CompositionalitySenderImpatientReceiverRnnReinforce, CompositionalitySenderReceiverRnnReinforce
 from egg.core.util import dump_sender_receiver_impatient, dump_sender_receiver_impatient_compositionality, dump_sender_receiver_compositionality
 
 from egg.core.trainers import CompoTrainer
+from egg.core.run_store import pad_messages
 
 
 def get_params(params):
@@ -79,6 +82,12 @@ def get_params(params):
     # AJOUT
     parser.add_argument('--dir_save', type=str, default="expe_1",
                         help="Directory in which we will save the information")
+    parser.add_argument('--npy_dumps', default=True, action='store_true',
+                        help='Also save the messages and the accuracies of each epoch as .npy files in '
+                             'dir_save/messages and dir_save/accuracy, besides the run store dir_save/run '
+                             '(default: True, will be False in the next release)')
+    parser.add_argument('--no_npy_dumps', dest='npy_dumps', action='store_false',
+                        help='Only save the messages and the accuracies of each epoch in the run store dir_save/run')
     parser.add_argument('--unigram_pen', type=float, default=0.0,
                         help="Add a penalty for redundancy")
     parser.add_argument('--impatient', type=bool, default=False,
@@ -87,6 +96,17 @@ def get_params(params):
                         help='Print message ?')
     parser.add_argument('--reg', type=bool, default=False,
                         help='Add regularization ?')
+    parser.add_argument('--sampler', type=str, default='multinomial', choices=['multinomial', 'alias', 'torch'],
+                        help='How the training inputs are drawn: RandomState.multinomial, an alias table on the CPU '
+                             'or an alias table on the training device (default: multinomial)')
+    parser.add_argument('--early_exit', default=False, action='store_true',
+                        help='Stop unrolling Sender once every message of the batch has ended (default: False)')
+    parser.add_argument('--adaptive_max_len', default=False, action='store_true',
+                        help='Adapt the unrolling horizon of Sender to the lengths of the training messages '
+                             '(default: False)')
+    parser.add_argument('--receiver_buckets', type=int, default=1,
+                        help='Number of length buckets the messages are split into before being fed to Receiver, '
+                             'each one truncated to its longest message (default: 1, no bucketing)')
 
     # Compositionality
     parser.add_argument('--n_attributes', type=int, default=3,
@@ -108,39 +128,6 @@ def loss(sender_input, _message, _receiver_input, receiver_output, _labels):
     loss = F.cross_entropy(receiver_output, sender_input.argmax(dim=1), reduction="none")
     return loss, {'acc': acc}
 
-def loss_impatient(sender_input, _message, message_length, _receiver_input, receiver_output, _labels):
-
-    to_onehot=torch.eye(_message.size(1)).to("cuda")
-    to_onehot=torch.cat((to_onehot,torch.zeros((1,_message.size(1))).to("cuda")),0)
-    len_mask=[]
-    for i in range(message_length.size(0)):
-      len_mask.append(to_onehot[message_length[i]])
-    len_mask=torch.stack(len_mask,dim=0)
-
-    coef=(1/message_length.to(float)).repeat(_message.size(1),1).transpose(1,0)
-    coef2=coef*torch.arange(_message.size(1),0,-1).repeat(_message.size(0),1).to("cuda")
-
-    len_mask=torch.cumsum(len_mask,dim=1)
-    len_mask=torch.ones(len_mask.size()).to("cuda").add_(-len_mask)
-
-    len_mask.mul_((coef2))
-    len_mask.mul_((1/len_mask.sum(1)).repeat((_message.size(1),1)).transpose(1,0))
-
-    crible_acc=torch.zeros(size=_message.size()).to("cuda")
-    crible_loss=torch.zeros(size=_message.size()).to("cuda")
-
-    for i in range(receiver_output.size(1)):
-      crible_acc[:,i].add_((receiver_output[:,i,:].argmax(dim=1) == sender_input.argmax(dim=1)).detach().float())
-      crible_loss[:,i].add_(F.cross_entropy(receiver_output[:,i,:], sender_input.argmax(dim=1), reduction="none"))
-
-    acc=crible_acc*len_mask
-    loss=crible_loss*len_mask
-
-    acc = acc.sum(1)
-    loss= loss.sum(1)
-
-    return loss, {'acc': acc}, crible_acc
-
 def loss_compositionality(sender_input, _message, message_length, _receiver_input, receiver_output, _labels,n_attributes,n_values):
 
     loss=0.
@@ -156,52 +143,6 @@ def loss_compositionality(sender_input, _message, message_length, _receiver_inpu
 
     return loss, {'acc': crible_acc}, crible_acc
 
-def loss_impatient_compositionality(sender_input, _message, message_length, _receiver_input, receiver_output, _labels,n_attributes,n_values,att_weights):
-
-    to_onehot=torch.eye(_message.size(1)).to("cuda")
-    to_onehot=torch.cat((to_onehot,torch.zeros((1,_message.size(1))).to("cuda")),0)
-    len_mask=[]
-    for i in range(message_length.size(0)):
-      len_mask.append(to_onehot[message_length[i]])
-    len_mask=torch.stack(len_mask,dim=0)
-
-    coef=(1/message_length.to(float)).repeat(_message.size(1),1).transpose(1,0)
-    #coef2=coef*torch.arange(_message.size(1),0,-1).repeat(_message.size(0),1).to("cuda")
-    coef2=coef
-    # NEW LOSS
-    #Mlen=n_attributes*torch.ones(message_length.size()).to("cuda")
-    #coef=(1/Mlen).repeat(_message.size(1),1).transpose(1,0)
-    #coef2=coef
-
-    len_mask=torch.cumsum(len_mask,dim=1)
-    len_mask=torch.ones(len_mask.size()).to("cuda").add_(-len_mask)
-
-    #len_mask.mul_((coef2)) # A priori avec la normalisation apres, etape useless
-    len_mask.mul_((1/len_mask.sum(1)).repeat((_message.size(1),1)).transpose(1,0))
-
-    crible_acc=torch.zeros(size=_message.size()).to("cuda")
-    crible_loss=torch.zeros(size=_message.size()).to("cuda")
-
-    for i in range(receiver_output.size(1)):
-      ro=receiver_output[:,i,:].reshape(receiver_output.size(0),n_attributes,n_values)
-      si=sender_input.reshape(sender_input.size(0),n_attributes,n_values)
-
-      crible_acc[:,i].add_((ro.argmax(dim=2)==si.argmax(2)).detach().float().sum(1)/n_attributes)
-
-      #crible_loss[:,i].add_(F.cross_entropy(receiver_output[:,i,:], sender_input.argmax(dim=1), reduction="none"))
-      for j in range(ro.size(1)):
-        #K=att_weights[j]
-        K=si[:,j,:].max(dim=1).values
-        crible_loss[:,i].add_(K*F.cross_entropy(ro[:,j,:], si[:,j,:].argmax(dim=1), reduction="none")/n_attributes)
-
-    acc=crible_acc*len_mask
-    loss=crible_loss*len_mask
-
-    acc = acc.sum(1)
-    loss= loss.sum(1)
-
-    return loss, {'acc': acc}, crible_acc
-
 def dump(game, n_features, device, gs_mode, epoch):
     # tiny "dataset"
     dataset = [[torch.eye(n_features).to(device), None]]
@@ -407,8 +348,13 @@ def main(params):
 
     print("Probability by attribute is:",probs_attributes)
 
+    samplers = None
+    if opts.sampler != 'multinomial':
+        samplers = [build_sampler(opts.sampler, probs_by_att, device=device) for probs_by_att in probs]
+
     train_loader = OneHotLoaderCompositionality(n_values=opts.n_values, n_attributes=opts.n_attributes, batch_size=opts.batch_size*opts.n_attributes,
-                                                batches_per_epoch=opts.batches_per_epoch, probs=probs, probs_attributes=probs_attributes)
+                                                batches_per_epoch=opts.batches_per_epoch, probs=probs, probs_attributes=probs_attributes,
+                                                samplers=samplers)
 
     # single batches with 1s on the diag
     test_loader = TestLoaderCompositionality(n_values=opts.n_values,n_attributes=opts.n_attributes)
@@ -419,7 +365,7 @@ def main(params):
 
     sender = core.RnnSenderReinforce(sender,opts.vocab_size, opts.sender_embedding, opts.sender_hidden,
                                    cell=opts.sender_cell, max_len=opts.max_len, num_layers=opts.sender_num_layers,
-                                   force_eos=force_eos)
+                                   force_eos=force_eos, early_exit=opts.early_exit)
 
 
     ### RECEIVER ###
@@ -439,25 +385,39 @@ def main(params):
                                             num_layers=opts.receiver_num_layers, max_len=opts.max_len, n_attributes=opts.n_attributes, n_values=opts.n_values)
 
 
+    max_len_controller = core.AdaptiveMaxLen(sender.max_len) if opts.adaptive_max_len else None
+
     if not opts.impatient:
         game = CompositionalitySenderReceiverRnnReinforce(sender, receiver, loss_compositionality, sender_entropy_coeff=opts.sender_entropy_coeff,
                                            n_attributes=opts.n_attributes,n_values=opts.n_values,receiver_entropy_coeff=opts.receiver_entropy_coeff,
-                                           length_cost=opts.length_cost,unigram_penalty=opts.unigram_pen,reg=opts.reg)
+                                           length_cost=opts.length_cost,unigram_penalty=opts.unigram_pen,reg=opts.reg,
+                                           max_len_controller=max_len_controller, receiver_buckets=opts.receiver_buckets)
     else:
         game = CompositionalitySenderImpatientReceiverRnnReinforce(sender, receiver, loss_impatient_compositionality, sender_entropy_coeff=opts.sender_entropy_coeff,
                                            n_attributes=opts.n_attributes,n_values=opts.n_values,att_weights=opts.att_weights,receiver_entropy_coeff=opts.receiver_entropy_coeff,
-                                           length_cost=opts.length_cost,unigram_penalty=opts.unigram_pen,reg=opts.reg)
+                                           length_cost=opts.length_cost,unigram_penalty=opts.unigram_pen,reg=opts.reg,
+                                           max_len_controller=max_len_controller, receiver_buckets=opts.receiver_buckets)
 
     optimizer = core.build_optimizer(game.parameters())
 
     trainer = CompoTrainer(n_attributes=opts.n_attributes,n_values=opts.n_values,game=game, optimizer=optimizer, train_data=train_loader,
                            validation_data=test_loader, callbacks=[EarlyStopperAccuracy(opts.early_stopping_thr)])
 
+    # messages and accuracies of each epoch. A run resumed from a checkpoint appends to its store, from the epoch of
+    # the checkpoint
+    resumed = trainer.starting_epoch is not None
+    run_store = core.RunStoreWriter(opts.dir_save + '/run', n_inputs=opts.n_values**opts.n_attributes,
+                                    max_len=opts.max_len, vocab_size=opts.vocab_size, overwrite=not resumed)
+    first_epoch = 0
+    if resumed:
+        first_epoch = trainer.starting_epoch
+        run_store.rewind(first_epoch)
+
     curr_accs=[0]*7
 
     game.att_weights=[1]*(game.n_attributes)
 
-    for epoch in range(int(opts.n_epochs)):
+    for epoch in range(first_epoch, int(opts.n_epochs)):
 
         print("Epoch: "+str(epoch))
 
@@ -478,19 +438,17 @@ def main(params):
         #print(trainer.optimizer.defaults["lr"])
 
 
-        # ADDITION TO SAVE MESSAGES
-        all_messages=[]
-        for x in messages:
-            x = x.cpu().numpy()
-            all_messages.append(x)
-        all_messages = np.asarray(all_messages)
-
         if epoch%50==0:
             torch.save(sender.state_dict(), opts.dir_save+"/sender/sender_weights"+str(epoch)+".pth")
             torch.save(receiver.state_dict(), opts.dir_save+"/receiver/receiver_weights"+str(epoch)+".pth")
 
-        np.save(opts.dir_save+'/messages/messages_'+str((epoch))+'.npy', all_messages)
-        np.save(opts.dir_save+'/accuracy/accuracy_'+str((epoch))+'.npy', acc_vec)
+        all_messages = [x.cpu().numpy() for x in messages]
+        run_store.append(epoch, *pad_messages(all_messages, opts.max_len), accuracy=acc_vec)
+
+        if opts.npy_dumps:
+            all_messages = np.asarray(all_messages)
+            np.save(opts.dir_save+'/messages/messages_'+str((epoch))+'.npy', all_messages)
+            np.save(opts.dir_save+'/accuracy/accuracy_'+str((epoch))+'.npy', acc_vec)
         print(acc_vec.T)
 
     core.close()
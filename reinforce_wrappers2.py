@@ -153,7 +153,8 @@ class RnnSenderReinforce(nn.Module):
     >>> message.size()  # batch size x max_len
     torch.Size([16, 10])
     """
-    def __init__(self, agent, vocab_size, embed_dim, hidden_size, max_len, num_layers=1, cell='rnn', force_eos=True):
+    def __init__(self, agent, vocab_size, embed_dim, hidden_size, max_len, num_layers=1, cell='rnn', force_eos=True,
+                 early_exit=False):
         """
         :param agent: the agent to be wrapped
         :param vocab_size: the communication vocabulary size
@@ -163,11 +164,14 @@ class RnnSenderReinforce(nn.Module):
         :param cell: type of the cell used (rnn, gru, lstm)
         :param force_eos: if set to True, each message is extended by an EOS symbol. To ensure that no message goes
         beyond `max_len`, Sender only generates `max_len - 1` symbols from an RNN cell and appends EOS.
+        :param early_exit: if set to True, the unrolling stops as soon as every message of the batch contains EOS; the
+        remaining positions are filled with EOS, with zero log-prob and entropy. The output shapes are unchanged.
         """
         super(RnnSenderReinforce, self).__init__()
         self.agent = agent
 
         self.force_eos = force_eos
+        self.early_exit = early_exit
 
         self.max_len = max_len
         if force_eos:
@@ -209,6 +213,8 @@ class RnnSenderReinforce(nn.Module):
         logits = []
         entropy = []
 
+        eosed = torch.zeros(x.size(0), dtype=torch.bool, device=input.device)
+
         for step in range(self.max_len):
             for i, layer in enumerate(self.cells):
                 if isinstance(layer, nn.LSTMCell):
@@ -233,10 +239,22 @@ class RnnSenderReinforce(nn.Module):
             input = self.embedding(x)
             sequence.append(x)
 
+            if self.early_exit:
+                eosed = eosed | (x == 0)
+                if eosed.all():
+                    break
+
         sequence = torch.stack(sequence).permute(1, 0)
         logits = torch.stack(logits).permute(1, 0)
         entropy = torch.stack(entropy).permute(1, 0)
 
+        if sequence.size(1) < self.max_len:
+            # every message has already ended: the skipped positions are EOS symbols
+            padding = (0, self.max_len - sequence.size(1))
+            sequence = F.pad(sequence, padding)
+            logits = F.pad(logits, padding)
+            entropy = F.pad(entropy, padding)
+
         if self.force_eos:
             zeros = torch.zeros((sequence.size(0), 1)).to(sequence.device)
 